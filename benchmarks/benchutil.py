@@ -0,0 +1,97 @@
+""" Shared code for the benchmarks: timing things, and collecting the results in a form that can be compared between runs.
+
+Each benchmark module has a function run(options, results) and can also be run on its own.
+Results are written as JSON, to standard output unless a file is given, while progress goes to standard error.
+A benchmark which finds something over its budget says so in the results, and the run exits with a non-zero status.
+"""
+
+import os, sys, time, json, platform, tempfile, shutil
+from optparse import OptionParser
+
+# Benchmark this copy of capturemock, rather than any installed one
+packageDir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, packageDir)
+
+class Results:
+    def __init__(self):
+        self.results = []
+        self.failures = []
+
+    def add(self, benchmark, case, seconds, operations=1, **parameters):
+        result = { "benchmark" : benchmark,
+                   "case" : case,
+                   "parameters" : parameters,
+                   "seconds" : round(seconds, 6),
+                   "operations" : operations,
+                   "microseconds_per_operation" : round(seconds * 1000000 / operations, 3) }
+        self.results.append(result)
+        paramText = ", ".join(key + "=" + str(value) for key, value in sorted(parameters.items()))
+        sys.stderr.write("%-20s %-40s %10.4f s %12.2f us/op  %s\n" % (benchmark, case, seconds,
+                                                                     result["microseconds_per_operation"], paramText))
+
+    def fail(self, message):
+        self.failures.append(message)
+        sys.stderr.write("FAILED: " + message + "\n")
+
+    def write(self, fileName):
+        data = { "python" : platform.python_version(),
+                 "implementation" : platform.python_implementation(),
+                 "platform" : platform.platform(),
+                 "time" : time.strftime("%Y-%m-%dT%H:%M:%S"),
+                 "results" : self.results,
+                 "failures" : self.failures }
+        text = json.dumps(data, indent=2, sort_keys=True) + "\n"
+        if fileName:
+            with open(fileName, "w") as f:
+                f.write(text)
+        else:
+            sys.stdout.write(text)
+
+
+def timeBest(func, repeats):
+    # The best of several runs is the one least affected by whatever else the machine is doing
+    best = None
+    for _ in range(repeats):
+        start = time.time()
+        func()
+        taken = time.time() - start
+        if best is None or taken < best:
+            best = taken
+    return best
+
+def scaled(options, size):
+    return max(1, int(size * options.scale))
+
+def makeTempDir():
+    return tempfile.mkdtemp(prefix="capturemock_benchmark")
+
+def removeTempDir(tmpDir):
+    shutil.rmtree(tmpDir, ignore_errors=True)
+
+def writeRcFile(tmpDir, text=""):
+    # Always given explicitly, so that nothing in the personal configuration affects things
+    rcFile = os.path.join(tmpDir, "capturemockrc")
+    with open(rcFile, "w") as f:
+        f.write(text)
+    return rcFile
+
+def makeOptionParser(usage="usage: %prog [options]"):
+    parser = OptionParser(usage)
+    parser.add_option("-o", "--output", help="write the JSON results to this file rather than standard output")
+    parser.add_option("-r", "--repeats", type="int", default=3, help="number of times to repeat each measurement, taking the best")
+    parser.add_option("-s", "--scale", type="float", default=1.0,
+                      help="multiply the size of every workload by this, e.g. 0.1 for a quick check")
+    parser.add_option("-b", "--startup-budget", type="float", default=20.0,
+                      help="allowed extra startup time in milliseconds for an intercepted command, compared with the bare interpreter")
+    return parser
+
+def finish(results, options):
+    results.write(options.output)
+    if results.failures:
+        sys.exit(1)
+
+def main(runFunc, parser=None):
+    options = (parser or makeOptionParser()).parse_args()[0]
+    results = Results()
+    runFunc(options, results)
+    finish(results, options)
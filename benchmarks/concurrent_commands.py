@@ -0,0 +1,81 @@
+#!/usr/bin/env python
+""" Many intercepted command line programs run at the same time against a ClassicTrafficServer,
+as a parallel build or test run would. Measures the round trip of each command through the server,
+over TCP and Unix domain sockets, when recording and when replaying.
+"""
+
+import os, sys, subprocess, threading
+import benchutil
+import capturemock
+
+workers = 16
+
+def runCommands(env, commandCount):
+    # A fixed number of threads working through the commands, so that this many are always in progress
+    remaining = list(range(commandCount))
+    lock = threading.Lock()
+    failures = []
+    def work():
+        while True:
+            with lock:
+                if not remaining:
+                    return
+                index = remaining.pop()
+            proc = subprocess.Popen([ "echo", "command", str(index % 20) ], env=env, stdout=subprocess.PIPE)
+            proc.communicate()
+            if proc.returncode != 0:
+                failures.append(index)
+    threads = [ threading.Thread(target=work) for _ in range(workers) ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    if failures:
+        sys.stderr.write(str(len(failures)) + " intercepted commands failed!\n")
+
+def runWithServer(tmpDir, mode, recordFile, replayFile, rcFile, commandCount):
+    env = dict(os.environ)
+    # The server process needs to find the same capturemock
+    env["PYTHONPATH"] = os.pathsep.join(filter(None, [ benchutil.packageDir, env.get("PYTHONPATH") ]))
+    # Deprecation warnings from the server would be reported as errors when it is terminated
+    env.setdefault("PYTHONWARNINGS", "ignore::DeprecationWarning")
+    interceptDir = os.path.join(tmpDir, "intercepts")
+    manager = capturemock.CaptureMockManager()
+    manager.startServer(mode, recordFile, replayFile, rcFiles=[ rcFile ], interceptDir=interceptDir,
+                        environment=env, sutDirectory=tmpDir)
+    try:
+        runCommands(env, commandCount)
+    finally:
+        manager.terminate()
+
+def run(options, results):
+    if os.name != "posix":
+        sys.stderr.write("Skipping concurrent command benchmark, only works on POSIX\n")
+        return
+    tmpDir = benchutil.makeTempDir()
+    try:
+        commandCount = benchutil.scaled(options, 400)
+        for transport in [ "tcp", "unix" ]:
+            rcFile = benchutil.writeRcFile(tmpDir, "[general]\nserver_transport = " + transport + "\n" +
+                                           "[command line]\nintercepts = echo\n")
+            mockFile = os.path.join(tmpDir, "commands.mock")
+            recordFile = os.path.join(tmpDir, "record.mock")
+            def record():
+                if os.path.isfile(mockFile):
+                    os.remove(mockFile)
+                runWithServer(tmpDir, capturemock.RECORD, mockFile, None, rcFile, commandCount)
+            results.add("concurrent_commands", "record commands", benchutil.timeBest(record, options.repeats), commandCount,
+                        commands=commandCount, workers=workers, transport=transport)
+
+            def replay():
+                if os.path.isfile(recordFile):
+                    os.remove(recordFile)
+                runWithServer(tmpDir, capturemock.REPLAY, recordFile, mockFile, rcFile, commandCount)
+            results.add("concurrent_commands", "replay commands", benchutil.timeBest(replay, options.repeats), commandCount,
+                        commands=commandCount, workers=workers, transport=transport)
+    finally:
+        benchutil.removeTempDir(tmpDir)
+
+
+if __name__ == "__main__":
+    benchutil.main(run)
@@ -0,0 +1,69 @@
+#!/usr/bin/env python
+""" A large directory tree under file-edit tracking, as when a command is given a build area as an argument.
+Measures taking the first snapshot of it, ServerDispatcher.getLatestFileEdits when nothing has changed,
+and finding and storing the edits when some files have changed.
+"""
+
+import os
+from optparse import Values
+import benchutil
+import capturemock
+from capturemock import fileedittraffic
+from capturemock.server import ServerDispatcher
+
+def makeTree(root, fileCount, filesPerDir=500):
+    for index in range(fileCount):
+        dirName = os.path.join(root, "dir" + str(index // filesPerDir))
+        if index % filesPerDir == 0:
+            os.makedirs(dirName)
+        with open(os.path.join(dirName, "file" + str(index) + ".txt"), "w") as f:
+            f.write("contents of file " + str(index) + "\n")
+
+def makeDispatcher(tmpDir, editDir):
+    options = Values({ "rcfiles" : benchutil.writeRcFile(tmpDir),
+                       "mode" : capturemock.RECORD,
+                       "record" : os.path.join(tmpDir, "record.mock"),
+                       "record_file_edits" : editDir,
+                       "replay" : None,
+                       "replay_file_edits" : None })
+    fileedittraffic.FileEditTraffic.configure(options)
+    # Not serving anything, we just want the file edit handling
+    return ServerDispatcher(options, server=object())
+
+def takeSnapshot(dispatcher, root):
+    return dict((path, dispatcher.getLatestModification(path)) for path in dispatcher.findFilesAndLinks(root))
+
+def run(options, results):
+    tmpDir = benchutil.makeTempDir()
+    try:
+        root = os.path.join(tmpDir, "tree")
+        fileCount = benchutil.scaled(options, 50000)
+        makeTree(root, fileCount)
+        editDir = os.path.join(tmpDir, "edits")
+        dispatcher = makeDispatcher(tmpDir, editDir)
+
+        results.add("file_edits", "first snapshot", benchutil.timeBest(lambda: takeSnapshot(dispatcher, root), options.repeats),
+                    fileCount, files=fileCount)
+        fileEditData = takeSnapshot(dispatcher, root)
+        def findNoEdits():
+            assert not dispatcher.getLatestFileEdits([ root ], fileEditData)
+        results.add("file_edits", "no changes", benchutil.timeBest(findNoEdits, options.repeats), fileCount, files=fileCount)
+
+        editCount = min(benchutil.scaled(options, 100), fileCount)
+        editedFiles = [ os.path.join(root, "dir" + str(index // 500), "file" + str(index) + ".txt")
+                        for index in range(0, fileCount, max(1, fileCount // editCount)) ][:editCount]
+        def findAndStoreEdits():
+            # Changing the size means the edit is seen even within the same second
+            for fileName in editedFiles:
+                with open(fileName, "a") as f:
+                    f.write("edited\n")
+            for traffic in dispatcher.getLatestFileEdits([ root ], fileEditData):
+                traffic.record(dispatcher.recordFileHandler, 1) # which is where the edited files are stored
+        results.add("file_edits", "changes found and stored", benchutil.timeBest(findAndStoreEdits, options.repeats),
+                    fileCount, files=fileCount, edited=editCount)
+    finally:
+        benchutil.removeTempDir(tmpDir)
+
+
+if __name__ == "__main__":
+    benchutil.main(run)
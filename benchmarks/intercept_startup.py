@@ -0,0 +1,75 @@
+#!/usr/bin/env python
+""" Measure the startup cost of an intercepted command line program, and check it against a budget.
+
+The intercept is run against a dummy server which answers immediately, so what is measured is the
+interpreter startup, the imports and the round trip. This is compared with starting the bare interpreter.
+Exits with a non-zero status if the intercept takes more than the budget longer than the bare interpreter.
+"""
+
+import os, sys, time, socket, threading, subprocess, tempfile, shutil
+import benchutil
+import capturemock
+from capturemock import framing
+
+def startDummyServer():
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.bind(("127.0.0.1", 0))
+    sock.listen(50)
+    def serve():
+        while True:
+            conn, _ = sock.accept()
+            while conn.recv(65536):
+                pass
+            framing.writeField(conn.sendall, framing.EXC, b"0")
+            framing.writeFrame(conn.sendall, framing.END)
+            conn.close()
+    serverThread = threading.Thread(target=serve)
+    serverThread.daemon = True
+    serverThread.start()
+    host, port = sock.getsockname()
+    return host + ":" + str(port)
+
+def timeCommand(cmdArgs, runs, env):
+    # Take the best of the runs, which is the least affected by other things happening on the machine
+    best = None
+    for _ in range(runs):
+        start = time.time()
+        subprocess.check_call(cmdArgs, env=env)
+        taken = time.time() - start
+        if best is None or taken < best:
+            best = taken
+    return best
+
+def measure(runs):
+    interceptDir = tempfile.mkdtemp()
+    try:
+        interceptName = os.path.join(interceptDir, "benchmark_command")
+        capturemock.CaptureMockManager().makePosixIntercept(interceptName)
+        env = dict(os.environ)
+        env["CAPTUREMOCK_SERVER"] = startDummyServer()
+        bareTime = timeCommand([ sys.executable, "-c", "pass" ], runs, env)
+        interceptTime = timeCommand([ interceptName ], runs, env)
+    finally:
+        shutil.rmtree(interceptDir)
+    return bareTime, interceptTime
+
+def run(options, results):
+    if os.name != "posix":
+        sys.stderr.write("Skipping intercept startup benchmark, only works on POSIX\n")
+        return
+    runs = getattr(options, "runs", None) or benchutil.scaled(options, 20)
+    bareTime, interceptTime = measure(runs)
+    results.add("intercept_startup", "bare interpreter", bareTime, runs=runs)
+    results.add("intercept_startup", "intercepted command", interceptTime, runs=runs)
+    extraMs = (interceptTime - bareTime) * 1000
+    sys.stderr.write("Extra startup: %.1f ms, budget %.1f ms\n" % (extraMs, options.startup_budget))
+    if extraMs > options.startup_budget:
+        results.fail("intercept startup is over budget, %.1f ms extra" % extraMs)
+
+def main():
+    parser = benchutil.makeOptionParser()
+    parser.add_option("-n", "--runs", type="int", help="number of times to run each command, 20 unless scaled")
+    benchutil.main(run, parser)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,71 @@
+#!/usr/bin/env python
+""" An intercepted Python module called very many times, as a polling loop would, when recording and when replaying.
+This exercises PythonTrafficHandler.callFunction and everything it does for each call.
+"""
+
+import os, sys
+import benchutil
+import capturemock
+from capturemock.capturepython import interceptPython
+
+moduleName = "capturemock_benchmark_module"
+moduleText = '''
+class Sensor(object):
+    def __init__(self, name):
+        self.name = name
+
+    def read(self, channel):
+        return { "sensor" : self.name, "channel" : channel, "values" : [ channel, channel * 2.5 ] }
+
+def poll(count):
+    return [ count, "ok" ]
+
+def makeSensor(name):
+    return Sensor(name)
+'''
+
+def runWorkload(calls):
+    module = __import__(moduleName)
+    sensor = module.makeSensor("probe")
+    for i in range(calls - 1):
+        if i % 10 == 0:
+            sensor.read(i % 8)
+        else:
+            module.poll(i % 50)
+
+def runIntercepted(mode, recordFile, replayFile, rcFile, calls):
+    handler = interceptPython(mode, recordFile, replayFile, [ rcFile ], [ moduleName ])
+    try:
+        runWorkload(calls)
+    finally:
+        handler.resetIntercepts()
+        sys.modules.pop(moduleName, None)
+
+def run(options, results):
+    tmpDir = benchutil.makeTempDir()
+    try:
+        with open(os.path.join(tmpDir, moduleName + ".py"), "w") as f:
+            f.write(moduleText)
+        sys.path.insert(0, tmpDir)
+        rcFile = benchutil.writeRcFile(tmpDir)
+        calls = benchutil.scaled(options, 100000)
+        mockFile = os.path.join(tmpDir, "module.mock")
+        recordFile = os.path.join(tmpDir, "record.mock")
+        def record():
+            if os.path.isfile(mockFile):
+                os.remove(mockFile)
+            runIntercepted(capturemock.RECORD, mockFile, None, rcFile, calls)
+        results.add("python_intercept", "record calls", benchutil.timeBest(record, options.repeats), calls, calls=calls)
+
+        def replay():
+            if os.path.isfile(recordFile):
+                os.remove(recordFile)
+            runIntercepted(capturemock.REPLAY, recordFile, mockFile, rcFile, calls)
+        results.add("python_intercept", "replay calls", benchutil.timeBest(replay, options.repeats), calls, calls=calls)
+    finally:
+        sys.path.remove(tmpDir)
+        benchutil.removeTempDir(tmpDir)
+
+
+if __name__ == "__main__":
+    benchutil.main(run)
@@ -0,0 +1,66 @@
+#!/usr/bin/env python
+""" Reading mock files of different sizes, and looking up requests in them, both those recorded exactly and
+those which have changed a little and need ReplayInfo.findBestMatch to choose the closest recorded one.
+"""
+
+import os, random
+import benchutil
+import capturemock
+from capturemock import config, customtraffic
+from capturemock.replayinfo import ReplayInfo
+
+tools = [ "fetch", "build", "deploy", "query", "render" ]
+
+def makeRequestText(index):
+    # Realistic-looking requests that share many words, which is what makes best matches expensive
+    return tools[index % len(tools)] + " --input /data/run" + str(index // 7) + "/part" + str(index % 97) + \
+        ".dat --level " + str(index % 5) + " --tag batch" + str(index)
+
+def writeMockFile(fileName, entries):
+    with open(fileName, "w") as f:
+        for index in range(entries):
+            f.write("<-CAL:" + makeRequestText(index) + "\n")
+            f.write("->RET:result " + str(index) + "\n")
+
+def makeTraffic(text, rcHandler):
+    return customtraffic.CustomTraffic(text, None, rcHandler)
+
+def run(options, results):
+    tmpDir = benchutil.makeTempDir()
+    rcHandler = config.RcFileHandler([ benchutil.writeRcFile(tmpDir) ])
+    responseClasses = [ customtraffic.CustomResponseTraffic ]
+    randomGenerator = random.Random(42)
+    try:
+        for entries in [ 1000, 10000, 100000 ]:
+            entries = benchutil.scaled(options, entries)
+            mockFile = os.path.join(tmpDir, "entries" + str(entries) + ".mock")
+            writeMockFile(mockFile, entries)
+            replayInfos = []
+            def parse():
+                replayInfos.append(ReplayInfo(capturemock.REPLAY, mockFile, rcHandler))
+            results.add("replay_matching", "read mock file", benchutil.timeBest(parse, options.repeats), entries, entries=entries)
+            replayInfo = replayInfos[-1]
+
+            lookups = benchutil.scaled(options, 10000)
+            exactTraffic = [ makeTraffic(makeRequestText(randomGenerator.randrange(entries)), rcHandler) for _ in range(lookups) ]
+            def lookUpExact():
+                for traffic in exactTraffic:
+                    replayInfo.readReplayResponses(traffic, responseClasses)
+            results.add("replay_matching", "exact lookup", benchutil.timeBest(lookUpExact, options.repeats), lookups,
+                        entries=entries)
+
+            # Every word of these has been seen, but not in this combination
+            fuzzyLookups = benchutil.scaled(options, 100)
+            fuzzyTraffic = [ makeTraffic(makeRequestText(randomGenerator.randrange(entries)).replace("--level", "--verbose --level"), rcHandler)
+                             for _ in range(fuzzyLookups) ]
+            def lookUpFuzzy():
+                for traffic in fuzzyTraffic:
+                    replayInfo.readReplayResponses(traffic, responseClasses)
+            results.add("replay_matching", "best match lookup", benchutil.timeBest(lookUpFuzzy, options.repeats), fuzzyLookups,
+                        entries=entries)
+    finally:
+        benchutil.removeTempDir(tmpDir)
+
+
+if __name__ == "__main__":
+    benchutil.main(run)
@@ -0,0 +1,28 @@
+#!/usr/bin/env python
+""" Runs all the benchmarks, or those named on the command line, and writes their results together as one JSON document.
+"""
+
+import benchutil
+import python_intercept, replay_matching, file_edits, concurrent_commands, intercept_startup
+
+benchmarks = [ ("python_intercept", python_intercept),
+               ("replay_matching", replay_matching),
+               ("file_edits", file_edits),
+               ("concurrent_commands", concurrent_commands),
+               ("intercept_startup", intercept_startup) ]
+
+def main():
+    parser = benchutil.makeOptionParser("usage: %prog [options] [benchmark ...]")
+    options, args = parser.parse_args()
+    names = [ name for name, _ in benchmarks ]
+    for arg in args:
+        if arg not in names:
+            parser.error("unknown benchmark '" + arg + "', choose from " + ", ".join(names))
+    results = benchutil.Results()
+    for name, module in benchmarks:
+        if not args or name in args:
+            module.run(options, results)
+    benchutil.finish(results, options)
+
+if __name__ == "__main__":
+    main()
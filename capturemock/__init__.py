@@ -1,16 +1,20 @@
 from .capturepython import interceptPython
 from .capturecommand import interceptCommand
 from .config import CaptureMockReplayError, RECORD, REPLAY, REPLAY_OLD_RECORD_NEW
-from . import config, cmdlineutils
+from . import config, cmdlineutils, recordfilehandler
 import os, sys, shutil, filecmp, subprocess, tempfile, types
 from functools import wraps
 from glob import glob
 
 class CaptureMockManager:
     fileContents = "import capturemock; capturemock.interceptCommand()\n"
+    lightFileContents = "import sys; sys.path.insert(0, {0})\n" + \
+                        "from capturecommand import interceptCommand; interceptCommand()\n"
     def __init__(self):
         self.serverProcess = None
         self.serverAddress = None
+        self.recordFile = None
+        self.rcHandler = None
 
     def startServer(self,
                     mode,
@@ -27,29 +31,57 @@ class CaptureMockManager:
             environment["CAPTUREMOCK_MODE"] = str(mode)
             rcHandler = config.RcFileHandler(rcFiles)
             commands = rcHandler.getIntercepts("command line")
-            for var in [ "CAPTUREMOCK_PROCESS_START", "CAPTUREMOCK_SERVER" ]:
+            self.recordFile = recordFile
+            self.rcHandler = rcHandler
+            for var in [ "CAPTUREMOCK_PROCESS_START", "CAPTUREMOCK_SERVER", "CAPTUREMOCK_ENVIRONMENT" ]:
                 if var in environment:
                     del environment[var]
 
             from . import server
-            self.serverProcess = server.startServer(rcFiles,
-                                                    mode,
-                                                    replayFile,
-                                                    replayEditDir,
-                                                    recordFile,
-                                                    recordEditDir,
-                                                    sutDirectory,
-                                                    environment)
-            self.serverAddress = self.serverProcess.stdout.readline().strip()
+            daemonAddress = environment.get("CAPTUREMOCK_DAEMON")
+            if daemonAddress:
+                # Much quicker than starting a server process of our own
+                self.serverAddress = server.openSession(daemonAddress,
+                                                        rcFiles,
+                                                        mode,
+                                                        replayFile,
+                                                        replayEditDir,
+                                                        recordFile,
+                                                        recordEditDir,
+                                                        sutDirectory,
+                                                        environment)
+            else:
+                self.serverProcess = server.startServer(rcFiles,
+                                                        mode,
+                                                        replayFile,
+                                                        replayEditDir,
+                                                        recordFile,
+                                                        recordEditDir,
+                                                        sutDirectory,
+                                                        environment)
+                self.serverAddress = self.serverProcess.stdout.readline().strip()
 
             # And environment it shouldn't get...
             environment["CAPTUREMOCK_SERVER"] = self.serverAddress
             if self.makePathIntercepts(commands, interceptDir, replayFile, mode):
+                # Before PATH is changed, as the intercepted commands remove themselves from it
+                self.writeEnvironmentBaseline(interceptDir, environment)
                 environment["PATH"] = interceptDir + os.pathsep + environment.get("PATH", "")
             return True
         else:
             return False
 
+    def writeEnvironmentBaseline(self, interceptDir, environment):
+        # Intercepted commands only send how their environment differs from this
+        baselineFile = os.path.join(interceptDir, ".capturemock_environment")
+        environment["CAPTUREMOCK_ENVIRONMENT"] = baselineFile
+        try:
+            with open(baselineFile, "w") as f:
+                f.write("\0".join(name + "=" + value for name, value in environment.items()))
+        except (EnvironmentError, UnicodeError):
+            # They will send all of it instead
+            del environment["CAPTUREMOCK_ENVIRONMENT"]
+
     def makeWindowsIntercept(self, interceptName):
         destFile = interceptName + ".exe"
         if sys.version_info.major == 3: # python 3, uses pyinstaller
@@ -66,8 +98,14 @@ class CaptureMockManager:
 
     def makePosixIntercept(self, interceptName):
         file = open(interceptName, "w")
-        file.write("#!" + sys.executable + "\n")
-        file.write(self.fileContents)
+        if getattr(sys, 'frozen', False):
+            file.write("#!" + sys.executable + "\n")
+            file.write(self.fileContents)
+        else:
+            # Intercepted commands may be called very often, so keep their startup to a minimum:
+            # no site module, no PYTHON* variables from the system under test, and only the client module imported
+            file.write("#!" + sys.executable + " -SE\n")
+            file.write(self.lightFileContents.format(repr(os.path.dirname(os.path.abspath(__file__)))))
         file.close()
         os.chmod(interceptName, 0o775) # make executable
 
@@ -100,12 +138,23 @@ class CaptureMockManager:
         return len(commands) > 0
 
     def terminate(self):
+        if self.serverAddress:
+            from .server import stopServer
+            stopServer(self.serverAddress)
+            self.serverAddress = None
         if self.serverProcess:
-            if self.serverAddress:
-                from .server import stopServer
-                stopServer(self.serverAddress)
             self.writeServerErrors()
             self.serverProcess = None
+        if self.rcHandler:
+            # Everything has stopped writing to the record file by now
+            recordfilehandler.compactRecordFile(self.recordFile, self.rcHandler)
+            self.rcHandler = None
+
+    def getStatistics(self):
+        """ Timings of the server's traffic so far, as JSON text, if it was told to collect them """
+        if self.serverAddress:
+            from .server import queryStatistics
+            return queryStatistics(self.serverAddress)
 
     def writeServerErrors(self):
         err = self.serverProcess.communicate()[1]
@@ -143,6 +192,24 @@ def process_startup():
         interceptPython(mode, recordFile, replayFile, rcFiles, pythonAttrs)
 
 
+def startDaemon(rcFiles=[], environment=os.environ):
+    """ Start a server daemon which all later calls to setUpServer with this environment will use """
+    from . import server
+    daemonProcess = server.startDaemon(rcFiles, environment)
+    environment["CAPTUREMOCK_DAEMON"] = daemonProcess.stdout.readline().strip()
+    return daemonProcess
+
+
+def stopDaemon(daemonProcess, environment=os.environ):
+    daemonAddress = environment.pop("CAPTUREMOCK_DAEMON", None)
+    if daemonAddress:
+        from .server import stopServer
+        stopServer(daemonAddress)
+    err = daemonProcess.communicate()[1]
+    if err:
+        sys.stderr.write("Error from CaptureMock Daemon :\n" + err)
+
+
 manager = None
 def setUpServer(*args, **kw):
     global manager
@@ -226,6 +293,10 @@ class CaptureMockDecorator(object):
                 setUpPython(self.mode, recordFile, replayFile, self.rcFiles, self.pythonAttrs)
                 interceptor = interceptPython(self.mode, recordFile, replayFile, self.rcFiles, self.pythonAttrs)
                 result = func(*funcargs, **funckw)
+                # Make sure the record file is complete before we look at it
+                interceptor.resetIntercepts()
+                interceptor = None
+                recordfilehandler.compactRecordFile(recordFile, config.RcFileHandler(self.rcFiles))
                 if self.mode == config.REPLAY:
                     self.checkMatching(recordFile, replayFile)
                 elif os.path.isfile(recordFile):
@@ -242,8 +313,8 @@ class CaptureMockDecorator(object):
     def fileContentsEqual(self, fn1, fn2):
         bufsize = 8*1024
         # copied from filecmp.py, adding universal line ending support
-        fp1 = open(fn1, "rU")
-        fp2 = open(fn2, "rU")
+        fp1 = open(fn1, config.READ_MODE)
+        fp2 = open(fn2, config.READ_MODE)
         while True:
             b1 = fp1.read(bufsize)
             b2 = fp2.read(bufsize)
@@ -0,0 +1,225 @@
+""" Traffic server based on asyncio, instead of starting a new thread for every request """
+
+import asyncio, os, shutil, threading
+from concurrent.futures import ThreadPoolExecutor, Future
+from capturemock import config, clientservertraffic, commandlinetraffic, framing
+
+class ResponseFile:
+    """ Lets traffic being processed in a request thread write its response to the connection,
+    and run the real commands it stands for on the event loop """
+    def __init__(self, loop, writer):
+        self.loop = loop
+        self.writer = writer
+        self.connected = True
+
+    def inLoopThread(self):
+        try:
+            return asyncio.get_running_loop() is self.loop
+        except RuntimeError:
+            return False
+
+    def write(self, data):
+        if self.inLoopThread():
+            # Only small things are handled on the loop itself, and it can't wait for itself
+            self.writer.write(data)
+        else:
+            # Wait until the client has taken it, so a slow client slows the command down rather than filling our memory
+            asyncio.run_coroutine_threadsafe(self.writeAndDrain(data), self.loop).result()
+
+    async def writeAndDrain(self, data):
+        self.writer.write(data)
+        await self.writer.drain()
+
+    def close(self):
+        pass # the connection is closed when the request is complete
+
+    def runCommand(self, traffic, streaming):
+        # The event loop looks after the process and its pipes, the request thread just waits for the result
+        return asyncio.run_coroutine_threadsafe(self.runCommandAsync(traffic, streaming), self.loop).result()
+
+    async def runCommandAsync(self, traffic, streaming):
+        proc = await asyncio.create_subprocess_exec(*traffic.cmdArgs, env=traffic.cmdEnviron, cwd=traffic.cmdCwd,
+                                                    stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE)
+        commandlinetraffic.CommandLineKillTraffic.pidMap[traffic.proxyPid] = proc
+        try:
+            if streaming:
+                writeLock = asyncio.Lock()
+                output, errors = await asyncio.gather(self.relayStream(traffic, proc.stdout, commandlinetraffic.StdoutTraffic, writeLock),
+                                                      self.relayStream(traffic, proc.stderr, commandlinetraffic.StderrTraffic, writeLock))
+            else:
+                outData, errData = await proc.communicate()
+                output = traffic.makeDecoder().decode(outData, final=True)
+                errors = traffic.makeDecoder().decode(errData, final=True)
+            await proc.wait()
+        finally:
+            commandlinetraffic.CommandLineKillTraffic.pidMap.pop(traffic.proxyPid, None)
+        return output, errors, proc.returncode
+
+    async def relayStream(self, traffic, stream, trafficClass, writeLock):
+        # As CommandLineTraffic.relayStream, without needing threads of its own
+        decoder = traffic.makeDecoder("replace")
+        pieces = []
+        while True:
+            data = await stream.read(65536)
+            text = decoder.decode(data, final=not data)
+            if text:
+                pieces.append(text)
+                async with writeLock: # frames from the two streams mustn't get mixed up
+                    await self.writeFieldAsync(trafficClass.typeId.encode(), text.encode())
+            if not data:
+                break
+        return "".join(pieces)
+
+    async def writeFieldAsync(self, frameType, data):
+        # If the system under test has gone, keep reading the output anyway so it can be recorded
+        if self.connected:
+            try:
+                framing.writeField(self.writer.write, frameType, data)
+                await self.writer.drain()
+            except ConnectionError:
+                self.connected = False
+
+
+class FramedResponseFile(framing.FramedResponseFile):
+    def runCommand(self, traffic, streaming):
+        return self.wfile.runCommand(traffic, streaming)
+
+
+class AsyncioTrafficServer:
+    def __init__(self, address, dispatcher, useThreads):
+        self.dispatcher = dispatcher
+        self.requestCount = 0
+        self.connectionTasks = set()
+        self.loop = asyncio.new_event_loop()
+        # Traffic processing is blocking, so each request gets a thread of its own, as with the classic server:
+        # a fixed pool would hold up requests behind long-running commands, or deadlock pipelines of them.
+        # A single worker means requests are processed one at a time, as if not multithreaded
+        self.executor = None if useThreads else ThreadPoolExecutor(max_workers=1)
+        self.terminate = None
+        self.address = address
+        if isinstance(address, tuple):
+            host, port = address
+            serverCoroutine = asyncio.start_server(self.handleConnection, host, port, backlog=500)
+        else:
+            serverCoroutine = asyncio.start_unix_server(self.handleConnection, address, backlog=500)
+        self.server = self.loop.run_until_complete(serverCoroutine)
+
+    @staticmethod
+    def getTrafficClasses(incoming):
+        if incoming:
+            return [ clientservertraffic.ServerStateTraffic, clientservertraffic.ClientSocketTraffic ]
+        else:
+            return [ clientservertraffic.ServerTraffic, clientservertraffic.ClientSocketTraffic ]
+
+    def getAddress(self):
+        if isinstance(self.address, tuple):
+            host, port = self.server.sockets[0].getsockname()[:2]
+            return host + ":" + str(port)
+        else:
+            return self.address
+
+    def run(self):
+        self.loop.run_until_complete(self.serve())
+        if self.executor:
+            self.executor.shutdown()
+        self.loop.close()
+        if not isinstance(self.address, tuple):
+            shutil.rmtree(os.path.dirname(self.address), ignore_errors=True)
+
+    async def serve(self):
+        self.terminate = asyncio.Event()
+        await self.terminate.wait()
+        self.server.close()
+        await self.server.wait_closed()
+        # Let remaining requests finish before the interpreter starts to shut down
+        if self.connectionTasks:
+            await asyncio.wait(list(self.connectionTasks))
+
+    def shutdown(self):
+        # Called from a worker thread
+        self.loop.call_soon_threadsafe(self.terminate.set)
+
+    async def handleConnection(self, reader, writer):
+        # Numbered on accepting, so we know what order things should go in the record file
+        self.requestCount += 1
+        requestNumber = self.requestCount
+        task = asyncio.current_task()
+        self.connectionTasks.add(task)
+        try:
+            try:
+                start = await reader.readexactly(len(framing.MAGIC))
+            except asyncio.IncompleteReadError as e:
+                start = e.partial
+            if start == framing.MAGIC:
+                await self.handleFramedRequests(reader, writer, requestNumber)
+            else:
+                text = (start + await reader.read()).decode()
+                responseFile = ResponseFile(self.loop, writer)
+                await self.runRequest(self.processText, text, responseFile, requestNumber)
+        except ConnectionError:
+            pass # The system under test has died or is otherwise unresponsive
+        finally:
+            writer.close()
+            self.connectionTasks.discard(task)
+
+    async def handleFramedRequests(self, reader, writer, requestNumber):
+        request = await self.readRequest(reader)
+        while request is not None:
+            responseFile = FramedResponseFile(ResponseFile(self.loop, writer))
+            await self.runRequest(self.processFramedRequest, request.decode(), responseFile, requestNumber)
+            request = await self.readRequest(reader)
+            if request is not None:
+                self.requestCount += 1
+                requestNumber = self.requestCount
+
+    def runRequest(self, method, text, responseFile, requestNumber):
+        if text.startswith(commandlinetraffic.CommandLineKillTraffic.socketId):
+            # Quick, and mustn't wait behind the commands it's trying to kill
+            method(text, responseFile, requestNumber)
+            future = self.loop.create_future()
+            future.set_result(None)
+            return future
+        elif self.executor:
+            return self.loop.run_in_executor(self.executor, method, text, responseFile, requestNumber)
+        else:
+            return asyncio.wrap_future(self.startRequestThread(method, text, responseFile, requestNumber), loop=self.loop)
+
+    @staticmethod
+    def startRequestThread(method, *args):
+        future = Future()
+        def run():
+            if future.set_running_or_notify_cancel():
+                try:
+                    future.set_result(method(*args))
+                except BaseException as e:
+                    future.set_exception(e)
+        threading.Thread(target=run, name="request").start()
+        return future
+
+    @staticmethod
+    async def readRequest(reader):
+        # As framing.readRequest, but without blocking the event loop
+        chunks = []
+        while True:
+            try:
+                frameType, size = framing.header.unpack(await reader.readexactly(framing.header.size))
+                data = await reader.readexactly(size)
+            except asyncio.IncompleteReadError:
+                return
+            if frameType == framing.REQ:
+                chunks.append(data)
+            elif frameType == framing.END:
+                return b"".join(chunks)
+            else:
+                return
+
+    def processFramedRequest(self, text, responseFile, requestNumber):
+        self.processText(text, responseFile, requestNumber)
+        responseFile.close()
+
+    def processText(self, text, responseFile, requestNumber):
+        self.dispatcher.diag.debug("Received incoming request...")
+        try:
+            self.dispatcher.processText(text, responseFile, requestNumber)
+        except config.CaptureMockReplayError as e:
+            responseFile.write(("CAPTUREMOCK MISMATCH: " + str(e)).encode())
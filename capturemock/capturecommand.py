@@ -1,33 +1,66 @@
-import signal, os
+import os
+# We are run for every intercepted command, so import as little as possible.
+# The C modules are much quicker to import than their Python wrappers
+try:
+    import _signal as signal
+except ImportError: # Python 2, signal is the C module
+    import signal
+try:
+    from . import framing
+except (ImportError, ValueError, SystemError): # run from an intercept script, outside the package
+    import framing
 
 gotSignal, sentInfo = 0, False
+# Marks an environment sent as differences from a baseline file, rather than the whole thing
+environmentDeltaId = "SUT_ENVIRONMENT_DELTA:"
 
-def makeSocket():
-    import socket
+def makeSocket(family):
     try:
-        return socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        import _socket as socket
+    except ImportError:
+        import socket
+    try:
+        return socket.socket(getattr(socket, family), socket.SOCK_STREAM)
     except AttributeError: # in case we get interrupted partway through
         try:
             import importlib
             importlib.reload(socket)
         except:
             reload(socket)
-        return socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        return socket.socket(getattr(socket, family), socket.SOCK_STREAM)
 
-def createSocket():
+def getServerAddress():
     servAddr = os.environ["CAPTUREMOCK_SERVER"]
     if not servAddr:
         raise RuntimeError("CAPTUREMOCK_SERVER empty.")
-    host, port = servAddr.split(":")
-    serverAddress = (host, int(port))
-    sock = makeSocket()
-    sock.connect(serverAddress)
+    # A server daemon gives each session an address of the form host:port#session
+    return servAddr.split("#", 1) if "#" in servAddr else (servAddr, None)
+
+def createSocket():
+    servAddr, _ = getServerAddress()
+    if servAddr.startswith("/"): # Unix domain socket, identified by its path
+        sock = makeSocket("AF_UNIX")
+        sock.connect(servAddr)
+    else:
+        host, port = servAddr.split(":")
+        sock = makeSocket("AF_INET")
+        sock.connect((host, int(port)))
     return sock
 
+def sendText(sock, text, framed=False):
+    _, sessionId = getServerAddress()
+    if sessionId:
+        text = "SUT_SESSION:" + sessionId + ":SUT_SEP:" + text
+    if framed:
+        sock.sendall(framing.MAGIC)
+        framing.sendRequest(sock.sendall, text.encode())
+    else:
+        sock.sendall(text.encode())
+
 def sendKill():
     sock = createSocket()
     text = "SUT_COMMAND_KILL:" + str(gotSignal) + ":SUT_SEP:" + str(os.getpid())
-    sock.sendall(text.encode())
+    sendText(sock, text)
     sock.close()
 
 def handleKill(sigNum, *args):
@@ -36,12 +69,38 @@ def handleKill(sigNum, *args):
     if sentInfo:
         sendKill()
 
-def readFromSocket(sock):
-    from socket import error
-    try:
-        return sock.makefile().read()
-    except error: # If we're interrupted, try again
-        return sock.makefile().read()
+def makeReader(sock):
+    def read(size):
+        try:
+            return sock.recv(size)
+        except EnvironmentError: # If we're interrupted, try again
+            return sock.recv(size)
+    return read
+
+def getOutputFile(stream):
+    # The text is passed on as we received it, Python 2 doesn't distinguish
+    return getattr(stream, "buffer", stream)
+
+def readResponse(sock):
+    """ Writes the command's output as it arrives. Returns its exit status, or None if something else was sent """
+    import sys
+    outputFiles = { framing.OUT : getOutputFile(sys.stdout), framing.ERR : getOutputFile(sys.stderr) }
+    read = makeReader(sock)
+    exitStr, messages = None, []
+    frameType, data = framing.readFrame(read)
+    while frameType is not None and frameType != framing.END:
+        outputFile = outputFiles.get(frameType)
+        if outputFile is not None:
+            if os.name == "nt": # what writing text would have done
+                data = data.replace(b"\n", b"\r\n")
+            outputFile.write(data)
+            outputFile.flush()
+        elif frameType == framing.EXC:
+            exitStr = data.decode()
+        else:
+            messages.append(data)
+        frameType, data = framing.readFrame(read)
+    return exitStr, b"".join(messages).decode()
 
 def getCommandLine(argv):
     if os.name == "posix":
@@ -60,13 +119,31 @@ def getEnvironmentDict(argv):
     os.environ["PATH"] = os.pathsep.join(filteredPathElems)
     return dict(os.environ)
 
+def getEnvironmentText(environ):
+    # Sending only what differs from the baseline written when the server started is much less to send and parse:
+    # entries are NAME=VALUE for what's new or changed and NAME for what's been unset, separated by null characters
+    baselineFile = environ.get("CAPTUREMOCK_ENVIRONMENT")
+    if baselineFile:
+        try:
+            with open(baselineFile) as f:
+                baseline = set(f.read().split("\0"))
+        except EnvironmentError:
+            return repr(environ)
+        current = set(name + "=" + value for name, value in environ.items())
+        # Windows has names like "=C:", so start looking for the separator after the first character
+        removedNames = [ entry[:entry.find("=", 1)] for entry in baseline - current if entry ]
+        entries = list(current - baseline) + [ name for name in removedNames if name not in environ ]
+        return environmentDeltaId + "\0".join([ baselineFile ] + entries)
+    else:
+        return repr(environ)
+
 def createAndSend():
     from sys import argv
     sock = createSocket()
     text = "SUT_COMMAND_LINE:" + repr(getCommandLine(argv)) + ":SUT_SEP:" + \
-        repr(getEnvironmentDict(argv)) + \
+        getEnvironmentText(getEnvironmentDict(argv)) + \
            ":SUT_SEP:" + os.getcwd() + ":SUT_SEP:" + str(os.getpid())
-    sock.sendall(text.encode())
+    sendText(sock, text, framed=True)
     return sock
 
 def infoSent():
@@ -83,34 +160,10 @@ def interceptCommand():
     sock = createAndSend()
     sock.shutdown(1)
     infoSent()
-    response = readFromSocket(sock)
+    exitStr, response = readResponse(sock)
     sock.close()
-    try:
-        stdout, stderr, exitStr = response.split("|TT_CMD_SEP|")
-        import sys
-        sys.stdout.write(stdout)
-        sys.stdout.flush()
-        sys.stderr.write(stderr)
-        sys.stderr.flush()
-        exitCode = int(exitStr)
-        if exitCode < 0 or (exitCode > 128 and exitCode <= 160):
-            # process was killed (on UNIX...)
-            # We use the conventions of negative exit code, or 128 + killed signal for this
-            # We should hang if we haven't been killed ourselves (though we might be replaying on Windows anyway)
-            if os.name == "posix":
-                signal.signal(signal.SIGINT, signal.SIG_DFL)
-                signal.signal(signal.SIGTERM, signal.SIG_DFL)
-                if gotSignal:
-                    os.kill(os.getpid(), gotSignal)
-                else:
-                    signal.pause()
-            else:
-                import time
-                time.sleep(10000) # The best we can do on Windows where waiting for signals is concerned :)
-        else:
-            sys.exit(exitCode)
-    except ValueError:
-        import sys
+    import sys
+    if exitStr is None:
         if response.startswith("CAPTUREMOCK MISMATCH"):
             sys.stderr.write("Replayed calls do not match those recorded.\n" +
                              response.split(":", 1)[-1].strip() + "\n" +
@@ -119,3 +172,22 @@ def interceptCommand():
             sys.exit(1)
         else:
             sys.stderr.write("Received unexpected communication from MIM server:\n '" + response + "'\n\n")
+        return
+
+    exitCode = int(exitStr)
+    if exitCode < 0 or (exitCode > 128 and exitCode <= 160):
+        # process was killed (on UNIX...)
+        # We use the conventions of negative exit code, or 128 + killed signal for this
+        # We should hang if we haven't been killed ourselves (though we might be replaying on Windows anyway)
+        if os.name == "posix":
+            signal.signal(signal.SIGINT, signal.SIG_DFL)
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            if gotSignal:
+                os.kill(os.getpid(), gotSignal)
+            else:
+                signal.pause()
+        else:
+            import time
+            time.sleep(10000) # The best we can do on Windows where waiting for signals is concerned :)
+    else:
+        sys.exit(exitCode)
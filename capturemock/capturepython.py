@@ -1,21 +1,49 @@
 
 """ Generic front end module to all forms of Python interception"""
 
-import sys, os, logging, inspect, types
+import sys, os, logging, inspect, types, threading
 from distutils.sysconfig import get_python_lib
 from . import pythonclient, config
 
-class CallStackChecker:
+class CallStackState(object):
+    # Where we are in intercepted code, or in a callback
+    excludeLevel = 0
+    inCallback = False
+
+
+class ThreadCallStackState(threading.local, CallStackState):
+    # When calls can be made concurrently, each thread can be at a different place
+    pass
+
+
+class CallStackChecker(object):
     def __init__(self, rcHandler):
         # Always ignore our own command-line capture module
         # TODO - ignore_callers list should be able to vary between different calls
         self.ignoreModuleCalls = set([ "capturecommand" ] + rcHandler.getList("ignore_callers", [ "python" ]))
-        self.excludeLevel = 0
-        self.inCallback = False
+        concurrent = rcHandler.getboolean("concurrent_calls", [ "python" ], False)
+        self.state = ThreadCallStackState() if concurrent else CallStackState()
         self.logger = logging.getLogger("Call Stack Checker")
         self.stdlibDirs = self.findStandardLibDirs()
-        self.logger.debug("Found stdlib directories at " + repr(self.stdlibDirs))
-        self.logger.debug("Ignoring calls from " + repr(self.ignoreModuleCalls))
+        self.fileVerdicts = {}
+        self.logger.debug("Found stdlib directories at %r", self.stdlibDirs)
+        self.logger.debug("Ignoring calls from %r", self.ignoreModuleCalls)
+
+    @property
+    def excludeLevel(self):
+        return self.state.excludeLevel
+
+    @excludeLevel.setter
+    def excludeLevel(self, value):
+        self.state.excludeLevel = value
+
+    @property
+    def inCallback(self):
+        return self.state.inCallback
+
+    @inCallback.setter
+    def inCallback(self, value):
+        self.state.inCallback = value
 
     def callNoInterception(self, callback, method, *args, **kw):
         delta = -1 if callback else 1
@@ -41,15 +69,30 @@ class CallStackChecker:
             return True
 
         # Don't intercept if we've been called from within the standard library
-        self.excludeLevel += 1
-        
-        framerecord = inspect.stack()[stackDistance]
-        fileName = framerecord[1]
+        # The answer only depends on the calling file, so we only work it out once per file
+        fileName = self.getCallerFileName(stackDistance)
+        verdict = self.fileVerdicts.get(fileName)
+        if verdict is None:
+            self.excludeLevel += 1
+            try:
+                verdict = self.fileExcluded(fileName)
+            finally:
+                self.excludeLevel -= 1
+            self.fileVerdicts[fileName] = verdict
+        return verdict
+
+    def getCallerFileName(self, stackDistance):
+        # inspect.stack() builds info for every frame and reads source code from disk, far too slow here
+        if hasattr(sys, "_getframe"):
+            return sys._getframe(stackDistance + 1).f_code.co_filename
+        else:
+            return inspect.stack()[stackDistance + 1][1]
+
+    def fileExcluded(self, fileName):
         dirName = self.getDirectory(fileName)
         moduleName = self.getModuleName(fileName)
         moduleNames = set([ moduleName, os.path.basename(dirName) ])
-        self.logger.debug("Checking call from " + dirName + ", modules " + repr(moduleNames))
-        self.excludeLevel -= 1
+        self.logger.debug("Checking call from %s, modules %r", dirName, moduleNames)
         return dirName in self.stdlibDirs or len(moduleNames.intersection(self.ignoreModuleCalls)) > 0
 
     def getModuleName(self, fileName):
@@ -241,6 +284,7 @@ class InterceptHandler:
         from . import replayinfo
         self.replayInfo = replayinfo.ReplayInfo(mode, replayFile, self.rcHandler)
         self.recordFile = recordFile
+        self.trafficHandler = None
         self.allAttrNames = self.findAttributeNames(mode, pythonAttrs)
 
     def findAttributeNames(self, mode, pythonAttrs):
@@ -275,6 +319,7 @@ class InterceptHandler:
         from .pythontraffic import PythonTrafficHandler
         trafficHandler = PythonTrafficHandler(self.replayInfo, self.recordFile, self.rcHandler,
                                               callStackChecker, self.allAttrNames)
+        self.trafficHandler = trafficHandler
         if len(fullIntercepts):
             import_handler = ImportHandler(fullIntercepts, callStackChecker, trafficHandler)
             if import_handler not in sys.meta_path:
@@ -339,3 +384,6 @@ class InterceptHandler:
                 item.reset()
         for realObj, attrName, origValue in self.attributesIntercepted:
             setattr(realObj, attrName, origValue)
+        if self.trafficHandler:
+            # Make sure anything buffered is in the record file before anyone looks at it
+            self.trafficHandler.recordFileHandler.close()
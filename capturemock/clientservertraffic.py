@@ -2,6 +2,7 @@
 
 import socket, sys
 from capturemock import traffic
+from capturemock.evalcache import evalCache
 
 try:
     import xmlrpclib
@@ -54,7 +55,7 @@ class XmlRpcClientTraffic(ClientSocketTraffic):
             paramText = self.applyAlterationVariables(paramText)
             if "," not in paramText and paramText != "()":
                 paramText = paramText[:-1] + ",)" # make proper tuple output
-            self.params = eval(paramText)
+            self.params = evalCache.evaluate(paramText, globals())
 
     def forwardToServer(self):
         try:
@@ -84,7 +85,7 @@ class XmlRpcServerTraffic(ServerTraffic):
             raiseException = text.startswith("raise ")
             if raiseException:
                 text = text[6:]
-            self.responseObject = eval(text)
+            self.responseObject = evalCache.evaluate(text, globals())
         ServerTraffic.__init__(self, text, None, rcHandler)
 
     def getXmlRpcResponse(self):
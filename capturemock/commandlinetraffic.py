@@ -1,37 +1,77 @@
 """ Traffic classes to do with captured command lines """
 
-import os, logging, subprocess
+import os, logging, subprocess, threading, io, codecs
 import sys
+from locale import getpreferredencoding
 from capturemock import traffic, fileedittraffic
+from capturemock.capturecommand import environmentDeltaId
 
 
 class CommandLineTraffic(traffic.Traffic):
     typeId = "CMD"
     socketId = "SUT_COMMAND_LINE"
     direction = "<-"
+    # What the command's environment and working directory are compared with
+    serverEnvironment = os.environ
+    serverDirectory = None
+    # Environments that intercepted commands send differences from, keyed on file and when it was written
+    environmentBaselines = {}
     def __init__(self, inText, responseFile, rcHandler):
         self.diag = logging.getLogger("Server")
         cmdText, environText, cmdCwd, proxyPid = inText.split(":SUT_SEP:")
         argv = eval(cmdText)
-        self.cmdEnviron = eval(environText)
+        self.cmdEnviron = self.parseEnvironment(environText)
         self.cmdCwd = cmdCwd
         self.proxyPid = proxyPid
-        self.diag.debug("Received command with cwd = " + cmdCwd)
+        self.diag.debug("Received command with cwd = %s", cmdCwd)
         self.fullCommand = argv[0].replace("\\", "/")
         self.commandName = os.path.basename(self.fullCommand)
         self.cmdArgs = [ self.commandName ] + argv[1:]
         self.asynchronousEdits = rcHandler.getboolean("asynchronous", self.getRcSections(), False)
+        self.streamOutput = rcHandler.getboolean("stream_output", self.getRcSections(), False)
         self.envVarsSet, envVarsUnset = self.filterEnvironment(self.cmdEnviron, rcHandler)
         cmdString = " ".join(map(self.quoteArg, self.cmdArgs))
         text = self.getEnvString(self.envVarsSet, envVarsUnset) + cmdString
         super(CommandLineTraffic, self).__init__(text, responseFile, rcHandler)
 
+    @classmethod
+    def parseEnvironment(cls, environText):
+        if not environText.startswith(environmentDeltaId):
+            return eval(environText)
+
+        entries = environText[len(environmentDeltaId):].split("\0")
+        environ = cls.getEnvironmentBaseline(entries[0]).copy()
+        for entry in entries[1:]:
+            pos = entry.find("=", 1)
+            if pos == -1:
+                environ.pop(entry, None)
+            else:
+                environ[entry[:pos]] = entry[pos + 1:]
+        return environ
+
+    @classmethod
+    def getEnvironmentBaseline(cls, baselineFile):
+        stat = os.stat(baselineFile)
+        key = baselineFile, stat.st_mtime, stat.st_size
+        baseline = cls.environmentBaselines.get(key)
+        if baseline is None:
+            with open(baselineFile) as f:
+                entries = f.read().split("\0")
+            baseline = dict((entry[:entry.find("=", 1)], entry[entry.find("=", 1) + 1:]) for entry in entries if entry)
+            cls.environmentBaselines[key] = baseline
+        return baseline
+
+    @classmethod
+    def makeSessionClass(cls, environment, directory):
+        # Sessions of a server daemon compare with their own environment rather than the daemon's
+        return type(cls.__name__, (cls,), { "serverEnvironment" : environment, "serverDirectory" : directory })
+
     def filterEnvironment(self, cmdEnviron, rcHandler):
         envVarsSet, envVarsUnset = [], []
         for var in self.getEnvironmentVariables(rcHandler):
             value = cmdEnviron.get(var)
-            currValue = os.getenv(var)
-            self.diag.debug("Checking environment " + var + "=" + repr(value) + " against " + repr(currValue))
+            currValue = self.serverEnvironment.get(var)
+            self.diag.debug("Checking environment %s=%r against %r", var, value, currValue)
             if value != currValue:
                 if value is None:
                     envVarsUnset.append(var)
@@ -51,7 +91,7 @@ class CommandLineTraffic(traffic.Traffic):
         return rcHandler.getList("environment", self.getRcSections())
 
     def hasChangedWorkingDirectory(self):
-        return self.cmdCwd != os.getcwd()
+        return self.cmdCwd != (self.serverDirectory or os.getcwd())
 
     def quoteArg(self, arg):
         if " " in arg:
@@ -86,11 +126,11 @@ class CommandLineTraffic(traffic.Traffic):
         return newPre, newPost
     
     def getEnvValueString(self, var, value):
-        oldVal = os.getenv(var)
+        oldVal = self.serverEnvironment.get(var)
         if oldVal and oldVal != value:
             if "PATH" not in var:
                 compactValue = value.replace(oldVal, "$" + var)
-                self.diag.debug("Compacted value to " + repr(compactValue))
+                self.diag.debug("Compacted value to %r", compactValue)
                 return compactValue
         
             newPre, newPost = self.getNewElements(value, oldVal)
@@ -102,7 +142,7 @@ class CommandLineTraffic(traffic.Traffic):
                     newValue += ":" + ":".join(newPost)
                 return newValue
             else:
-                self.diag.debug("Added text " + repr(value) + " already present, assuming not changed in essence")
+                self.diag.debug("Added text %r already present, assuming not changed in essence", value)
             
             # Don't react if something is adding the same element to a path multiple times, for example
             # GTK+ on Windows adds a new copy of itself for every Python process started
@@ -114,24 +154,24 @@ class CommandLineTraffic(traffic.Traffic):
         changedCwd = self.hasChangedWorkingDirectory()
         if changedCwd:
             edits.append(self.cmdCwd)
-            self.diag.debug("Adding cwd " + repr(self.cmdCwd))
+            self.diag.debug("Adding cwd %r", self.cmdCwd)
         for _, value in self.envVarsSet:
             for word in value.split():
                 if os.pathsep not in word and os.path.isabs(word):
-                    self.diag.debug("Adding environment path " + repr(word))
+                    self.diag.debug("Adding environment path %r", word)
                     edits.append(word)
         for arg in self.cmdArgs[1:]:
             for word in self.getFileWordsFromArg(arg):
                 if os.path.isabs(word):
-                    self.diag.debug("Adding absolute path argument " + repr(word))
+                    self.diag.debug("Adding absolute path argument %r", word)
                     edits.append(word)
                 elif not changedCwd:
                     fullPath = os.path.join(self.cmdCwd, word)
                     if os.path.exists(fullPath):
-                        self.diag.debug("Adding relative path argument " + repr(word))
+                        self.diag.debug("Adding relative path argument %r", word)
                         edits.append(fullPath)
         self.removeSubPaths(edits) # don't want to in effect mark the same file twice
-        self.diag.debug("Might edit in " + repr(edits))
+        self.diag.debug("Might edit in %r", edits)
         return edits
 
     def makesAsynchronousEdits(self):
@@ -160,20 +200,68 @@ class CommandLineTraffic(traffic.Traffic):
             return arg.split()
 
     def forwardToDestination(self):
+        # Only framed connections can take the output in pieces
+        streaming = self.streamOutput and hasattr(self.responseFile, "writeField")
+        # Servers with their own way of running processes provide it along with the response file
+        runCommand = getattr(self.responseFile, "runCommand", self.runCommand)
         try:
-            self.diag.debug("Running real command with args : " + repr(self.cmdArgs))
-            proc = subprocess.Popen(self.cmdArgs, env=self.cmdEnviron, cwd=self.cmdCwd, 
-                                    stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True)
-            CommandLineKillTraffic.pidMap[self.proxyPid] = proc
-            output, errors = proc.communicate()
-            response = self.makeResponse(output, errors, proc.returncode)
-            del CommandLineKillTraffic.pidMap[self.proxyPid]
-            return response
+            self.diag.debug("Running real command with args : %r", self.cmdArgs)
+            output, errors, exitCode = runCommand(self, streaming)
         except OSError:
             return self.makeResponse("", "ERROR: CaptureMock Server could not find command '" + self.commandName + "' in PATH\n", 1)
+        return self.makeResponse(output, errors, exitCode, relayed=streaming)
 
-    def makeResponse(self, output, errors, exitCode):
-        return [ StdoutTraffic(output, self.responseFile), StderrTraffic(errors, self.responseFile), \
+    @staticmethod
+    def runCommand(traffic, streaming):
+        proc = subprocess.Popen(traffic.cmdArgs, env=traffic.cmdEnviron, cwd=traffic.cmdCwd,
+                                stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=not streaming)
+        CommandLineKillTraffic.pidMap[traffic.proxyPid] = proc
+        try:
+            if streaming:
+                output, errors = traffic.relayOutput(proc)
+            else:
+                output, errors = proc.communicate()
+        finally:
+            CommandLineKillTraffic.pidMap.pop(traffic.proxyPid, None)
+        return output, errors, proc.returncode
+
+    @staticmethod
+    def makeDecoder(errors="strict"):
+        # Decodes as universal_newlines would, but can be given the output a piece at a time
+        return io.IncrementalNewlineDecoder(codecs.getincrementaldecoder(getpreferredencoding(False))(errors), True)
+
+    def relayOutput(self, proc):
+        # Send the output on as it arrives, while keeping all of it to record
+        texts = {}
+        writeLock = threading.Lock()
+        threads = [ threading.Thread(target=self.relayStream, args=(proc.stdout, StdoutTraffic.typeId, texts, writeLock)),
+                    threading.Thread(target=self.relayStream, args=(proc.stderr, StderrTraffic.typeId, texts, writeLock)) ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        proc.wait()
+        return texts[StdoutTraffic.typeId], texts[StderrTraffic.typeId]
+
+    def relayStream(self, stream, typeId, texts, writeLock):
+        decoder = self.makeDecoder("replace")
+        pieces = []
+        while True:
+            data = os.read(stream.fileno(), 65536)
+            text = decoder.decode(data, final=not data)
+            if text:
+                pieces.append(text)
+                with writeLock: # frames from the two streams mustn't get mixed up
+                    self.sendResponse(self.responseFile.writeField, typeId.encode(), text.encode())
+            if not data:
+                break
+        stream.close()
+        texts[typeId] = "".join(pieces)
+
+    def makeResponse(self, output, errors, exitCode, relayed=False):
+        # Output that has been relayed already is just for recording
+        outputFile = None if relayed else self.responseFile
+        return [ StdoutTraffic(output, outputFile), StderrTraffic(errors, outputFile), \
                  SysExitTraffic(exitCode, self.responseFile) ]
 
     def filterReplay(self, trafficList):
@@ -198,13 +286,13 @@ class CommandLineTraffic(traffic.Traffic):
 class StdoutTraffic(traffic.ResponseTraffic):
     typeId = "OUT"
     def forwardToDestination(self):
-        self.write(self.text + "|TT_CMD_SEP|")
+        self.writeField(self.text)
         return []
 
 class StderrTraffic(traffic.ResponseTraffic):
     typeId = "ERR"
     def forwardToDestination(self):
-        self.write(self.text + "|TT_CMD_SEP|")
+        self.writeField(self.text)
         return []
 
 class SysExitTraffic(traffic.ResponseTraffic):
@@ -214,6 +302,11 @@ class SysExitTraffic(traffic.ResponseTraffic):
         self.exitStatus = int(status)
     def hasInfo(self):
         return self.exitStatus != 0
+    def forwardToDestination(self):
+        self.writeField(self.text, separator="")
+        if self.responseFile:
+            self.responseFile.close()
+        return []
 
 
 # Only works on UNIX
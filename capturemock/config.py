@@ -11,6 +11,9 @@ REPLAY = 0
 RECORD = 1
 REPLAY_OLD_RECORD_NEW = 2
 
+# For reading with universal newlines: Python 3 always does that, and 3.11 no longer accepts "U"
+READ_MODE = "rU" if sys.version_info[0] < 3 else "r"
+
 class CaptureMockReplayError(RuntimeError):
     pass
 
@@ -38,6 +41,12 @@ class RcFileHandler:
     def getboolean(self, *args):
         return self._get(self.parser.getboolean, *args)
 
+    def getint(self, *args):
+        return self._get(self.parser.getint, *args)
+
+    def getfloat(self, *args):
+        return self._get(self.parser.getfloat, *args)
+
     def _get(self, getMethod, setting, sections, defaultVal=None):
         for section in sections:
             if self.parser.has_section(section) and self.parser.has_option(section, setting):
@@ -0,0 +1,55 @@
+""" Cache of compiled code for recorded responses, which are evaluated each time they are replayed """
+
+import threading
+try: # Python 2.7, Python 3.x
+    from collections import OrderedDict
+except ImportError: # Python 2.6 and earlier
+    from ordereddict import OrderedDict
+
+class CompiledExpressionCache:
+    """ Least recently used cache of code objects, keyed on the text and how it's compiled.
+    Shared by everything that evaluates replayed text, counting hits and misses so it can be sized """
+    def __init__(self, maxSize=1000):
+        self.maxSize = maxSize
+        self.codeObjects = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def configure(self, rcHandler):
+        self.maxSize = rcHandler.getint("eval_cache_size", [ "general" ], self.maxSize)
+        with self.lock:
+            self.removeOldest()
+
+    def removeOldest(self):
+        while len(self.codeObjects) > max(self.maxSize, 0):
+            self.codeObjects.popitem(last=False)
+
+    def getCode(self, text, mode):
+        key = text, mode
+        with self.lock:
+            code = self.codeObjects.pop(key, None)
+            if code is not None:
+                self.hits += 1
+                self.codeObjects[key] = code # now the most recently used
+                return code
+            self.misses += 1
+        code = compile(text, "<capturemock response>", mode)
+        with self.lock:
+            self.codeObjects[key] = code
+            self.removeOldest()
+        return code
+
+    # Unlike eval and exec, there is no default scope: it would be ours rather than the caller's
+    def evaluate(self, text, globals, locals=None):
+        return eval(self.getCode(text, "eval"), globals, locals)
+
+    def execute(self, text, globals, locals=None):
+        exec(self.getCode(text, "exec"), globals, locals)
+
+    def getStatistics(self):
+        return "Compiled expression cache: " + str(self.hits) + " hits, " + str(self.misses) + " misses, " + \
+            str(len(self.codeObjects)) + " of " + str(self.maxSize) + " entries used"
+
+
+evalCache = CompiledExpressionCache()
@@ -1,22 +1,42 @@
 """ Capturing edits for files, currently only from command line traffic """
 
 from capturemock import traffic
-import os, logging, shutil
+import os, logging, shutil, hashlib, threading
+
+try:
+    from concurrent.futures import ThreadPoolExecutor
+except ImportError: # Python 2 without the backport, copy one file at a time
+    ThreadPoolExecutor = None
 
 class FileEditTraffic(traffic.ResponseTraffic):
     typeId = "FIL"
     linkSuffix = ".CAPTUREMOCK_SYMLINK"
     deleteSuffix = ".CAPTUREMOCK_DELETION"
+    blobSuffix = ".CAPTUREMOCK_BLOB"
     replayFileEditDir = None
     recordFileEditDir = None
+    storeDir = None # Shared store of file contents, named by their hash. Not used unless configured
     fileRequestCount = {} # also only for recording
     diag = None
+    copyThreads = 8 # copying is mostly waiting for the disk, so more threads than processors is fine
     @classmethod
     def configure(cls, options):
         cls.diag = logging.getLogger("Server")
         cls.replayFileEditDir = options.replay_file_edits
         cls.recordFileEditDir = options.record_file_edits
 
+    @classmethod
+    def configureStore(cls, rcHandler):
+        storeDir = rcHandler.get("file_edit_store", [ "general" ])
+        cls.storeDir = os.path.abspath(os.path.expanduser(storeDir)) if storeDir else None
+
+    @classmethod
+    def makeSessionClass(cls, options):
+        # Each session of a server daemon stores and restores edits in its own places
+        sessionClass = type(cls.__name__, (cls,), { "fileRequestCount" : {} })
+        sessionClass.configure(options)
+        return sessionClass
+
     def __init__(self, fileName, activeFile, storedFile, changedPaths, reproduce):
         self.activeFile = activeFile
         self.storedFile = storedFile
@@ -27,7 +47,7 @@ class FileEditTraffic(traffic.ResponseTraffic):
     @classmethod
     def getFileWithType(cls, fileName):
         if cls.replayFileEditDir:
-            for name in [ fileName, fileName + cls.linkSuffix, fileName + cls.deleteSuffix ]:
+            for name in [ fileName, fileName + cls.linkSuffix, fileName + cls.deleteSuffix, fileName + cls.blobSuffix ]:
                 candidate = os.path.join(cls.replayFileEditDir, name)
                 if os.path.exists(candidate):
                     return candidate, cls.getFileType(candidate)
@@ -46,9 +66,10 @@ class FileEditTraffic(traffic.ResponseTraffic):
     def makeRecordedTraffic(cls, file, changedPaths):
         storedFile = os.path.join(cls.recordFileEditDir, cls.getFileEditName(os.path.basename(file)))
         fileName = os.path.basename(storedFile)
-        cls.diag.debug("File being edited for '" + fileName + "' : will store " + str(file) + " as " + str(storedFile))
-        for path in changedPaths:
-            cls.diag.debug("- changed " + path)
+        if cls.diag.isEnabledFor(logging.DEBUG):
+            cls.diag.debug("File being edited for '%s' : will store %s as %s", fileName, file, storedFile)
+            for path in changedPaths:
+                cls.diag.debug("- changed %s", path)
         return cls(fileName, file, storedFile, changedPaths, reproduce=False)
 
     @classmethod
@@ -66,16 +87,18 @@ class FileEditTraffic(traffic.ResponseTraffic):
             shutil.rmtree(path)
 
     def copy(self, srcRoot, dstRoot):
+        # Links and deletions are quick, and done as we go. Files are copied together at the end
+        filesToCopy = []
+        knownDirs = set()
+        storeBlobs = self.storeDir is not None and not self.reproduce
         for srcPath in self.changedPaths:
             dstPath = srcPath.replace(srcRoot, dstRoot)
             try:
-                dstParent = os.path.dirname(dstPath)
-                if not os.path.isdir(dstParent):
-                    if os.path.islink(dstParent) or os.path.isfile(dstParent):
-                        os.remove(dstParent)
-                    os.makedirs(dstParent)
+                self.makeParentDir(dstPath, knownDirs)
                 if srcPath.endswith(self.linkSuffix):
                     self.restoreLink(srcPath, dstPath.replace(self.linkSuffix, ""))
+                elif srcPath.endswith(self.blobSuffix):
+                    filesToCopy.append((self.restoreBlob, srcPath, dstPath.replace(self.blobSuffix, "")))
                 elif os.path.islink(srcPath):
                     self.storeLinkAsFile(srcPath, dstPath + self.linkSuffix)
                 elif srcPath.endswith(self.deleteSuffix):
@@ -83,9 +106,113 @@ class FileEditTraffic(traffic.ResponseTraffic):
                 elif not os.path.exists(srcPath):
                     open(dstPath + self.deleteSuffix, "w").close()
                 else:
-                    shutil.copyfile(srcPath, dstPath)
+                    filesToCopy.append((self.storeBlob if storeBlobs else self.copyFile, srcPath, dstPath))
             except IOError:
                 print("Could not transfer " + srcPath + " to " + dstPath)
+        self.copyFiles(filesToCopy)
+
+    def makeParentDir(self, dstPath, knownDirs):
+        # Many changed files usually share a few directories, so only look at each one once
+        dstParent = os.path.dirname(dstPath)
+        if dstParent not in knownDirs:
+            if not os.path.isdir(dstParent):
+                if os.path.islink(dstParent) or os.path.isfile(dstParent):
+                    os.remove(dstParent)
+                os.makedirs(dstParent)
+            knownDirs.add(dstParent)
+
+    def copyFiles(self, filesToCopy):
+        if len(filesToCopy) > 1 and ThreadPoolExecutor is not None and self.copyThreads > 1:
+            with ThreadPoolExecutor(max_workers=min(self.copyThreads, len(filesToCopy))) as executor:
+                for _ in executor.map(self.transferFile, filesToCopy):
+                    pass
+        else:
+            for transfer in filesToCopy:
+                self.transferFile(transfer)
+
+    def transferFile(self, transfer):
+        method, srcPath, dstPath = transfer
+        try:
+            method(srcPath, dstPath)
+        except (IOError, OSError):
+            print("Could not transfer " + srcPath + " to " + dstPath)
+
+    @staticmethod
+    def copyFile(srcPath, dstPath):
+        # copy_file_range lets the kernel copy without going through us, or even share the blocks.
+        # Otherwise shutil.copyfile, which itself uses sendfile where it can
+        if hasattr(os, "copy_file_range"):
+            with open(srcPath, "rb") as src:
+                size = os.fstat(src.fileno()).st_size
+                if size > 0: # Files in /proc and the like claim to be empty, and can't be copied this way
+                    with open(dstPath, "wb") as dst:
+                        try:
+                            copied = 0
+                            while True:
+                                sent = os.copy_file_range(src.fileno(), dst.fileno(), max(size - copied, 1 << 20))
+                                if sent == 0:
+                                    break
+                                copied += sent
+                            if copied >= size:
+                                return
+                        except OSError: # e.g. different file systems on older kernels
+                            pass
+        shutil.copyfile(srcPath, dstPath)
+
+    @classmethod
+    def cloneFile(cls, srcPath, dstPath):
+        # Where the file system can, share the blocks until one of the files is changed
+        try:
+            import fcntl
+            with open(srcPath, "rb") as src:
+                with open(dstPath, "wb") as dst:
+                    fcntl.ioctl(dst.fileno(), 0x40049409, src.fileno()) # FICLONE, which fcntl doesn't name
+            return
+        except (ImportError, IOError, OSError):
+            pass
+        cls.copyFile(srcPath, dstPath)
+
+    @staticmethod
+    def hashFile(fileName):
+        sha = hashlib.sha1()
+        with open(fileName, "rb") as f:
+            for block in iter(lambda: f.read(1 << 20), b""):
+                sha.update(block)
+        return sha.hexdigest()
+
+    def getBlobPath(self, blobName):
+        return os.path.join(self.storeDir, blobName[:2], blobName[2:])
+
+    def storeBlob(self, srcPath, dstPath):
+        # Identical contents are only stored once however many times, and in however many tests, they are recorded
+        blobName = self.hashFile(srcPath)
+        blobPath = self.getBlobPath(blobName)
+        if not os.path.isfile(blobPath):
+            blobDir = os.path.dirname(blobPath)
+            try:
+                os.makedirs(blobDir)
+            except OSError:
+                if not os.path.isdir(blobDir):
+                    raise
+            # Other threads and processes may be storing the same thing, so only give it its name once it's complete
+            tmpPath = blobPath + ".tmp" + str(os.getpid()) + "_" + str(threading.current_thread().ident)
+            try:
+                self.copyFile(srcPath, tmpPath)
+                os.rename(tmpPath, blobPath)
+            except OSError:
+                if os.path.isfile(tmpPath):
+                    os.remove(tmpPath)
+                if not os.path.isfile(blobPath): # Windows won't rename over an existing file, anything else is a real problem
+                    raise
+        with open(dstPath + self.blobSuffix, "w") as f:
+            f.write(blobName + "\n")
+
+    def restoreBlob(self, srcPath, dstPath):
+        with open(srcPath) as f:
+            blobName = f.read().strip()
+        if self.storeDir is None:
+            raise IOError("no file_edit_store configured to find " + blobName + " in")
+        self.cloneFile(self.getBlobPath(blobName), dstPath)
 
     def restoreLink(self, srcPath, dstPath):
         linkTo = open(srcPath).read().strip()
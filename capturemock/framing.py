@@ -0,0 +1,79 @@
+
+""" Length-prefixed framing for the classic socket protocol, used by intercepted commands.
+A framed connection starts with MAGIC, which includes the protocol version, and then consists of frames:
+a three-letter type and a payload length followed by the payload itself, all of it bytes.
+A request is some REQ frames and an END frame, and its response comes back the same way,
+so a connection can carry several requests one after the other.
+Connections which don't start with MAGIC are using the original protocol. """
+
+# This is also imported by intercepted commands, so keep its own imports to a minimum
+import struct
+
+MAGIC = b"CMF\x01"
+REQ, OUT, ERR, EXC, MSG, END = b"REQ", b"OUT", b"ERR", b"EXC", b"MSG", b"END"
+header = struct.Struct(">3sI")
+maxFrameSize = 65536
+
+def writeFrame(write, frameType, data=b""):
+    write(header.pack(frameType, len(data)))
+    if data:
+        write(data)
+
+def writeField(write, frameType, data):
+    # Large fields go in several frames: slicing a memoryview means neither end copies the whole thing again
+    view = memoryview(data)
+    for pos in range(0, len(view), maxFrameSize):
+        writeFrame(write, frameType, view[pos:pos + maxFrameSize])
+
+def sendRequest(write, data):
+    writeField(write, REQ, data)
+    writeFrame(write, END)
+
+def readExactly(read, size):
+    # Files return everything we ask for unless they're finished, sockets may return less
+    chunks = []
+    while size > 0:
+        chunk = read(size)
+        if not chunk:
+            break
+        chunks.append(chunk)
+        size -= len(chunk)
+    return b"".join(chunks)
+
+def readFrame(read):
+    """ Returns the frame type and its payload, or (None, None) if the connection has closed """
+    headerData = readExactly(read, header.size)
+    if len(headerData) < header.size:
+        return None, None
+    frameType, size = header.unpack(headerData)
+    return frameType, readExactly(read, size)
+
+def readRequest(read):
+    """ Returns the request text as bytes, or None if the connection closes first """
+    chunks = []
+    frameType, data = readFrame(read)
+    while frameType == REQ:
+        chunks.append(data)
+        frameType, data = readFrame(read)
+    if frameType == END:
+        return b"".join(chunks)
+
+
+class FramedResponseFile:
+    """ Takes the place of the socket file when responding to a framed request """
+    def __init__(self, wfile):
+        self.wfile = wfile
+        self.ended = False
+
+    def write(self, data):
+        # Anything that isn't one of a command's response fields
+        self.writeField(MSG, data)
+
+    def writeField(self, frameType, data):
+        writeField(self.wfile.write, frameType, data)
+
+    def close(self):
+        # The connection stays open for further requests, just say that this response is complete
+        if not self.ended:
+            self.ended = True
+            writeFrame(self.wfile.write, END)
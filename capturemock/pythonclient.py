@@ -1,5 +1,6 @@
 """ Actual interception objects used by Python interception mechanism """
-import sys, types, inspect
+import sys, types, inspect, weakref
+from .evalcache import evalCache
 
 class NameFinder(dict):
     def __init__(self, moduleProxy):
@@ -20,13 +21,15 @@ class NameFinder(dict):
         newClass = dict.__getitem__(self, className)
         newClass.__module__ = self.moduleProxy.captureMockProxyName
         self["Instance"] = self.makeInstance # In case we created a class called Instance...
+        if isinstance(newClass, type) and issubclass(newClass, InstanceProxy):
+            localAttributeTable.getLocalNames(newClass)
         return newClass
 
     def makeMetaClass(self, realMetaClass):
         fullClassName = realMetaClass.__module__ + "." + realMetaClass.__name__
         clsName = realMetaClass.__name__ + "Proxy"
         if clsName not in self.moduleProxy.__dict__:
-            classDefStr = "class " + clsName + "(" + fullClassName + ", PythonProxy) : pass"
+            classDefStr = "class " + clsName + "(" + fullClassName + ", ProxyMetaClass) : pass"
             self.defineClass(clsName, classDefStr)
         return clsName
 
@@ -152,9 +155,9 @@ class PythonProxy(object):
 
     def captureMockEvaluate(self, response):
         if response.startswith("raise "):
-            exec(response, self.captureMockNameFinder)
+            evalCache.execute(response, self.captureMockNameFinder)
         else:
-            return eval(response, self.captureMockNameFinder)
+            return evalCache.evaluate(response, self.captureMockNameFinder)
 
     def __call__(self, *args, **kw):
         return self.captureMockTrafficHandler.callFunction(self.captureMockProxyName,
@@ -190,7 +193,43 @@ class ModuleProxy(PythonProxy):
         return self.captureMockTarget
 
 
+class LocalAttributeTable:
+    """ For each proxy class, the attributes defined in a non-intercepted subclass, which are looked up locally.
+    Calling dir() on every attribute access is expensive, so this is worked out once for each class,
+    and again only if a proxy class or one of its subclasses has had attributes set or removed since """
+    def __init__(self):
+        self.tables = weakref.WeakKeyDictionary()
+        self.version = 0
+
+    def classChanged(self):
+        self.version += 1
+
+    def getLocalNames(self, cls):
+        table = self.tables.get(cls)
+        if table is None or table[0] != self.version:
+            table = self.version, self.findLocalNames(cls, inspect.getmro(cls))
+            self.tables[cls] = table
+        return table[1]
+
+    @staticmethod
+    def findLocalNames(cls, allbases):
+        proxyPos = allbases.index(PythonProxy) # should always exist
+        firstBaseClass = allbases[proxyPos + 1] # at least "object" should be there failing anything else
+        return frozenset(dir(cls)) - frozenset(dir(firstBaseClass))
+
+localAttributeTable = LocalAttributeTable()
+
+
 class InstanceProxy(PythonProxy):
+    captureMockLocalAttributes = frozenset([ "__file__",
+                                             "__dict__",
+                                             "__class__",
+                                             "__getattr__",
+                                             "__members__",
+                                             "__methods__",
+                                             "__name__",
+                                             "__cause__",
+                                             "__context__" ])
     moduleProxy = None
     captureMockTarget = None
     captureMockClassProxyName = None
@@ -253,31 +292,14 @@ class InstanceProxy(PythonProxy):
     # Used by mixins of this class and new-style classes
     def __getattribute__(self, attrname):
         if attrname.startswith("captureMock") or \
-               attrname in ["__file__",
-                            "__dict__",
-                            "__class__",
-                            "__getattr__",
-                            "__members__",
-                            "__methods__",
-                            "__name__",
-                            "__cause__", 
-                            "__context__"] or \
+               attrname in InstanceProxy.captureMockLocalAttributes or \
                self.captureMockDefinedInNonInterceptedSubclass(attrname):
             return object.__getattribute__(self, attrname)
         else:
             return self.__getattr__(attrname)
 
     def captureMockDefinedInNonInterceptedSubclass(self, attrname):
-        if attrname not in dir(self.__class__):
-            return False
-
-        firstBaseClass = self.captureMockGetFirstInterceptedBaseClass()
-        return attrname not in dir(firstBaseClass)
-
-    def captureMockGetFirstInterceptedBaseClass(self):
-        allbases = inspect.getmro(self.__class__)
-        proxyPos = allbases.index(PythonProxy) # should always exist
-        return allbases[proxyPos + 1] # at least "object" should be there failing anything else
+        return attrname in localAttributeTable.getLocalNames(self.__class__)
 
     def captureMockConvertToBoolean(self, methodName):
         try:
@@ -328,4 +350,13 @@ class InstanceProxy(PythonProxy):
 
 
 class ProxyMetaClass(type, PythonProxy):
-    pass
+    # Proxies set our own attributes on their class all the time, they can't be local names
+    def __setattr__(cls, attrname, value):
+        super(ProxyMetaClass, cls).__setattr__(attrname, value)
+        if not attrname.startswith("captureMock"):
+            localAttributeTable.classChanged()
+
+    def __delattr__(cls, attrname):
+        super(ProxyMetaClass, cls).__delattr__(attrname)
+        if not attrname.startswith("captureMock"):
+            localAttributeTable.classChanged()
@@ -1,11 +1,13 @@
 
 """ Traffic classes for all kinds of Python calls """
 
-import sys, types, inspect, re
+import sys, types, inspect, re, weakref
 from pprint import pformat
-from threading import RLock
+from threading import Lock, RLock, local
 from . import traffic
-from .recordfilehandler import RecordFileHandler
+from .recordfilehandler import RecordFileHandler, OrderedRecordFileHandler
+from .evalcache import evalCache
+from .pythonclient import PythonProxy
 from .config import CaptureMockReplayError
 
 class PythonWrapper(object):
@@ -52,6 +54,7 @@ class PythonInstanceWrapper(PythonWrapper):
     allInstances = {}
     wrappersByInstance = {}
     classDescriptions = {}
+    callNumbering = None
     def __init__(self, instance, classDesc, namingHint=None):
         self.classDesc = classDesc
         if classDesc not in self.classDescriptions:
@@ -60,9 +63,10 @@ class PythonInstanceWrapper(PythonWrapper):
         super(PythonInstanceWrapper, self).__init__(name, instance)
             
     @classmethod
-    def resetCaches(cls):
+    def resetCaches(cls, callNumbering=None):
         super(PythonInstanceWrapper, cls).resetCaches()
         cls.classDescriptions = {}
+        cls.callNumbering = callNumbering
         
     @classmethod
     def renameInstance(cls, instanceName, namingHint):
@@ -71,7 +75,7 @@ class PythonInstanceWrapper(PythonWrapper):
 
     def shouldRename(self):
         className = self.getClassName()
-        return self.name.replace(className, "").isdigit()
+        return self.name.replace(className, "").replace("_", "").isdigit()
     
     def rename(self, namingHint):
         if self.shouldRename(): 
@@ -92,8 +96,20 @@ class PythonInstanceWrapper(PythonWrapper):
             className += "_" + namingHint
             if className not in self.allInstances:
                 return className
-        
+
+        callNumber = self.callNumbering.getCallNumber() if self.callNumbering else None
+        if callNumber:
+            return self.addCallPostfix(className, callNumber)
         return self.addNumericPostfix(className)
+
+    def addCallPostfix(self, stem, callNumber):
+        # Concurrent calls can return in any order, so name after the call, which was numbered when it started
+        name = stem + str(callNumber)
+        num = 2
+        while name in self.allInstances:
+            name = stem + str(callNumber) + "_" + str(num)
+            num += 1
+        return name
                 
     def createProxy(self, proxy):
         return proxy.captureMockCreateInstanceProxy(self.name, self.target, self.classDesc)
@@ -158,8 +174,8 @@ class PythonImportTraffic(PythonTraffic):
         text = "import " + self.moduleName
         super(PythonImportTraffic, self).__init__(text, *args)
 
-    def isMarkedForReplay(self, replayItems, responses):
-        return self.getDescription() in responses
+    def isMarkedForReplay(self, replayItems, replayInfo):
+        return replayInfo.hasDescription(self.getDescription())
 
 
 class ReprObject:
@@ -190,6 +206,17 @@ def extendDirection(direction):
     return direction + extra if direction.startswith("<") else extra + direction
                   
 class PythonModuleTraffic(PythonTraffic):
+    # What we find out about classes and modules depends only on them and the intercepts, so only do it once
+    relevantBaseClasses = weakref.WeakKeyDictionary()
+    proxyClasses = weakref.WeakKeyDictionary()
+    intercepts = {}
+    @classmethod
+    def resetCaches(cls):
+        # Intercepts may differ from before
+        PythonModuleTraffic.relevantBaseClasses = weakref.WeakKeyDictionary()
+        PythonModuleTraffic.proxyClasses = weakref.WeakKeyDictionary()
+        PythonModuleTraffic.intercepts = {}
+
     def __init__(self, text, rcHandler, interceptModules, inCallback):
         super(PythonModuleTraffic, self).__init__(text, rcHandler)
         self.interceptModules = interceptModules
@@ -224,11 +251,15 @@ class PythonModuleTraffic(PythonTraffic):
         return type(obj) in cacheTypes or hasattr(obj, "__call__")
 
 
-    def isMarkedForReplay(self, replayItems, responses):
-        fullTextMarker = self.direction + self.typeId + ":" + self.getTextMarker()
-        return any((item == fullTextMarker or item.startswith(fullTextMarker + "(") for item in responses))
+    def isMarkedForReplay(self, replayItems, replayInfo):
+        return replayInfo.hasTextMarker(self.direction + self.typeId + ":" + self.getTextMarker())
 
     def getIntercept(self, modOrAttr):
+        if modOrAttr not in self.intercepts:
+            self.intercepts[modOrAttr] = self.findIntercept(modOrAttr)
+        return self.intercepts[modOrAttr]
+
+    def findIntercept(self, modOrAttr):
         if modOrAttr in self.interceptModules:
             return modOrAttr
         elif "." in modOrAttr:
@@ -243,24 +274,52 @@ class PythonModuleTraffic(PythonTraffic):
     def isIterator(self, obj):
         return hasattr(obj, "__iter__") and (hasattr(obj, "next") or hasattr(obj, "__next__"))
 
-    def getResultText(self, result):
-        text = repr(self.transformStructure(result, self.insertReprObjects))
-        return self.applyAlterations(text)
-
     def transformResponse(self, response, proxy):
-        wrappedValue = self.transformStructure(response, self.addInstanceWrapper, responseIsBasic=self.isBasicType(response))
-        responseText = self.getResultText(wrappedValue)
-        transformedResponse = self.transformStructure(wrappedValue, self.insertProxy, proxy)
+        transformedResponse, reprResponse = self.transformStructures(response, 2, self.transformResponseElement,
+                                                                     proxy, self.isBasicType(response))
+        responseText = self.applyAlterations(repr(reprResponse))
         return responseText, transformedResponse
 
+    def transformResponseElement(self, response, proxy, responseIsBasic):
+        wrappedValue = self.addInstanceWrapper(response, responseIsBasic=responseIsBasic)
+        reprValue = self.insertReprObjects(wrappedValue)
+        return self.insertProxy(wrappedValue, proxy), reprValue
+
+    @staticmethod
+    def makeContainer(result, newElems, keys):
+        # Share anything where nothing inside has changed, rather than copying it
+        elems = result.values() if keys is not None else result
+        if all((newElem is elem for newElem, elem in zip(newElems, elems))):
+            return result
+        elif keys is not None:
+            return dict(zip(keys, newElems))
+        else:
+            return type(result)(newElems)
+
     def transformStructure(self, result, transformMethod, *args, **kw):
         if type(result) in (list, tuple):
-            return type(result)([ self.transformStructure(elem, transformMethod, *args, **kw) for elem in result ])
+            newElems = [ self.transformStructure(elem, transformMethod, *args, **kw) for elem in result ]
+            return self.makeContainer(result, newElems, None)
         elif type(result) == dict:
-            newResult = {}
-            for key, value in result.items():
-                newResult[key] = self.transformStructure(value, transformMethod, *args, **kw)
-            return transformMethod(newResult, *args, **kw)
+            keys = list(result.keys())
+            newValues = [ self.transformStructure(result[key], transformMethod, *args, **kw) for key in keys ]
+            return transformMethod(self.makeContainer(result, newValues, keys), *args, **kw)
+        else:
+            return transformMethod(result, *args, **kw)
+
+    def transformStructures(self, result, versionCount, transformMethod, *args, **kw):
+        # As transformStructure, but makes several transformed versions in the same pass.
+        # transformMethod returns all the versions for each element inside the lists, tuples and dicts.
+        # The last version is the one for recording, so dicts there are prepared for repr as insertReprObjects does
+        if type(result) in (list, tuple, dict):
+            keys = list(result.keys()) if type(result) == dict else None
+            elems = [ result[key] for key in keys ] if keys is not None else result
+            elemVersions = [ self.transformStructures(elem, versionCount, transformMethod, *args, **kw) for elem in elems ]
+            versions = [ self.makeContainer(result, [ elemVersion[i] for elemVersion in elemVersions ], keys)
+                         for i in range(versionCount) ]
+            if keys is not None:
+                versions[-1] = DictForRepr(versions[-1])
+            return tuple(versions)
         else:
             return transformMethod(result, *args, **kw)
         
@@ -287,9 +346,18 @@ class PythonModuleTraffic(PythonTraffic):
         except:
             return False
 
+    def isProxy(self, instance):
+        # Only our proxies have a captureMockTarget, so we don't need to look at all attributes of every instance
+        cls = type(instance)
+        isProxy = self.proxyClasses.get(cls)
+        if isProxy is None:
+            isProxy = issubclass(cls, PythonProxy)
+            self.proxyClasses[cls] = isProxy
+        return isProxy and self.instanceHasAttribute(instance, "captureMockTarget")
+
     def getWrapper(self, instance, namingHint=None, **kw):
         # hasattr fails if the intercepted instance defines __getattr__, when it always returns True
-        if self.instanceHasAttribute(instance, "captureMockTarget"):
+        if self.isProxy(instance):
             return self.getWrapper(instance.captureMockTarget, namingHint)
         classDesc = self.getClassDescription(self.getClass(instance))
         return PythonInstanceWrapper.getWrapperFor(instance, classDesc, namingHint)
@@ -298,7 +366,10 @@ class PythonModuleTraffic(PythonTraffic):
         if cls.__name__ in PythonInstanceWrapper.classDescriptions:
             return cls.__name__
         
-        baseClasses = self.findRelevantBaseClasses(cls)
+        baseClasses = self.relevantBaseClasses.get(cls)
+        if baseClasses is None:
+            baseClasses = self.findRelevantBaseClasses(cls)
+            self.relevantBaseClasses[cls] = baseClasses
         if len(baseClasses):
             return cls.__name__ + "(" + ", ".join(baseClasses) + ")"
         else:
@@ -324,6 +395,7 @@ class PythonAttributeTraffic(PythonModuleTraffic):
     cachedInstances = {}
     @classmethod
     def resetCaches(cls):
+        super(PythonAttributeTraffic, cls).resetCaches()
         cls.cachedAttributes = {}
         cls.cachedInstances = {}
             
@@ -361,11 +433,10 @@ class PythonFunctionCallTraffic(PythonModuleTraffic):
         self.functionName = functionName
         self.args = args
         self.kw = kw # Prevent naming hints being added when transforming arguments
-        self.args = self.transformStructure(args, self.transformArg, proxy)
-        self.kw = self.transformStructure(kw, self.transformArg, proxy)
-        
-        argsForRecord = self.transformStructure(list(self.args), self.insertReprObjects)
-        keywForRecord = self.transformStructure(self.kw, self.insertReprObjects)
+        self.args, argsForRecord = self.transformStructures(args, 2, self.transformArgForRecord, proxy)
+        self.kw, keywForRecord = self.transformStructures(kw, 2, self.transformArgForRecord, proxy)
+
+        argsForRecord = list(argsForRecord)
         for key in sorted(keywForRecord.keys()):
             value = keywForRecord[key]
             recordArg = ReprObject(key + "=" + repr(value))
@@ -382,6 +453,10 @@ class PythonFunctionCallTraffic(PythonModuleTraffic):
     def getTextMarker(self):
         return self.functionName
     
+    def transformArgForRecord(self, arg, proxy):
+        newArg = self.transformArg(arg, proxy)
+        return newArg, self.insertReprObjects(newArg)
+
     def transformArg(self, arg, proxy):
         if proxy.captureMockCallback:
             return self.addInstanceWrapper(arg)
@@ -484,17 +559,91 @@ class PythonResponseTraffic(traffic.BaseTraffic):
             self.direction = extendDirection(self.direction)
         super(PythonResponseTraffic, self).__init__(text, rcHandler)
 
+class CallOrderedRecordFileHandler(OrderedRecordFileHandler):
+    """ For intercepted calls made from many threads at once. Each outermost call in a thread is numbered
+    when it starts, and everything recorded until it returns is written together, in that order """
+    def __init__(self, file, rcHandler):
+        super(CallOrderedRecordFileHandler, self).__init__(file, rcHandler)
+        self.callCount = 0
+        self.countLock = Lock()
+        self.threadCalls = local()
+
+    def startCall(self):
+        depth = getattr(self.threadCalls, "depth", 0)
+        if depth == 0:
+            with self.countLock:
+                self.callCount += 1
+                self.threadCalls.callNumber = self.callCount
+        self.threadCalls.depth = depth + 1
+
+    def getCallNumber(self):
+        if getattr(self.threadCalls, "depth", 0) > 0:
+            return self.threadCalls.callNumber
+
+    def endCall(self):
+        self.threadCalls.depth -= 1
+        if self.threadCalls.depth == 0:
+            self.requestComplete(self.threadCalls.callNumber)
+
+    def record(self, text, truncationPoint=False):
+        inCall = getattr(self.threadCalls, "depth", 0) > 0
+        if not inCall: # e.g. setting attributes, which is a call of its own
+            self.startCall()
+        try:
+            super(CallOrderedRecordFileHandler, self).record(text, self.threadCalls.callNumber, truncationPoint)
+        finally:
+            if not inCall:
+                self.endCall()
+
+
+class CallLock(object):
+    """ Held while handling an intercepted call. When calls can be made concurrently, it is released
+    while the real code runs, and calls are numbered so that their traffic can be recorded in order """
+    def __init__(self, orderedRecordFileHandler=None):
+        self.lock = RLock()
+        self.orderedRecordFileHandler = orderedRecordFileHandler
+
+    def __enter__(self):
+        if self.orderedRecordFileHandler:
+            self.orderedRecordFileHandler.startCall()
+        self.lock.acquire()
+
+    def __exit__(self, *args):
+        self.lock.release()
+        if self.orderedRecordFileHandler:
+            self.orderedRecordFileHandler.endCall()
+
+    def unlocked(self, method):
+        if not self.orderedRecordFileHandler:
+            return method
+
+        def callUnlocked(*args, **kw):
+            self.lock.release()
+            try:
+                return method(*args, **kw)
+            finally:
+                self.lock.acquire()
+        return callUnlocked
+
+
 class PythonTrafficHandler:
     def __init__(self, replayInfo, recordFile, rcHandler, callStackChecker, interceptModules):
         self.replayInfo = replayInfo
-        self.recordFileHandler = RecordFileHandler(recordFile)
+        if rcHandler.getboolean("concurrent_calls", [ "python" ], False):
+            self.recordFileHandler = CallOrderedRecordFileHandler(recordFile, rcHandler)
+            self.lock = CallLock(self.recordFileHandler)
+            callNumbering = self.recordFileHandler
+        else:
+            self.recordFileHandler = RecordFileHandler(recordFile, rcHandler)
+            self.lock = CallLock()
+            callNumbering = None
         self.callStackChecker = callStackChecker
         self.rcHandler = rcHandler
         self.interceptModules = interceptModules
-        self.lock = RLock()
-        PythonInstanceWrapper.resetCaches() # reset, in case of previous tests
+        PythonInstanceWrapper.resetCaches(callNumbering) # reset, in case of previous tests
         PythonCallbackWrapper.resetCaches()
         PythonAttributeTraffic.resetCaches()
+        evalCache.configure(rcHandler)
 
     def importModule(self, name, proxy, loadModule):
         with self.lock:
@@ -580,7 +729,7 @@ class PythonTrafficHandler:
         if response is not None and response.startswith("Instance"):
             def Instance(classDesc, instanceName):
                 return classDesc
-            return eval(response)
+            return evalCache.evaluate(response, globals(), locals())
         
     def getReplayInstanceName(self, text, proxy):
         def Instance(classDesc, instanceName):
@@ -588,7 +737,7 @@ class PythonTrafficHandler:
         if text.startswith("raise "):
             proxy.captureMockEvaluate(text) # raise the exception
         else:
-            return eval(text)
+            return evalCache.evaluate(text, globals(), locals())
 
     def getAndRecordRealAttribute(self, traffic, proxyTarget, attrName, proxy, fullAttrName):
         try:
@@ -656,8 +805,8 @@ class PythonTrafficHandler:
     def callRealFunction(self, captureMockTraffic, captureMockFunction, captureMockProxy):
         realRet = self.callStackChecker.callNoInterception(captureMockProxy.captureMockCallback, 
                                                            captureMockTraffic.callRealFunction,
-                                                           captureMockFunction, self.recordFileHandler,
-                                                           captureMockProxy)
+                                                           self.lock.unlocked(captureMockFunction),
+                                                           self.recordFileHandler, captureMockProxy)
         if captureMockTraffic.shouldRecord:
             return self.transformResponse(captureMockTraffic, realRet, captureMockProxy)
         else:
@@ -686,8 +835,8 @@ class PythonTrafficHandler:
                     raise CaptureMockReplayError("Could not match sufficiently well to construct object of type '" + captureMockClassName + "'")
             else:
                 realObj = self.callStackChecker.callNoInterception(False, traffic.callRealFunction,
-                                                                   captureMockRealClass, self.recordFileHandler,
-                                                                   captureMockProxy)
+                                                                   self.lock.unlocked(captureMockRealClass),
+                                                                   self.recordFileHandler, captureMockProxy)
                 wrapper = traffic.getWrapper(realObj)
                 self.recordResponse(repr(wrapper))
                 return wrapper.name, realObj
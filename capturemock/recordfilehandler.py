@@ -1,27 +1,162 @@
+""" Very basic interface for appending to a file, and a version for writing traffic from many requests in order """
+import os, threading, atexit, tempfile
 
-""" Very basic interface for appending to a file. Server version much more complex """ 
-import os
+# Says that the block of traffic before it happened this many more times
+repeatPrefix = "<-RPT:"
+
+# Handlers which still have something to do when they're closed. Closed at exit if nobody else did it
+openHandlers = set()
+openHandlersLock = threading.Lock()
+
+def closeOpenHandlers():
+    with openHandlersLock:
+        handlers = list(openHandlers)
+    for handler in handlers:
+        handler.close()
+
+atexit.register(closeOpenHandlers)
+
+def isBlockStart(line):
+    # Each block starts with a request which isn't part of anything else
+    return line.startswith("<-") and len(line.split(":")[0]) == 5
+
+def readBlocks(readFile):
+    block = []
+    for line in readFile:
+        if block and isBlockStart(line):
+            yield "".join(block)
+            block = []
+        block.append(line)
+    if block:
+        yield "".join(block)
+
+def compactRepeats(fileName):
+    """ Write each run of identical consecutive blocks once, followed by how many more times it happened """
+    fd, tmpFile = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(fileName)), prefix=".tmp")
+    compacted = False
+    with open(fileName) as readFile:
+        with os.fdopen(fd, "w") as writeFile:
+            prevBlock, repeats = None, 0
+            for block in readBlocks(readFile):
+                if block == prevBlock and isBlockStart(block):
+                    repeats += 1
+                    compacted = True
+                    continue
+                if repeats:
+                    writeFile.write(repeatPrefix + str(repeats) + "\n")
+                writeFile.write(block)
+                prevBlock, repeats = block, 0
+            if repeats:
+                writeFile.write(repeatPrefix + str(repeats) + "\n")
+    if compacted:
+        getattr(os, "replace", os.rename)(tmpFile, fileName)
+    else:
+        os.remove(tmpFile)
+
+def compactRecordFile(fileName, rcHandler):
+    """ For whoever owns the record file, once everything that writes to it has finished.
+    Several processes can append to it, so none of them can do this when they close it """
+    if fileName and rcHandler.getboolean("compact_repeats", [ "general" ], False) and os.path.isfile(fileName):
+        compactRepeats(fileName)
 
 class RecordFileHandler(object):
-    def __init__(self, file):
+    def __init__(self, file, rcHandler=None):
         self.file = file
         self.lastTruncationPoint = None
         self.recordedSinceTruncationPoint = []
+        # Buffered mode: keep the file open and write in batches rather than once per traffic
+        self.bufferSize = self.getSetting(rcHandler, "getint", "record_buffer_size", 0)
+        flushInterval = self.getSetting(rcHandler, "getfloat", "record_flush_interval", 0)
+        self.buffered = self.bufferSize > 0 or flushInterval > 0
+        self.buffer = []
+        self.bufferedLength = 0
+        self.truncationBufferIndex = None # truncation point which hasn't reached the file yet
+        self.writeFile = None
+        self.bufferLock = threading.RLock()
+        self.closed = threading.Event()
+        if self.file and self.buffered:
+            with openHandlersLock:
+                openHandlers.add(self)
+            if flushInterval > 0:
+                self.startFlushThread(flushInterval)
+
+    @staticmethod
+    def getSetting(rcHandler, methodName, setting, defaultVal):
+        if rcHandler:
+            return getattr(rcHandler, methodName)(setting, [ "general" ], defaultVal)
+        else:
+            return defaultVal
+
+    def startFlushThread(self, flushInterval):
+        def flushRegularly():
+            while not self.closed.wait(flushInterval):
+                self.flush()
+        flushThread = threading.Thread(target=flushRegularly, name="record flush")
+        flushThread.daemon = True
+        flushThread.start()
 
     def record(self, text, truncationPoint=False):
         if self.file:
+            if self.buffered and self.recordBuffered(text, truncationPoint):
+                return
             if truncationPoint:
                 self.lastTruncationPoint = os.path.getsize(self.file)
-                self.recordedSinceTruncationPoint = []                
+                self.recordedSinceTruncationPoint = []
             if self.lastTruncationPoint is not None:
                 self.recordedSinceTruncationPoint.append(text)
             writeFile = open(self.file, "a")
             writeFile.write(text)
             writeFile.flush()
             writeFile.close()
-            
+
+    def recordBuffered(self, text, truncationPoint):
+        with self.bufferLock:
+            if self.closed.is_set():
+                return False # Nothing will flush the buffer any more, so write straight to the file
+            if truncationPoint:
+                self.lastTruncationPoint = None
+                self.truncationBufferIndex = len(self.buffer)
+                self.recordedSinceTruncationPoint = []
+            if self.lastTruncationPoint is not None or self.truncationBufferIndex is not None:
+                self.recordedSinceTruncationPoint.append(text)
+            self.buffer.append(text)
+            self.bufferedLength += len(text)
+            if self.bufferSize and self.bufferedLength >= self.bufferSize:
+                self.flush()
+            return True
+
+    def flush(self):
+        with self.bufferLock:
+            if not self.buffer:
+                return
+            if self.writeFile is None:
+                self.writeFile = open(self.file, "a")
+            if self.truncationBufferIndex is not None:
+                # Find out where in the file the truncation point ends up, in case we need to rerecord
+                self.writeFile.write("".join(self.buffer[:self.truncationBufferIndex]))
+                self.writeFile.flush()
+                self.lastTruncationPoint = self.writeFile.tell()
+                self.buffer = self.buffer[self.truncationBufferIndex:]
+                self.truncationBufferIndex = None
+            self.writeFile.write("".join(self.buffer))
+            self.writeFile.flush()
+            self.buffer = []
+            self.bufferedLength = 0
+
+    def close(self):
+        with self.bufferLock:
+            self.flush()
+            self.closed.set()
+            if self.writeFile is not None:
+                self.writeFile.close()
+                self.writeFile = None
+        with openHandlersLock:
+            openHandlers.discard(self)
+
     def rerecord(self, oldText, newText):
         if self.file:
+            if self.buffered and self.rerecordBuffered(oldText, newText):
+                return
             writeFile = open(self.file, "a")
             writeFile.truncate(self.lastTruncationPoint)
             for text in self.recordedSinceTruncationPoint:
@@ -30,3 +165,87 @@ class RecordFileHandler(object):
             writeFile.close()
             self.lastTruncationPoint = None
             self.recordedSinceTruncationPoint = []
+
+    def rerecordBuffered(self, oldText, newText):
+        with self.bufferLock:
+            if self.closed.is_set():
+                return False # Everything is in the file already
+            if self.truncationBufferIndex is not None:
+                # Nothing since the truncation point is in the file yet, just replace it in the buffer
+                del self.buffer[self.truncationBufferIndex:]
+            elif self.lastTruncationPoint is not None:
+                self.flush()
+                self.writeFile.truncate(self.lastTruncationPoint)
+            for text in self.recordedSinceTruncationPoint:
+                self.buffer.append(text.replace(oldText, newText))
+            self.bufferedLength = sum(map(len, self.buffer))
+            self.lastTruncationPoint = None
+            self.truncationBufferIndex = None
+            self.recordedSinceTruncationPoint = []
+            return True
+
+
+class OrderedRecordFileHandler(RecordFileHandler):
+    """ Records traffic from several requests handled at the same time.
+    Each request's traffic is written together, in the order the requests were numbered """
+    def __init__(self, file, rcHandler=None):
+        super(OrderedRecordFileHandler, self).__init__(file, rcHandler)
+        self.recordingRequest = 1
+        self.cache = {}
+        self.completedRequests = []
+        self.lock = threading.Lock()
+
+    def requestComplete(self, requestNumber):
+        with self.lock:
+            if requestNumber == self.recordingRequest:
+                self.recordingRequestComplete()
+            else:
+                self.completedRequests.append(requestNumber)
+
+    def skipRequest(self, requestNumber):
+        # A number which will never have traffic for this file. Those before we started can't hold anything up
+        if requestNumber >= self.recordingRequest:
+            self.requestComplete(requestNumber)
+
+    def writeFromCache(self):
+        # Write in as few pieces as possible: only truncation points need to start a new one
+        pieces = []
+        for text, truncationPoint in self.cache.pop(self.recordingRequest, []):
+            if truncationPoint or not pieces:
+                pieces.append([ text, truncationPoint ])
+            else:
+                pieces[-1][0] += text
+        for text, truncationPoint in pieces:
+            super(OrderedRecordFileHandler, self).record(text, truncationPoint)
+
+    def recordingRequestComplete(self):
+        self.writeFromCache()
+        self.recordingRequest += 1
+        if self.recordingRequest in self.completedRequests:
+            self.completedRequests.remove(self.recordingRequest)
+            self.recordingRequestComplete()
+
+    def record(self, text, requestNumber, truncationPoint=False):
+        if not self.file:
+            return
+        with self.lock:
+            if requestNumber == self.recordingRequest:
+                self.writeFromCache()
+                super(OrderedRecordFileHandler, self).record(text, truncationPoint)
+            else:
+                self.cache.setdefault(requestNumber, []).append((text, truncationPoint))
+
+    def rerecord(self, oldText, newText):
+        with self.lock:
+            super(OrderedRecordFileHandler, self).rerecord(oldText, newText)
+            # Anything not yet written needs changing too
+            for requestTexts in self.cache.values():
+                requestTexts[:] = [ (text.replace(oldText, newText), truncationPoint) for text, truncationPoint in requestTexts ]
+
+    def close(self):
+        with self.lock:
+            # Requests which never completed, write what we have of them anyway
+            for requestNumber in sorted(self.cache):
+                self.recordingRequest = requestNumber
+                self.writeFromCache()
+        super(OrderedRecordFileHandler, self).close()
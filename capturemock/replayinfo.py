@@ -1,27 +1,100 @@
 """ Module to manage the information in the file and return appropriate matches """
 
-import logging, difflib, re, os
+import logging, difflib, re, os, stat, hashlib, pickle, tempfile
+from bisect import bisect_right
 try: # Python 2.7, Python 3.x
     from collections import OrderedDict
 except ImportError: # Python 2.6 and earlier
     from ordereddict import OrderedDict
 
 from capturemock import config
+from capturemock.recordfilehandler import repeatPrefix, isBlockStart
 
 
 class ReplayInfo:
+    # Change this whenever what is pickled in the cache changes, e.g. the response handler classes
+    cacheFormatVersion = 2
     def __init__(self, mode, replayFile, rcHandler):
         self.responseMap = OrderedDict()
         self.diag = logging.getLogger("Replay")
         self.replayItems = set()
         self.replayAll = mode == config.REPLAY
         self.exactMatching = rcHandler.getboolean("use_exact_matching", [ "general" ], False)
+        self.matchIndex = None
+        self.markerIndex = None, set()
         if replayFile:
-            trafficList = self.readIntoList(replayFile)
-            self.parseTrafficList(trafficList)
             items = self.makeCommandItems(rcHandler.getIntercepts("command line")) + \
                     self.makePythonItems(rcHandler.getIntercepts("python"))
+            cacheDir = rcHandler.get("replay_cache_dir", [ "general" ])
+            cacheFile, cacheKey = None, None
+            if cacheDir:
+                cacheFile, cacheKey = self.getCacheInfo(cacheDir, replayFile, items)
+                if self.readCache(cacheFile, cacheKey):
+                    return
+            trafficList = self.readIntoList(replayFile)
+            self.parseTrafficList(trafficList)
             self.replayItems = self.filterForReplay(items, trafficList)
+            if cacheFile:
+                self.writeCache(cacheFile, cacheKey)
+
+    @classmethod
+    def getCacheInfo(cls, cacheDir, replayFile, items):
+        # The cache is only valid for the same file contents, replayed with the same intercepts
+        replayPath = os.path.abspath(replayFile)
+        contentHash = hashlib.sha1()
+        with open(replayPath, "rb") as f:
+            for data in iter(lambda: f.read(1024 * 1024), b""):
+                contentHash.update(data)
+        keyText = repr((cls.cacheFormatVersion, contentHash.hexdigest(), tuple(item for item, _ in items)))
+        cacheKey = hashlib.sha1(keyText.encode()).hexdigest().encode() + b"\n"
+        cacheName = hashlib.sha1(replayPath.encode()).hexdigest() + ".replaycache"
+        return os.path.join(os.path.expanduser(cacheDir), cacheName), cacheKey
+
+    def readCache(self, cacheFile, cacheKey):
+        try:
+            with open(cacheFile, "rb") as f:
+                # Unpickling runs code, so only trust a cache nobody else could have written
+                if not self.isPrivate(os.fstat(f.fileno())):
+                    self.diag.debug("Ignoring replay cache %s, other users can write it", cacheFile)
+                    return False
+                # The key comes first, so we know whether the cache is any use before unpickling anything
+                if f.read(len(cacheKey)) != cacheKey:
+                    self.diag.debug("Replay cache %s is out of date", cacheFile)
+                    return False
+                responseMap, replayItems = pickle.load(f)
+        except Exception:
+            # Missing, empty or unreadable cache: just parse the file instead
+            return False
+        self.diag.debug("Reading replay information from cache %s", cacheFile)
+        self.responseMap = responseMap
+        self.replayItems = replayItems
+        return True
+
+    @staticmethod
+    def isPrivate(statInfo):
+        if hasattr(os, "getuid"):
+            return statInfo.st_uid == os.getuid() and not statInfo.st_mode & (stat.S_IWGRP | stat.S_IWOTH)
+        else:
+            return True # Windows permissions aren't reflected in st_mode, rely on the user's own directory
+
+    def writeCache(self, cacheFile, cacheKey):
+        cacheDir = os.path.dirname(cacheFile)
+        tmpFile = None
+        try:
+            if not os.path.isdir(cacheDir):
+                os.makedirs(cacheDir, 0o700)
+            # Write to a temporary file and rename it, so that other processes never read half a cache.
+            # It is only readable and writable by us, which readCache checks
+            fd, tmpFile = tempfile.mkstemp(dir=cacheDir, prefix=".tmp")
+            with os.fdopen(fd, "wb") as f:
+                f.write(cacheKey)
+                pickle.dump((self.responseMap, self.replayItems), f, pickle.HIGHEST_PROTOCOL)
+            # Plain rename won't replace an existing cache on Windows
+            getattr(os, "replace", os.rename)(tmpFile, cacheFile)
+        except (IOError, OSError) as e:
+            self.diag.debug("Failed to write replay cache %s: %s", cacheFile, e)
+            if tmpFile and os.path.isfile(tmpFile):
+                os.remove(tmpFile)
 
     @staticmethod
     def filterForReplay(itemInfo, lines):
@@ -49,7 +122,25 @@ class ReplayInfo:
         elif self.replayAll:
             return True
         else:
-            return traffic.isMarkedForReplay(self.replayItems, list(self.responseMap.keys()))
+            return traffic.isMarkedForReplay(self.replayItems, self)
+
+    def hasDescription(self, desc):
+        return desc in self.responseMap
+
+    def hasTextMarker(self, fullTextMarker):
+        # Is there anything recorded which is either the marker itself or a call of it?
+        if "(" in fullTextMarker:
+            return any((item == fullTextMarker or item.startswith(fullTextMarker + "(") for item in self.responseMap))
+        else:
+            return fullTextMarker in self.getMarkerIndex()
+
+    def getMarkerIndex(self):
+        # Everything before the first bracket: for markers without brackets, exactly those which match
+        indexSize, markers = self.markerIndex
+        if indexSize != len(self.responseMap):
+            markers = set(desc.split("(", 1)[0] for desc in self.responseMap)
+            self.markerIndex = len(self.responseMap), markers
+        return markers
 
     def getTrafficLookupKey(self, trafficStr):
         # If we're matching server communications it means we're 'playing client'
@@ -68,7 +159,14 @@ class ReplayInfo:
 
     def parseTrafficList(self, trafficList):
         currResponseHandlers = []
-        for trafficStr in trafficList:
+        blockStart = None
+        for index, trafficStr in enumerate(trafficList):
+            if trafficStr.startswith(repeatPrefix):
+                if blockStart is not None:
+                    self.repeatBlock(trafficList[blockStart:index], int(trafficStr[len(repeatPrefix):]))
+                continue
+            if isBlockStart(trafficStr):
+                blockStart = index
             prefix = trafficStr.split(":")[0]
             indentLevel = int(len(prefix) / 2) - 2
             fromSUT = prefix.startswith("<-")
@@ -92,7 +190,26 @@ class ReplayInfo:
                     currResponseHandlers.append((responseHandler, fromSUT))
                 else:
                     currResponseHandlers[-1] = responseHandler, fromSUT
-        self.diag.debug("Replay info " + repr(self.responseMap))
+        if self.diag.isEnabledFor(logging.DEBUG):
+            self.diag.debug("Replay info %r", self.responseMap) # can be very large, so don't even start on it unless wanted
+
+    def repeatBlock(self, block, repeats):
+        # Usually a request and its responses, the same every time: just count how many times that happened
+        request = block[0]
+        if all((self.isPlainResponse(trafficStr) for trafficStr in block[1:])) and not self.isAttributeAccess(request):
+            self.responseMap[self.getTrafficLookupKey(request.strip())].repeatLastResponse(repeats)
+        else:
+            # Callbacks or attributes are linked with other requests, the simplest thing is to go through it all again
+            self.parseTrafficList(block * repeats)
+
+    @staticmethod
+    def isPlainResponse(trafficStr):
+        prefix = trafficStr.split(":")[0]
+        return len(prefix) == 5 and not prefix.startswith("<-")
+
+    @staticmethod
+    def isAttributeAccess(trafficStr):
+        return trafficStr.startswith("<-PYT:") and not "(" in trafficStr
 
     def registerIntermediateCalls(self, currResponseHandler):
         intermediate = []
@@ -107,7 +224,7 @@ class ReplayInfo:
     def readIntoList(self, replayFile):
         trafficList = []
         currTraffic = ""
-        for line in open(replayFile, "rU"):
+        for line in open(replayFile, config.READ_MODE):
             prefix = line.split(":")[0]
             if len(prefix) < 10 and (prefix.startswith("<-") or prefix[-5:-3] == "->"):
                 if currTraffic:
@@ -140,7 +257,7 @@ class ReplayInfo:
 
     def getResponseMapKey(self, traffic, exact):
         desc = self.getTrafficLookupKey(traffic.getDescription())
-        self.diag.debug("Trying to match '" + desc + "'")
+        self.diag.debug("Trying to match '%s'", desc)
         if desc in self.responseMap:
             self.diag.debug("Found exact match")
             return desc
@@ -152,23 +269,43 @@ class ReplayInfo:
 
     def findBestMatch(self, desc):
         descWords = self.getWords(desc)
-        bestMatch = None
-        bestMatchInfo = set(), 100000
-        for currDesc, responseHandler in self.responseMap.items():
-            if self.sameType(desc, currDesc):
-                descToCompare = currDesc
-                self.diag.debug("Comparing with '" + descToCompare + "'")
-                matchInfo = self.getWords(descToCompare), responseHandler.getUnmatchedResponseCount()
-                if self.isBetterMatch(matchInfo, bestMatchInfo, descWords):
-                    bestMatchInfo = matchInfo
-                    bestMatch = currDesc
+        # Analysing the target words is the expensive part of SequenceMatcher, so only do it once
+        matcher = difflib.SequenceMatcher(None, [], descWords)
+        debug = self.diag.isEnabledFor(logging.DEBUG)
+        bestMatch, bestMatchInfo = None, None
+        for position, currDesc, currWords, commonBound in self.getMatchIndex().findCandidates(self.getTypeKey(desc), descWords):
+            if bestMatchInfo is not None and commonBound < bestMatchInfo[0]:
+                # Candidates come with the most possible words in common first, so nothing further can win
+                break
+            if debug:
+                self.diag.debug("Comparing with '%s'", currDesc)
+            matcher.set_seq1(currWords)
+            blocks = matcher.get_matching_blocks()
+            common = self.commonElementCount(blocks)
+            if common == 0:
+                continue # Nothing in common, never better than nothing at all
+            # More words in common, then fewer non-matching sequences, then more unmatched responses, then earliest in the file
+            matchInfo = common, -self.nonMatchingSequenceCount(blocks), self.responseMap[currDesc].getUnmatchedResponseCount(), -position
+            if debug:
+                self.diag.debug("Match info %r", matchInfo)
+            if bestMatchInfo is None or matchInfo > bestMatchInfo:
+                bestMatchInfo = matchInfo
+                bestMatch = currDesc
 
         if bestMatch is not None:
-            self.diag.debug("Best match chosen as '" + bestMatch + "'")
+            self.diag.debug("Best match chosen as '%s'", bestMatch)
             return bestMatch
 
+    def getMatchIndex(self):
+        if self.matchIndex is None or len(self.matchIndex) != len(self.responseMap):
+            self.matchIndex = MatchIndex(self.responseMap, self.getWords, self.getTypeKey)
+        return self.matchIndex
+
     def sameType(self, desc1, desc2):
-        return desc1[2:5] == desc2[2:5]
+        return self.getTypeKey(desc1) == self.getTypeKey(desc2)
+
+    def getTypeKey(self, desc):
+        return desc[2:5]
 
     def getWords(self, desc):
         # Heuristic decisions trying to make the best of inexact matches
@@ -184,10 +321,6 @@ class ReplayInfo:
             words += self._getWords(part, separators[1:])
         return words
 
-    def getMatchingBlocks(self, list1, list2):
-        matcher = difflib.SequenceMatcher(None, list1, list2)
-        return list(matcher.get_matching_blocks())
-
     def commonElementCount(self, blocks):
         return sum((block.size for block in blocks))
 
@@ -201,36 +334,80 @@ class ReplayInfo:
         return blocks[-2].a + blocks[-2].size == blocks[-1].a and \
                blocks[-2].b + blocks[-2].size == blocks[-1].b
 
-    def isBetterMatch(self, info1, info2, targetWords):
-        words1, unmatchedCount1 = info1
-        words2, unmatchedCount2 = info2
-        blocks1 = self.getMatchingBlocks(words1, targetWords)
-        blocks2 = self.getMatchingBlocks(words2, targetWords)
-        common1 = self.commonElementCount(blocks1)
-        common2 = self.commonElementCount(blocks2)
-        self.diag.debug("Words in common " + repr(common1) + " vs " + repr(common2))
-        if common1 > common2:
-            return True
-        elif common1 < common2:
-            return False
 
-        nonMatchCount1 = self.nonMatchingSequenceCount(blocks1)
-        nonMatchCount2 = self.nonMatchingSequenceCount(blocks2)
-        self.diag.debug("Non matching sequences " + repr(nonMatchCount1) + " vs " + repr(nonMatchCount2))
-        if nonMatchCount1 < nonMatchCount2:
-            return True
-        elif nonMatchCount1 > nonMatchCount2:
-            return False
+class MatchIndex:
+    """ Words of all recorded descriptions, split up once and indexed by traffic type and word.
+    Only descriptions sharing at least one word with the target can ever be chosen as best match,
+    so these are the only ones we need to look at. """
+    def __init__(self, responseMap, getWords, getTypeKey):
+        self.descriptions = []
+        self.wordLists = []
+        self.wordIndex = {}
+        for position, desc in enumerate(responseMap):
+            words = getWords(desc)
+            self.descriptions.append(desc)
+            self.wordLists.append(words)
+            typeKey = getTypeKey(desc)
+            for word, count in self.countWords(words).items():
+                self.wordIndex.setdefault((typeKey, word), []).append((position, count))
+
+    def __len__(self):
+        return len(self.descriptions)
 
-        self.diag.debug("Unmatched count difference " + repr(unmatchedCount1) + " vs " + repr(unmatchedCount2))
-        return unmatchedCount1 > unmatchedCount2
+    @staticmethod
+    def countWords(words):
+        counts = {}
+        for word in words:
+            counts[word] = counts.get(word, 0) + 1
+        return counts
+
+    def findCandidates(self, typeKey, targetWords):
+        # The number of shared words is an upper bound for how many elements can match.
+        # Return in order of that bound, so the caller can stop as soon as no better match is possible
+        commonBounds = {}
+        for word, targetCount in self.countWords(targetWords).items():
+            for position, count in self.wordIndex.get((typeKey, word), []):
+                commonBounds[position] = commonBounds.get(position, 0) + min(count, targetCount)
+        for position in sorted(commonBounds, key=lambda pos: (-commonBounds[pos], pos)):
+            yield position, self.descriptions[position], self.wordLists[position], commonBounds[position]
+
+
+class ResponseList:
+    """ The responses recorded to a request, in order. Repeats of the same response are stored once, with a count """
+    def __init__(self):
+        self.runs = [ [] ]
+        self.runStarts = [ 0 ]
+        self.length = 1
+
+    def __len__(self):
+        return self.length
+
+    def __repr__(self):
+        runEnds = self.runStarts[1:] + [ self.length ]
+        return "[" + ", ".join((repr(run) if end - start == 1 else repr(run) + " * " + str(end - start)
+                                for run, start, end in zip(self.runs, self.runStarts, runEnds))) + "]"
+
+    def __getitem__(self, index):
+        if index < 0:
+            index += self.length
+        if index < 0 or index >= self.length:
+            raise IndexError("response index out of range")
+        return self.runs[bisect_right(self.runStarts, index) - 1]
+
+    def append(self, responses):
+        self.runs.append(responses)
+        self.runStarts.append(self.length)
+        self.length += 1
+
+    def repeatLast(self, repeats):
+        self.length += repeats
 
 
 # Need to handle multiple replies to the same question
 class ReplayedResponseHandler:
     def __init__(self):
         self.timesChosen = 0
-        self.responses = [[]]
+        self.responses = ResponseList()
         self.intermediateHandlers = []
 
     def __repr__(self):
@@ -245,6 +422,9 @@ class ReplayedResponseHandler:
     def addResponse(self, trafficStr):
         self.responses[-1].append(trafficStr)
 
+    def repeatLastResponse(self, repeats):
+        self.responses.repeatLast(repeats)
+
     def allIntermediatesCalled(self):
         return all((handler.timesChosen for handler in self.intermediateHandlers[self.timesChosen - 1 ]))
 
@@ -280,7 +460,7 @@ class ReplayedResponseHandler:
 
 
 def filterFileForReplay(itemInfo, replayFile):
-    with open(replayFile, "rU") as f:
+    with open(replayFile, config.READ_MODE) as f:
         return ReplayInfo.filterForReplay(itemInfo, f)
 
 def filterCommands(commands, replayFile):
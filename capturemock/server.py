@@ -1,9 +1,11 @@
-import os, stat, sys, socket, threading, time, subprocess
+import os, stat, sys, socket, threading, time, subprocess, tempfile, shutil, logging
 from copy import copy
 
 from capturemock import config
 from capturemock.replayinfo import ReplayInfo
-from capturemock import recordfilehandler, cmdlineutils
+from capturemock.evalcache import evalCache
+from capturemock import recordfilehandler, cmdlineutils, framing
+from capturemock.trafficstatistics import TrafficStatistics
 from capturemock import commandlinetraffic, fileedittraffic, clientservertraffic, customtraffic
 from locale import getpreferredencoding
 from glob import glob
@@ -80,13 +82,89 @@ def stopServer(servAddr):
             print("Could not send terminate message to CaptureMock server at " + servAddr + \
                   ", seemed not to be running anyway.")
 
+def queryStatistics(servAddr):
+    # The XMLRPC server has no way to ask for them, but still writes them at the end
+    if not servAddr.startswith("http"):
+        servAddr, sessionId = ServerDaemon.splitSessionAddress(servAddr)
+        serverAddress = parseAddress(servAddr)
+        if sessionId:
+            return ServerDaemon.sendSessionMessage(serverAddress, sessionId, TrafficStatistics.queryId)
+        else:
+            return ServerDaemon.sendAndRead(serverAddress, TrafficStatistics.queryId)
+
+def startDaemon(rcFiles, environment):
+    cmdArgs = [ getPython(), getServer(), "--daemon" ]
+    if rcFiles:
+        cmdArgs += [ "--rcfiles", ",".join(rcFiles) ]
+    return subprocess.Popen(cmdArgs,
+                            env=environment.copy(),
+                            universal_newlines=True,
+                            stdout=subprocess.PIPE,
+                            stderr=subprocess.PIPE)
+
+def openSession(daemonAddress,
+                rcFiles,
+                mode,
+                replayFile,
+                replayEditDir,
+                recordFile,
+                recordEditDir,
+                sutDirectory,
+                environment):
+    # The daemon runs somewhere else, so it needs to be told everything a server process would inherit
+    def makeAbsolute(path):
+        return os.path.join(sutDirectory, path) if path else path
+    options = { "rcfiles" : ",".join(map(makeAbsolute, rcFiles)),
+                "mode" : mode,
+                "record" : makeAbsolute(recordFile),
+                "record_file_edits" : makeAbsolute(recordEditDir),
+                "replay" : None,
+                "replay_file_edits" : None,
+                "sut_directory" : sutDirectory,
+                "environment" : dict(environment) }
+    if replayFile and mode != config.RECORD:
+        options["replay"] = makeAbsolute(replayFile)
+        options["replay_file_edits"] = makeAbsolute(replayEditDir)
+    return ServerDaemon.sendSessionStartMessage(daemonAddress, options)
+
+# Unix domain sockets are identified by their path, TCP sockets by host:port
+def parseAddress(serverAddressStr):
+    if serverAddressStr.startswith("/"):
+        return serverAddressStr
+    host, port = serverAddressStr.split(":")
+    return host, int(port)
+
+def makeAddressString(serverAddress):
+    if isinstance(serverAddress, tuple):
+        host, port = serverAddress[:2]
+        return host + ":" + str(port)
+    else:
+        return serverAddress
+
+def connectSocket(serverAddress):
+    family = socket.AF_INET if isinstance(serverAddress, tuple) else socket.AF_UNIX
+    sendSocket = socket.socket(family, socket.SOCK_STREAM)
+    sendSocket.connect(serverAddress)
+    return sendSocket
+
+def makeUnixSocketPath():
+    # A fresh directory, so nobody else can have the name and we can tidy it all up afterwards
+    return os.path.join(tempfile.mkdtemp(prefix="capturemock"), "server")
+
+def removeUnixSocketPath(serverAddress):
+    if not isinstance(serverAddress, tuple):
+        shutil.rmtree(os.path.dirname(serverAddress), ignore_errors=True)
+
 
 class ClassicTrafficServer(TCPServer):
     def __init__(self, addrinfo, useThreads):
+        if not isinstance(addrinfo, tuple):
+            self.address_family = socket.AF_UNIX
         TCPServer.__init__(self, addrinfo, TrafficRequestHandler)
         self.useThreads = useThreads
         self.terminate = False
         self.requestCount = 0
+        self.requestLock = threading.Lock()
 
     def run(self):
         while not self.terminate:
@@ -96,16 +174,22 @@ class ClassicTrafficServer(TCPServer):
         for t in threading.enumerate():
             if t.getName() == "request":
                 t.join()
+        self.server_close()
+        removeUnixSocketPath(self.server_address)
 
     @classmethod
     def sendTerminateMessage(cls, serverAddressStr):
-        host, port = serverAddressStr.split(":")
-        cls._sendTerminateMessage((host, int(port)))
+        serverAddressStr, sessionId = ServerDaemon.splitSessionAddress(serverAddressStr)
+        serverAddress = parseAddress(serverAddressStr)
+        if sessionId:
+            # Wait for the daemon to say it's done, so the session's files are all written when we return
+            ServerDaemon.sendSessionMessage(serverAddress, sessionId, "TERMINATE_SERVER\n")
+        else:
+            cls._sendTerminateMessage(serverAddress)
 
     @staticmethod
     def _sendTerminateMessage(serverAddress):
-        sendSocket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        sendSocket.connect(serverAddress)
+        sendSocket = connectSocket(serverAddress)
         sendSocket.sendall("TERMINATE_SERVER\n".encode())
         sendSocket.shutdown(2)
 
@@ -136,19 +220,28 @@ class ClassicTrafficServer(TCPServer):
             self.handle_error(request, client_address)
             self.close_request(request)
 
+    def getNextRequestNumber(self):
+        # Framed connections can send further requests, which are numbered from their own threads
+        with self.requestLock:
+            self.requestCount += 1
+            return self.requestCount
+
+    def getLatestRequestNumber(self):
+        with self.requestLock:
+            return self.requestCount
+
     def process_request(self, request, client_address):
-        self.requestCount += 1
+        requestCount = self.getNextRequestNumber()
         if self.useThreads:
             """Start a new thread to process the request."""
             t = threading.Thread(target = self.process_request_thread, name="request",
-                                 args = (request, client_address, self.requestCount))
+                                 args = (request, client_address, requestCount))
             t.start()
         else:
-            self.process_request_thread(request, client_address, self.requestCount)
+            self.process_request_thread(request, client_address, requestCount)
 
     def getAddress(self):
-        host, port = self.socket.getsockname()
-        return host + ":" + str(port)
+        return makeAddressString(self.socket.getsockname())
 
 class XmlRpcTrafficServer(SimpleXMLRPCServer):
     def run(self):
@@ -184,15 +277,17 @@ class XmlRpcDispatchInstance:
     def _dispatch(self, method, binparams):
         params = tuple([ self.convertBytes(param) for param in binparams ])
         try:
-            self.dispatcher.diag.info("Received XMLRPC traffic " + method + repr(params))
+            self.dispatcher.diag.info("Received XMLRPC traffic %s%r", method, params)
             XmlRpcDispatchInstance.requestCount += 1
             if method == "shutdownCaptureMockServer":
                 self.dispatcher.server.setShutdownFlag()
                 return ""
-            elif method == "setServerLocation":
+            startTime = self.dispatcher.statistics.start()
+            if method == "setServerLocation":
                 traffic = clientservertraffic.XmlRpcServerStateTraffic(params[0])
             else:
                 traffic = clientservertraffic.XmlRpcClientTraffic(method=method, params=params, rcHandler=self.dispatcher.rcHandler)
+            self.dispatcher.statistics.add(traffic, "parse", startTime)
             responses = self.dispatcher.process(traffic, self.requestCount)
             return responses[0].getXmlRpcResponse() if responses else ""
         except Fault:
@@ -206,14 +301,18 @@ class XmlRpcDispatchInstance:
             return ""
 
 class ServerDispatcher:
-    def __init__(self, options):
+    sessionClasses = {}
+    def __init__(self, options, server=None):
         rcFiles = options.rcfiles.split(",") if options.rcfiles else []
         self.rcHandler = config.RcFileHandler(rcFiles)
-        self.diag = self.rcHandler.setUpLogging("Server")
+        self.diag = self.setUpLogging()
         self.filesToIgnore = self.rcHandler.getList("ignore_edits", [ "command line" ])
         self.useThreads = self.rcHandler.getboolean("server_multithreaded", [ "general" ], True)
         self.replayInfo = ReplayInfo(options.mode, options.replay, self.rcHandler)
-        self.recordFileHandler = RecordFileHandler(options.record)
+        self.recordFileHandler = RecordFileHandler(options.record, self.rcHandler)
+        self.configureEvalCache()
+        self.getSessionClass(fileedittraffic.FileEditTraffic).configureStore(self.rcHandler)
+        self.statistics = TrafficStatistics(self.rcHandler)
         self.topLevelForEdit = [] # contains only paths explicitly given. Always present.
         self.fileEditData = OrderedDict() # contains all paths, including subpaths of the above. Empty when replaying.
         self.terminate = False
@@ -221,22 +320,44 @@ class ServerDispatcher:
         # Default value of 5 isn't very much...
         # There doesn't seem to be any disadvantage of allowing a longer queue, so we will increase it by a lot...
         self.request_queue_size = 500
-        self.server = self.makeServer()
-        sys.stdout.write(self.server.getAddress() + "\n") # Tell our caller, so they can tell the program being handled
-        sys.stdout.flush()
+        if server is None:
+            self.server = self.makeServer()
+            sys.stdout.write(self.server.getAddress() + "\n") # Tell our caller, so they can tell the program being handled
+            sys.stdout.flush()
+        else:
+            self.server = server
+
+    def setUpLogging(self):
+        return self.rcHandler.setUpLogging("Server")
+
+    def configureEvalCache(self):
+        evalCache.configure(self.rcHandler)
 
     def makeServer(self):
         protocol = self.rcHandler.get("server_protocol", [ "general" ], "classic")
-        ipAddress = self.getIpAddress()
-        if protocol == "classic":
-            TrafficRequestHandler.dispatcher = self
-            return ClassicTrafficServer((ipAddress, 0), TrafficRequestHandler)
-        elif protocol == "xmlrpc":
-            server = XmlRpcTrafficServer((ipAddress, 0), logRequests=False, use_builtin_types=True)
+        if protocol == "xmlrpc":
+            server = XmlRpcTrafficServer((self.getIpAddress(), 0), logRequests=False, use_builtin_types=True)
             server.register_instance(XmlRpcDispatchInstance(self))
             return server
 
-    def getIpAddress(self):
+        address = self.getServerAddress(self.rcHandler)
+        if protocol == "classic":
+            TrafficRequestHandler.dispatcher = self
+            return ClassicTrafficServer(address, TrafficRequestHandler)
+        elif protocol == "asyncio":
+            from capturemock.asyncioserver import AsyncioTrafficServer
+            return AsyncioTrafficServer(address, self, self.useThreads)
+
+    @classmethod
+    def getServerAddress(cls, rcHandler):
+        # Unix domain sockets only work locally, but they're quicker and don't need to look anything up
+        if rcHandler.get("server_transport", [ "general" ], "tcp") == "unix":
+            return makeUnixSocketPath()
+        else:
+            return cls.getIpAddress(), 0
+
+    @staticmethod
+    def getIpAddress():
         try:
             # Doesn't always work, sometimes not available
             return socket.gethostbyname(socket.gethostname())
@@ -247,12 +368,20 @@ class ServerDispatcher:
     def run(self):
         self.diag.debug("Starting capturemock server")
         self.server.run()
+        self.recordFileHandler.close()
+        self.diag.info(evalCache.getStatistics())
+        self.writeStatistics(self.statistics.fileName)
         self.diag.debug("Shut down capturemock server")
         
     def shutdown(self):
         self.diag.debug("Told to shut down!")
         self.server.shutdown()
 
+    def writeStatistics(self, fileName):
+        if self.statistics.enabled:
+            self.diag.info("%s", self.statistics.getSummary())
+            self.statistics.write(fileName)
+
     def findFilesAndLinks(self, path):
         if not os.path.exists(path):
             return []
@@ -276,14 +405,16 @@ class ServerDispatcher:
         return paths
 
     def getLatestModification(self, path):
-        if os.path.exists(path):
+        try:
             statObj = os.stat(path)
-            return statObj[stat.ST_MTIME], statObj[stat.ST_SIZE]
-        else:
+        except OSError: # doesn't exist, or is a broken link
             return None, 0
+        return statObj[stat.ST_MTIME], statObj[stat.ST_SIZE]
 
     def addPossibleFileEdits(self, traffic):
         allEdits = traffic.findPossibleFileEdits()
+        startTime = self.statistics.start() if allEdits else None
+        debug = self.diag.isEnabledFor(logging.DEBUG)
         topLevelForEdit = copy(self.topLevelForEdit)
         fileEditData = copy(self.fileEditData)
         for file in allEdits:
@@ -297,16 +428,24 @@ class ServerDispatcher:
                 for subPath in self.findFilesAndLinks(file):
                     modTime, modSize = self.getLatestModification(subPath)
                     fileEditData[subPath] = modTime, modSize
-                    self.diag.debug("Adding possible sub-path edit for " + subPath + " with mod time " +
-                                   time.strftime("%d%b%H:%M:%S", time.localtime(modTime)) + " and size " + str(modSize))
+                    if debug:
+                        self.diag.debug("Adding possible sub-path edit for %s with mod time %s and size %s", subPath,
+                                        time.strftime("%d%b%H:%M:%S", time.localtime(modTime)), modSize)
+        self.statistics.add(traffic, "file edit scan", startTime)
         return topLevelForEdit, fileEditData
 
     def processText(self, text, wfile, reqNo):
-        self.diag.debug("Request text : " + text)
+        self.diag.debug("Request text : %s", text)
         if text.startswith("TERMINATE_SERVER"):
             self.shutdown()
+        elif text.startswith(TrafficStatistics.queryId):
+            wfile.write(self.statistics.getText().encode())
+            # Not recorded, but it has a number, and the requests after it can't be written until it's done
+            self.recordFileHandler.requestComplete(reqNo)
         else:
+            startTime = self.statistics.start()
             traffic = self.parseTraffic(text, wfile)
+            self.statistics.add(traffic, "parse", startTime)
             self.process(traffic, reqNo)
             self.diag.debug("Finished processing incoming request")
 
@@ -329,16 +468,20 @@ class ServerDispatcher:
         return responses
 
     def _process(self, traffic, reqNo):
-        self.diag.debug("Processing traffic " + traffic.__class__.__name__)
+        debug = self.diag.isEnabledFor(logging.DEBUG)
+        if debug:
+            self.diag.debug("Processing traffic %s", traffic.__class__.__name__)
         topLevelForEdit, fileEditData = self.addPossibleFileEdits(traffic)
         responses = self.getResponses(traffic, topLevelForEdit, fileEditData)
-        traffic.record(self.recordFileHandler, reqNo)
+        self.recordTraffic(traffic, reqNo)
         for response in responses:
-            self.diag.debug("Response of type " + response.__class__.__name__ + " with text " + repr(response.text))
-            response.record(self.recordFileHandler, reqNo)
-            for chainResponse in response.forwardToDestination():
+            if debug:
+                self.diag.debug("Response of type %s with text %r", response.__class__.__name__, response.text)
+            self.recordTraffic(response, reqNo)
+            for chainResponse in self.forwardToDestination(response):
                 self._process(chainResponse, reqNo)
-            self.diag.debug("Completed response of type " + response.__class__.__name__)
+            if debug:
+                self.diag.debug("Completed response of type %s", response.__class__.__name__)
         self.hasAsynchronousEdits |= traffic.makesAsynchronousEdits()
         if self.hasAsynchronousEdits:
             # Unless we've marked it as asynchronous we start again for the next traffic.
@@ -348,16 +491,31 @@ class ServerDispatcher:
             self.fileEditData.update(fileEditData)
         return responses
 
+    def recordTraffic(self, traffic, reqNo):
+        startTime = self.statistics.start()
+        traffic.record(self.recordFileHandler, reqNo)
+        self.statistics.add(traffic, "record write", startTime)
+
+    def forwardToDestination(self, traffic):
+        startTime = self.statistics.start()
+        responses = traffic.forwardToDestination()
+        self.statistics.add(traffic, "forward", startTime)
+        return responses
+
     def getTrafficClasses(self, incoming):
         classes = []
         # clientservertraffic must be last, it's the fallback option
         for mod in [ commandlinetraffic, fileedittraffic, customtraffic, self.server ]:
             classes += mod.getTrafficClasses(incoming)
-        return classes
+        return list(map(self.getSessionClass, classes))
+
+    def getSessionClass(self, cls):
+        return self.sessionClasses.get(cls, cls)
 
     def getResponses(self, traffic, topLevelForEdit, fileEditData):
         if self.replayInfo.isActiveFor(traffic):
             self.diag.debug("Replay active for current command")
+            startTime = self.statistics.start()
             replayedResponses = []
             filesMatched = []
             responseClasses = self.getTrafficClasses(incoming=False)
@@ -365,9 +523,10 @@ class ServerDispatcher:
                 responseTraffic = self.makeResponseTraffic(traffic, responseClass, text, filesMatched, topLevelForEdit)
                 if responseTraffic:
                     replayedResponses.append(responseTraffic)
+            self.statistics.add(traffic, "replay lookup", startTime)
             return traffic.filterReplay(replayedResponses)
         else:
-            trafficResponses = traffic.forwardToDestination()
+            trafficResponses = self.forwardToDestination(traffic)
             if topLevelForEdit: # Only if the traffic itself can produce file edits do we check here
                 return self.getLatestFileEdits(topLevelForEdit, fileEditData) + trafficResponses
             else:
@@ -389,7 +548,7 @@ class ServerDispatcher:
                 break
             else:
                 matchScore = self.getFileMatchScore(fileName, editedName)
-                self.diag.debug("Trying " + editedName + " vs " + fileName + " got score " + str(matchScore))
+                self.diag.debug("Trying %s vs %s got score %s", editedName, fileName, matchScore)
                 if matchScore > bestScore:
                     bestMatch, bestScore = editedFile, matchScore
 
@@ -411,17 +570,17 @@ class ServerDispatcher:
         return score
 
     def makeResponseTraffic(self, traffic, responseClass, text, filesMatched, topLevelForEdit):
-        if responseClass is fileedittraffic.FileEditTraffic:
+        if issubclass(responseClass, fileedittraffic.FileEditTraffic):
             fileName = text.strip()
-            self.diag.debug("Looking up file edit data for " + repr(fileName)) 
-            storedFile, fileType = fileedittraffic.FileEditTraffic.getFileWithType(fileName)
+            self.diag.debug("Looking up file edit data for %r", fileName)
+            storedFile, fileType = responseClass.getFileWithType(fileName)
             if storedFile:
-                self.diag.debug("Found file " + repr(storedFile) + " of type " + fileType)
+                self.diag.debug("Found file %r of type %s", storedFile, fileType)
                 editedFile = self.getFileBeingEdited(fileName, fileType, filesMatched, topLevelForEdit)
                 if editedFile:
-                    self.diag.debug("Will use it to edit file at " + str(editedFile))
+                    self.diag.debug("Will use it to edit file at %s", editedFile)
                     changedPaths = self.findFilesAndLinks(storedFile)
-                    return fileedittraffic.FileEditTraffic(fileName, editedFile, storedFile, changedPaths, reproduce=True)
+                    return responseClass(fileName, editedFile, storedFile, changedPaths, reproduce=True)
         else:
             return responseClass(text, traffic.responseFile, self.rcHandler)
 
@@ -437,37 +596,186 @@ class ServerDispatcher:
     def getLatestFileEdits(self, topLevelForEdit, fileEditData):
         traffic = []
         removedPaths = []
-        self.diag.debug("Getting latest file edits " + repr(topLevelForEdit))
+        if not topLevelForEdit:
+            return traffic
+
+        startTime = self.statistics.start()
+        debug = self.diag.isEnabledFor(logging.DEBUG)
+        self.diag.debug("Getting latest file edits %r", topLevelForEdit)
         for file in topLevelForEdit:
-            self.diag.debug("Looking for file edits under " + file)
+            self.diag.debug("Looking for file edits under %s", file)
             changedPaths = []
             newPaths = self.findFilesAndLinks(file)
             for subPath in newPaths:
                 newEditInfo = self.getLatestModification(subPath)
-                self.diag.debug("Found subpath " + subPath + " edit info " + repr(newEditInfo))
+                if debug:
+                    self.diag.debug("Found subpath %s edit info %r", subPath, newEditInfo)
                 if newEditInfo != fileEditData.get(subPath):
                     changedPaths.append(subPath)
                     fileEditData[subPath] = newEditInfo
 
+            # Sets for the membership tests, the lists keep the order for the traffic
+            newPathSet = set(newPaths)
+            changedPathSet = set(changedPaths)
+            prefix = file + os.sep
             for oldPath in fileEditData.keys():
-                if (oldPath == file or oldPath.startswith(file + os.sep)) and oldPath not in newPaths:
+                if (oldPath == file or oldPath.startswith(prefix)) and oldPath not in newPathSet:
                     removedPath = self.findRemovedPath(oldPath)
-                    self.diag.debug("Deletion of " + oldPath + "\n - registering " + removedPath)
+                    self.diag.debug("Deletion of %s\n - registering %s", oldPath, removedPath)
                     removedPaths.append(oldPath)
-                    if removedPath not in changedPaths:
+                    if removedPath not in changedPathSet:
                         changedPaths.append(removedPath)
+                        changedPathSet.add(removedPath)
 
             if len(changedPaths) > 0:
-                traffic.append(fileedittraffic.FileEditTraffic.makeRecordedTraffic(file, changedPaths))
+                fileEditClass = self.getSessionClass(fileedittraffic.FileEditTraffic)
+                traffic.append(fileEditClass.makeRecordedTraffic(file, changedPaths))
 
         for path in removedPaths:
             if path in fileEditData:
                 del fileEditData[path]
 
         self.diag.debug("Done getting latest file edits.")
+        self.statistics.add("FileEditTraffic", "file edit scan", startTime)
         return traffic
 
 
+class ServerSession(ServerDispatcher):
+    """ The traffic of one test, handled by a long-lived daemon rather than a server process of its own """
+    def __init__(self, sessionId, options, daemon):
+        self.sessionId = sessionId
+        self.daemon = daemon
+        cmdClass = commandlinetraffic.CommandLineTraffic
+        fileEditClass = fileedittraffic.FileEditTraffic
+        self.sessionClasses = { cmdClass : cmdClass.makeSessionClass(options.environment, options.sut_directory),
+                                fileEditClass : fileEditClass.makeSessionClass(options) }
+        ServerDispatcher.__init__(self, options, daemon.server)
+
+    def setUpLogging(self):
+        # Configuring logging again would disturb the other sessions, which are logging at the same time
+        self.rcHandler.diag = self.daemon.diag
+        return self.daemon.diag
+
+    def configureEvalCache(self):
+        pass # Shared by all sessions, the daemon configures it
+
+    def startRecordingAt(self, reqNo):
+        self.recordFileHandler.recordingRequest = reqNo
+
+    def skipRequest(self, reqNo):
+        self.recordFileHandler.skipRequest(reqNo)
+
+    def processSessionText(self, text, wfile, reqNo):
+        if text.startswith("TERMINATE_SERVER"):
+            self.shutdown()
+            wfile.write("CAPTUREMOCK SESSION CLOSED".encode())
+        else:
+            self.processText(text, wfile, reqNo)
+
+    def shutdown(self):
+        self.diag.debug("Closing session %s", self.sessionId)
+        self.recordFileHandler.close()
+        if self.statistics.fileName:
+            # Sessions may well share an rc file, don't let them overwrite each other's statistics
+            self.writeStatistics(self.statistics.fileName + "." + self.sessionId)
+        self.daemon.removeSession(self.sessionId)
+
+
+class ServerDaemon:
+    """ Serves many independent sessions, so that tests don't need to pay for starting a server each time """
+    sessionStartId = "SUT_SESSION_START"
+    sessionId = "SUT_SESSION"
+    sessionSeparator = "#"
+    def __init__(self, options):
+        rcFiles = options.rcfiles.split(",") if options.rcfiles else []
+        self.rcHandler = config.RcFileHandler(rcFiles)
+        self.diag = self.rcHandler.setUpLogging("Server")
+        evalCache.configure(self.rcHandler)
+        self.sessions = {}
+        self.sessionCount = 0
+        self.sessionLock = threading.Lock()
+        TrafficRequestHandler.dispatcher = self
+        self.server = ClassicTrafficServer(ServerDispatcher.getServerAddress(self.rcHandler), TrafficRequestHandler)
+        sys.stdout.write(self.server.getAddress() + "\n")
+        sys.stdout.flush()
+
+    @classmethod
+    def splitSessionAddress(cls, serverAddressStr):
+        if cls.sessionSeparator in serverAddressStr:
+            return serverAddressStr.split(cls.sessionSeparator, 1)
+        else:
+            return serverAddressStr, None
+
+    @staticmethod
+    def sendAndRead(serverAddress, text):
+        sendSocket = connectSocket(serverAddress)
+        sendSocket.sendall(text.encode())
+        sendSocket.shutdown(socket.SHUT_WR)
+        response = sendSocket.makefile().read()
+        sendSocket.close()
+        return response
+
+    @classmethod
+    def sendSessionMessage(cls, serverAddress, sessionId, text):
+        return cls.sendAndRead(serverAddress, cls.sessionId + ":" + sessionId + ":SUT_SEP:" + text)
+
+    @classmethod
+    def sendSessionStartMessage(cls, daemonAddressStr, options):
+        return cls.sendAndRead(parseAddress(daemonAddressStr), cls.sessionStartId + ":" + repr(options))
+
+    def run(self):
+        self.diag.debug("Starting capturemock daemon")
+        self.server.run()
+        for session in list(self.sessions.values()):
+            session.shutdown()
+        self.diag.debug("Shut down capturemock daemon")
+
+    def shutdown(self):
+        self.diag.debug("Told to shut down!")
+        self.server.shutdown()
+
+    def processText(self, text, wfile, reqNo):
+        sessionId, session = None, None
+        if text.startswith(self.sessionId + ":"):
+            sessionId, sessionText = text[len(self.sessionId) + 1:].split(":SUT_SEP:", 1)
+        with self.sessionLock:
+            if sessionId:
+                session = self.sessions.get(sessionId)
+            # Request numbers come from the order requests were accepted, the same for all sessions.
+            # Each session's record file is written in that order, and needs to know which numbers it won't see.
+            for otherSession in self.sessions.values():
+                if otherSession is not session:
+                    otherSession.skipRequest(reqNo)
+
+        if session:
+            session.processSessionText(sessionText, wfile, reqNo)
+        elif sessionId:
+            self.diag.debug("Ignoring request for unknown session %s", sessionId)
+        elif text.startswith(self.sessionStartId + ":"):
+            self.openSession(text[len(self.sessionStartId) + 1:], wfile)
+        elif text.startswith("TERMINATE_SERVER"):
+            self.shutdown()
+
+    def openSession(self, optionText, wfile):
+        from ast import literal_eval
+        from optparse import Values
+        options = Values(literal_eval(optionText))
+        with self.sessionLock:
+            self.sessionCount += 1
+            sessionId = str(self.sessionCount)
+        session = ServerSession(sessionId, options, self)
+        with self.sessionLock:
+            # Nobody knows about the session yet, so its requests can only be among those accepted from now on
+            session.startRecordingAt(self.server.getLatestRequestNumber() + 1)
+            self.sessions[sessionId] = session
+        self.diag.debug("Opened session %s", sessionId)
+        wfile.write((self.server.getAddress() + self.sessionSeparator + sessionId).encode())
+
+    def removeSession(self, sessionId):
+        with self.sessionLock:
+            self.sessions.pop(sessionId, None)
+
+
 class TrafficRequestHandler(StreamRequestHandler):
     dispatcher = None
     def __init__(self, requestNumber, *args):
@@ -476,59 +784,56 @@ class TrafficRequestHandler(StreamRequestHandler):
 
     def handle(self):
         self.dispatcher.diag.debug("Received incoming request...")
-        text = self.rfile.read().decode()
+        start = self.rfile.read(len(framing.MAGIC))
+        if start == framing.MAGIC:
+            self.handleFramedRequests()
+        else:
+            text = (start + self.rfile.read()).decode()
+            self.processText(text, self.wfile, self.requestNumber)
+
+    def handleFramedRequests(self):
+        requestNumber = self.requestNumber
+        try:
+            request = framing.readRequest(self.rfile.read)
+            while request is not None:
+                responseFile = framing.FramedResponseFile(self.wfile)
+                self.processText(request.decode(), responseFile, requestNumber)
+                responseFile.close()
+                request = framing.readRequest(self.rfile.read)
+                if request is not None:
+                    requestNumber = self.server.getNextRequestNumber()
+        except socket.error:
+            pass # The system under test has died or is otherwise unresponsive
+
+    def processText(self, text, responseFile, requestNumber):
         try:
-            self.dispatcher.processText(text, self.wfile, self.requestNumber)
+            self.dispatcher.processText(text, responseFile, requestNumber)
         except config.CaptureMockReplayError as e:
-            self.wfile.write(("CAPTUREMOCK MISMATCH: " + str(e)).encode())
+            responseFile.write(("CAPTUREMOCK MISMATCH: " + str(e)).encode())
 
 # The basic point here is to make sure that traffic appears in the record
 # file in the order in which it comes in, not in the order in which it completes (which is indeterministic and
 # may be wrong next time around)
-class RecordFileHandler(recordfilehandler.RecordFileHandler):
-    def __init__(self, file):
-        super(RecordFileHandler, self).__init__(file)
-        self.recordingRequest = 1
-        self.cache = {}
-        self.completedRequests = []
-        self.lock = threading.Lock()
-
-    def requestComplete(self, requestNumber):
-        self.lock.acquire()
-        if requestNumber == self.recordingRequest:
-            self.recordingRequestComplete()
-        else:
-            self.completedRequests.append(requestNumber)
-        self.lock.release()
-
-    def writeFromCache(self):
-        text = self.cache.get(self.recordingRequest)
-        if text:
-            super(RecordFileHandler, self).record(text)
-            del self.cache[self.recordingRequest]
+class RecordFileHandler(recordfilehandler.OrderedRecordFileHandler):
+    def __init__(self, file, rcHandler):
+        super(RecordFileHandler, self).__init__(file, rcHandler)
+        self.flushOnRequest = rcHandler.getboolean("record_flush_on_request", [ "general" ], False)
 
     def recordingRequestComplete(self):
-        self.writeFromCache()
-        self.recordingRequest += 1
-        if self.recordingRequest in self.completedRequests:
-            self.recordingRequestComplete()
-
-    def record(self, text, requestNumber):
-        self.lock.acquire()
-        if requestNumber == self.recordingRequest:
-            self.writeFromCache()
-            super(RecordFileHandler, self).record(text)
-        else:
-            self.cache.setdefault(requestNumber, "")
-            self.cache[requestNumber] += text
-        self.lock.release()
+        super(RecordFileHandler, self).recordingRequestComplete()
+        if self.buffered and self.flushOnRequest:
+            self.flush()
 
 
 if __name__ == "__main__":
     parser = cmdlineutils.create_option_parser()
+    parser.add_option("--daemon", action="store_true",
+                      help="run as a daemon serving many sessions, each with their own files and mode")
     options = parser.parse_args()[0] # no positional arguments
 
-    fileedittraffic.FileEditTraffic.configure(options)
-
-    server = ServerDispatcher(options)
+    if options.daemon:
+        server = ServerDaemon(options)
+    else:
+        fileedittraffic.FileEditTraffic.configure(options)
+        server = ServerDispatcher(options)
     server.run()
@@ -3,6 +3,7 @@
 import re
 import os
 import sys
+import weakref
 
 from pprint import pformat
 try:
@@ -10,39 +11,65 @@ try:
 except ImportError:
     from ordereddict import OrderedDict
 
+class AlterationReplacer:
+    def __init__(self, traffic, repl):
+        self.traffic = traffic
+        self.repl = repl
+
+    def __call__(self, match):
+        if self.repl.startswith("$"):
+            return self.traffic.storeAlterationVariable(self.repl, match.group(0))
+        else:
+            return match.expand(self.repl)
+
+
+class AlterationCompiler:
+    """ Reading and compiling the alterations from the rc file is done once for each set of sections,
+    and the result shared by all traffic objects using it """
+    def __init__(self):
+        self.cache = weakref.WeakKeyDictionary()
+
+    def getAlterations(self, rcHandler, sectionNames):
+        rcCache = self.cache.setdefault(rcHandler, {})
+        key = tuple(sectionNames)
+        alterations = rcCache.get(key)
+        if alterations is None:
+            alterations = self.compileAlterations(rcHandler, sectionNames)
+            rcCache[key] = alterations
+        return alterations
+
+    @staticmethod
+    def compileAlterations(rcHandler, sectionNames):
+        alterations = OrderedDict()
+        for alterStr in rcHandler.getList("alterations", sectionNames):
+            toFind = os.path.expandvars(rcHandler.get("match_pattern", [ alterStr ]))
+            toReplace = rcHandler.get("replacement", [ alterStr ])
+            if toFind and toReplace is not None:
+                alterations[re.compile(toFind)] = toReplace
+        # Stored in the order they are applied in
+        return tuple(reversed(list(alterations.items())))
+
+
 class BaseTraffic(object):
     alterationVariables = OrderedDict()
+    alterationCompiler = AlterationCompiler()
     def __init__(self, text, rcHandler=None):
         self.text = text
-        self.alterations = {}
+        self.alterations = ()
         if rcHandler:
             self.diag = rcHandler.diag
-            for alterStr in rcHandler.getList("alterations", self.getAlterationSectionNames()):
-                toFind = os.path.expandvars(rcHandler.get("match_pattern", [ alterStr ]))
-                toReplace = rcHandler.get("replacement", [ alterStr ])
-                if toFind and toReplace is not None:
-                    self.alterations[re.compile(toFind)] = toReplace
+            self.alterations = self.alterationCompiler.getAlterations(rcHandler, self.getAlterationSectionNames())
 
     def applyAlterations(self, text):
         return self._applyAlterations(text, self.alterations)
 
     def applyAlterationVariables(self, text):
-        return self._applyAlterations(text, self.alterationVariables)
+        # Reverse it for the alteration variables, we may add newer ones as we go along, want to check those first...
+        return self._applyAlterations(text, reversed(list(self.alterationVariables.items())))
 
     def _applyAlterations(self, text, alterations):
-        class AlterationReplacer:
-            def __init__(rself, repl): #@NoSelf
-                rself.repl = repl
-
-            def __call__(rself, match): #@NoSelf
-                if rself.repl.startswith("$"):
-                    return self.storeAlterationVariable(rself.repl, match.group(0))
-                else:
-                    return match.expand(rself.repl)
-
-        # Reverse it for the alteration variables, we may add newer ones as we go along, want to check those first...
-        for regex, repl in reversed(list(alterations.items())):
-            text = regex.sub(AlterationReplacer(repl), text)
+        for regex, repl in alterations:
+            text = regex.sub(AlterationReplacer(self, repl), text)
         return text
 
     @staticmethod
@@ -61,7 +88,7 @@ class BaseTraffic(object):
             replText = self.findNextNameCandidate(replText)
             regex = re.compile(replText.replace("$", "\\$"))
 
-        self.diag.info("Adding alteration variable for " + replText + " = " + matched)
+        self.diag.info("Adding alteration variable for %s = %s", replText, matched)
         self.alterationVariables[regex] = matched
         return replText
 
@@ -126,14 +153,27 @@ class Traffic(BaseTraffic):
         self.responseFile = responseFile
 
     def write(self, message):
-        from socket import error
         if self.responseFile:
-            try:
-                self.responseFile.write(message.encode())
-            except error:
-                # The system under test has died or is otherwise unresponsive
-                # Should handle this, probably. For now, ignoring it is better than stack dumps
-                pass
+            self.sendResponse(self.responseFile.write, message.encode())
+
+    def writeField(self, message, separator="|TT_CMD_SEP|"):
+        # For responses made up of several fields. Framed connections send each field marked with its type,
+        # the original protocol relies on separators between them
+        if hasattr(self.responseFile, "writeField"):
+            self.sendResponse(self.responseFile.writeField, self.typeId.encode(), message.encode())
+        else:
+            self.write(message)
+            if separator:
+                self.write(separator)
+
+    def sendResponse(self, method, *args):
+        from socket import error
+        try:
+            method(*args)
+        except error:
+            # The system under test has died or is otherwise unresponsive
+            # Should handle this, probably. For now, ignoring it is better than stack dumps
+            pass
 
     def forwardToDestination(self):
         self.write(self.text)
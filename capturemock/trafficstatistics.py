@@ -0,0 +1,74 @@
+""" Counts and timings of what the server does with each kind of traffic, collected only when asked for """
+
+import threading, time, json
+
+# perf_counter is much finer-grained where it exists
+timer = getattr(time, "perf_counter", time.time)
+
+class StageStatistics:
+    """ Count, total, maximum and a histogram of the times taken, in buckets of powers of two microseconds """
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.maximum = 0.0
+        self.buckets = []
+
+    def add(self, seconds):
+        self.count += 1
+        self.total += seconds
+        self.maximum = max(self.maximum, seconds)
+        bucket = int(seconds * 1000000).bit_length() # 0 for under a microsecond, n for under 2**n
+        if bucket >= len(self.buckets):
+            self.buckets += [ 0 ] * (bucket + 1 - len(self.buckets))
+        self.buckets[bucket] += 1
+
+    def toDict(self):
+        return { "count" : self.count,
+                 "total_seconds" : round(self.total, 6),
+                 "max_seconds" : round(self.maximum, 6),
+                 "histogram" : [ [ 2 ** bucket, count ] for bucket, count in enumerate(self.buckets) if count ] }
+
+
+class TrafficStatistics:
+    """ Statistics for each traffic class and stage of processing: parse, replay lookup, forward,
+    file edit scan and record write. When not enabled, start returns None and add does nothing,
+    so the server only pays for a couple of function calls """
+    queryId = "SUT_STATISTICS"
+    def __init__(self, rcHandler):
+        self.fileName = rcHandler.get("statistics_file", [ "general" ])
+        self.enabled = rcHandler.getboolean("collect_statistics", [ "general" ], self.fileName is not None)
+        self.stages = {}
+        self.lock = threading.Lock()
+
+    def start(self):
+        if self.enabled:
+            return timer()
+
+    def add(self, traffic, stage, startTime):
+        if startTime is None:
+            return
+        seconds = timer() - startTime
+        key = traffic if isinstance(traffic, str) else traffic.__class__.__name__
+        with self.lock:
+            stages = self.stages.setdefault(key, {})
+            if stage not in stages:
+                stages[stage] = StageStatistics()
+            stages[stage].add(seconds)
+
+    def getText(self):
+        with self.lock:
+            data = dict((key, dict((stage, stats.toDict()) for stage, stats in stages.items()))
+                        for key, stages in self.stages.items())
+        return json.dumps(data, indent=2, sort_keys=True) + "\n"
+
+    def getSummary(self):
+        with self.lock:
+            return "Traffic statistics: " + ", ".join(key + " " + stage + " " + str(stats.count) + " in " + \
+                                                      str(round(stats.total, 3)) + "s"
+                                                      for key, stages in sorted(self.stages.items())
+                                                      for stage, stats in sorted(stages.items()))
+
+    def write(self, fileName):
+        if self.enabled and fileName:
+            with open(fileName, "w") as f:
+                f.write(self.getText())
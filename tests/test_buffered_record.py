@@ -0,0 +1,100 @@
+""" Buffered record files end up the same as unbuffered ones, including traffic rewritten when instances are renamed """
+
+import os, sys, shutil, tempfile, subprocess, unittest
+
+packageDir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, packageDir)
+import capturemock
+
+moduleText = """
+class Widget(object):
+    def setName(self, name):
+        self.name = name
+    def getName(self):
+        return self.name
+"""
+
+expectedPython = """<-PYT:import widgets
+<-PYT:widgets.Widget()
+->RET:Instance('Widget', 'widget_main')
+<-PYT:widget_main.setName('main')
+<-PYT:widget_main.getName()
+->RET:'main'
+<-PYT:widgets.Widget()
+->RET:Instance('Widget', 'widget_other')
+<-PYT:widget_other.setName('other')
+"""
+
+class BufferedRecordTest(unittest.TestCase):
+    def setUp(self):
+        self.tmpDir = tempfile.mkdtemp()
+        with open(os.path.join(self.tmpDir, "widgets.py"), "w") as f:
+            f.write(moduleText)
+        self.rcFile = os.path.join(self.tmpDir, "capturemockrc")
+        sys.path.insert(0, self.tmpDir)
+
+    def tearDown(self):
+        sys.path.remove(self.tmpDir)
+        sys.modules.pop("widgets", None)
+        shutil.rmtree(self.tmpDir)
+
+    def writeRcFile(self, text):
+        with open(self.rcFile, "w") as f:
+            f.write(text)
+
+    def readFile(self, fileName):
+        with open(fileName) as f:
+            return f.read()
+
+    def useWidgets(self, mode, recordFile, replayFile=None):
+        interceptor = capturemock.interceptPython(mode, recordFile, replayFile, [ self.rcFile ], [])
+        try:
+            import widgets
+            # Naming them rewrites what was recorded since they were created
+            widget = widgets.Widget()
+            widget.setName("main")
+            self.assertEqual(widget.getName(), "main")
+            widgets.Widget().setName("other")
+        finally:
+            interceptor.resetIntercepts()
+            sys.modules.pop("widgets", None)
+
+    def checkPython(self, settings):
+        self.writeRcFile("[general]\n" + settings + "\n[python]\nintercepts = widgets\n")
+        recordFile = os.path.join(self.tmpDir, "record.mock")
+        self.useWidgets(capturemock.RECORD, recordFile)
+        self.assertEqual(self.readFile(recordFile), expectedPython)
+        replayRecordFile = os.path.join(self.tmpDir, "replay_record.mock")
+        self.useWidgets(capturemock.REPLAY, replayRecordFile, recordFile)
+        self.assertEqual(self.readFile(replayRecordFile), expectedPython)
+
+    def testPythonLargeBuffer(self):
+        self.checkPython("record_buffer_size = 1000000")
+
+    def testPythonSmallBuffer(self):
+        # Flushed in the middle of things
+        self.checkPython("record_buffer_size = 10")
+
+    def testPythonFlushInterval(self):
+        self.checkPython("record_flush_interval = 0.01")
+
+    @unittest.skipUnless(os.name == "posix", "intercepts echo as a POSIX command")
+    def testCommandLine(self):
+        self.writeRcFile("[general]\nrecord_buffer_size = 1000000\n[command line]\nintercepts = echo\n")
+        environment = dict(os.environ)
+        environment["PYTHONPATH"] = os.pathsep.join(filter(None, [ packageDir, os.getenv("PYTHONPATH") ]))
+        recordFile = os.path.join(self.tmpDir, "record.mock")
+        manager = capturemock.CaptureMockManager()
+        manager.startServer(capturemock.RECORD, recordFile, rcFiles=[ self.rcFile ],
+                            interceptDir=os.path.join(self.tmpDir, "intercepts"),
+                            sutDirectory=self.tmpDir, environment=environment)
+        try:
+            for text in [ "one", "two", "three" ]:
+                subprocess.check_call([ "echo", text ], env=environment, cwd=self.tmpDir, stdout=subprocess.PIPE)
+        finally:
+            manager.terminate()
+        self.assertEqual(self.readFile(recordFile), "<-CMD:echo one\n->OUT:one\n<-CMD:echo two\n->OUT:two\n<-CMD:echo three\n->OUT:three\n")
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,58 @@
+""" Repeated traffic is written once with a count, and replays as if it had all been written out """
+
+import os, sys, shutil, tempfile, subprocess, unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import capturemock
+
+@unittest.skipUnless(os.name == "posix", "intercepts echo as a POSIX command")
+class CompactRepeatsTest(unittest.TestCase):
+    def setUp(self):
+        self.tmpDir = tempfile.mkdtemp()
+        self.rcFile = os.path.join(self.tmpDir, "capturemockrc")
+        with open(self.rcFile, "w") as f:
+            f.write("[general]\ncompact_repeats = True\n[command line]\nintercepts = echo\n")
+        self.environment = dict(os.environ)
+        self.environment["PYTHONPATH"] = os.pathsep.join(filter(None, [ sys.path[0], os.getenv("PYTHONPATH") ]))
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpDir)
+
+    def runEchoes(self, mode, recordFile, replayFile=None):
+        manager = capturemock.CaptureMockManager()
+        manager.startServer(mode, recordFile, replayFile, rcFiles=[ self.rcFile ],
+                            interceptDir=os.path.join(self.tmpDir, "intercepts"),
+                            sutDirectory=self.tmpDir, environment=self.environment)
+        outputs = []
+        try:
+            for text in [ "same" ] * 4 + [ "other", "same" ]:
+                outputs.append(subprocess.check_output([ "echo", text ], env=self.environment, cwd=self.tmpDir))
+            # Not compacted while the server still has it open
+            with open(recordFile) as f:
+                self.assertNotIn("RPT", f.read())
+        finally:
+            manager.terminate()
+        return outputs
+
+    def readFile(self, fileName):
+        with open(fileName) as f:
+            return f.read()
+
+    def testRecordAndReplay(self):
+        recordFile = os.path.join(self.tmpDir, "record.mock")
+        self.runEchoes(capturemock.RECORD, recordFile)
+        compacted = "<-CMD:echo same\n->OUT:same\n<-RPT:3\n<-CMD:echo other\n->OUT:other\n<-CMD:echo same\n->OUT:same\n"
+        self.assertEqual(self.readFile(recordFile), compacted)
+
+        # So we can tell the replayed output from the real thing
+        replayed = compacted.replace("->OUT:same", "->OUT:replayed")
+        with open(recordFile, "w") as f:
+            f.write(replayed)
+        replayRecordFile = os.path.join(self.tmpDir, "replay_record.mock")
+        outputs = self.runEchoes(capturemock.REPLAY, replayRecordFile, recordFile)
+        self.assertEqual(outputs, [ b"replayed\n" ] * 4 + [ b"other\n", b"replayed\n" ])
+        self.assertEqual(self.readFile(replayRecordFile), replayed)
+
+
+if __name__ == "__main__":
+    unittest.main()
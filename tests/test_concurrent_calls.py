@@ -0,0 +1,87 @@
+""" Intercepted Python calls made from several threads at once record and replay the same way each time """
+
+import os, sys, shutil, tempfile, threading, time, unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import capturemock
+
+moduleText = """
+import time
+class Counter(object):
+    def __init__(self):
+        self.value = 0
+    def increment(self):
+        self.value += 1
+        return self.value
+calls = []
+def make():
+    # The first call is slow, so returns after the second
+    calls.append(None)
+    time.sleep(0.3 if len(calls) == 1 else 0)
+    return Counter()
+"""
+
+class ConcurrentCallsTest(unittest.TestCase):
+    def setUp(self):
+        self.tmpDir = tempfile.mkdtemp()
+        with open(os.path.join(self.tmpDir, "counters.py"), "w") as f:
+            f.write(moduleText)
+        self.rcFile = os.path.join(self.tmpDir, "capturemockrc")
+        with open(self.rcFile, "w") as f:
+            f.write("[python]\nintercepts = counters\nconcurrent_calls = True\n")
+        sys.path.insert(0, self.tmpDir)
+
+    def tearDown(self):
+        sys.path.remove(self.tmpDir)
+        sys.modules.pop("counters", None)
+        shutil.rmtree(self.tmpDir)
+
+    def runThreads(self, mode, recordFile, replayFile=None):
+        interceptor = capturemock.interceptPython(mode, recordFile, replayFile, [ self.rcFile ], [])
+        try:
+            import counters
+            results = {}
+            made = threading.Barrier(2) if hasattr(threading, "Barrier") else None
+            def work(name):
+                counter = counters.make()
+                if made:
+                    made.wait() # Both counters exist before either is used
+                results[name] = counter.increment()
+            firstThread = threading.Thread(target=work, args=("first",))
+            firstThread.start()
+            time.sleep(0.1)
+            secondThread = threading.Thread(target=work, args=("second",))
+            secondThread.start()
+            firstThread.join()
+            secondThread.join()
+            return results
+        finally:
+            interceptor.resetIntercepts()
+            sys.modules.pop("counters", None)
+
+    def readLines(self, fileName):
+        with open(fileName) as f:
+            return f.read().splitlines()
+
+    def testNamedInCallOrder(self):
+        recordFile = os.path.join(self.tmpDir, "record.mock")
+        self.assertEqual(self.runThreads(capturemock.RECORD, recordFile), { "first" : 1, "second" : 1 })
+        # Numbered after the calls that made them, not the order they came back in
+        self.assertEqual(self.readLines(recordFile)[:5], [ "<-PYT:import counters",
+                                                           "<-PYT:counters.make()",
+                                                           "->RET:Instance('Counter', 'counter3')",
+                                                           "<-PYT:counters.make()",
+                                                           "->RET:Instance('Counter', 'counter5')" ])
+
+    @unittest.skipUnless(hasattr(threading, "Barrier"), "needs threading.Barrier")
+    def testReplay(self):
+        recordFile = os.path.join(self.tmpDir, "record.mock")
+        self.runThreads(capturemock.RECORD, recordFile)
+        replayRecordFile = os.path.join(self.tmpDir, "replay_record.mock")
+        self.assertEqual(self.runThreads(capturemock.REPLAY, replayRecordFile, recordFile), { "first" : 1, "second" : 1 })
+        # The threads can use their counters in either order, but each must have a different one
+        self.assertEqual(sorted(self.readLines(replayRecordFile)), sorted(self.readLines(recordFile)))
+
+
+if __name__ == "__main__":
+    unittest.main()
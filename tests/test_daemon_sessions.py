@@ -0,0 +1,57 @@
+""" Sessions of a server daemon record and replay independently of each other, as separate servers would """
+
+import os, sys, shutil, tempfile, subprocess, unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import capturemock
+
+@unittest.skipUnless(os.name == "posix", "intercepts echo as a POSIX command")
+class DaemonSessionsTest(unittest.TestCase):
+    def setUp(self):
+        self.tmpDir = tempfile.mkdtemp()
+        self.rcFile = os.path.join(self.tmpDir, "capturemockrc")
+        with open(self.rcFile, "w") as f:
+            f.write("[command line]\nintercepts = echo\n")
+        self.environment = dict(os.environ)
+        self.environment["PYTHONPATH"] = os.pathsep.join(filter(None, [ sys.path[0], os.getenv("PYTHONPATH") ]))
+        self.daemonProcess = capturemock.startDaemon([ self.rcFile ], self.environment)
+
+    def tearDown(self):
+        capturemock.stopDaemon(self.daemonProcess, self.environment)
+        shutil.rmtree(self.tmpDir)
+
+    def startSession(self, name, mode, replayFile=None):
+        environment = dict(self.environment)
+        manager = capturemock.CaptureMockManager()
+        recordFile = os.path.join(self.tmpDir, name + ".mock")
+        manager.startServer(mode, recordFile, replayFile, rcFiles=[ self.rcFile ],
+                            interceptDir=os.path.join(self.tmpDir, name),
+                            sutDirectory=self.tmpDir, environment=environment)
+        return manager, environment, recordFile
+
+    def runEcho(self, environment, text):
+        return subprocess.check_output([ "echo", text ], env=environment, cwd=self.tmpDir)
+
+    def readFile(self, fileName):
+        with open(fileName) as f:
+            return f.read()
+
+    def testRecordAndReplayTogether(self):
+        replayFile = os.path.join(self.tmpDir, "replay.mock")
+        with open(replayFile, "w") as f:
+            f.write("<-CMD:echo b\n->OUT:replayed b\n")
+        recorder, recordEnv, recordFile = self.startSession("recorder", capturemock.RECORD)
+        replayer, replayEnv, replayRecordFile = self.startSession("replayer", capturemock.REPLAY, replayFile)
+        try:
+            self.assertEqual(self.runEcho(recordEnv, "a"), b"a\n")
+            self.assertEqual(self.runEcho(replayEnv, "b"), b"replayed b\n")
+            self.assertEqual(self.runEcho(recordEnv, "c"), b"c\n")
+        finally:
+            recorder.terminate()
+            replayer.terminate()
+        self.assertEqual(self.readFile(recordFile), "<-CMD:echo a\n->OUT:a\n<-CMD:echo c\n->OUT:c\n")
+        self.assertEqual(self.readFile(replayRecordFile), "<-CMD:echo b\n->OUT:replayed b\n")
+
+
+if __name__ == "__main__":
+    unittest.main()
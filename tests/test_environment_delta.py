@@ -0,0 +1,77 @@
+""" Intercepted commands send only how their environment differs from the one they were set up with,
+and the server works out the same environment from that as from the whole thing """
+
+import os, sys, shutil, tempfile, subprocess, unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import capturemock
+
+expected = """<-CMD:env --unset=GONE 'FOO=new' 'EXISTING=changed' printenv FOO EXISTING GONE
+->OUT:new
+changed
+->EXC:1
+<-CMD:printenv EXISTING GONE
+->OUT:base
+here
+"""
+
+@unittest.skipUnless(os.name == "posix", "intercepts printenv as a POSIX command")
+class EnvironmentDeltaTest(unittest.TestCase):
+    def setUp(self):
+        self.tmpDir = tempfile.mkdtemp()
+        self.rcFile = os.path.join(self.tmpDir, "capturemockrc")
+        with open(self.rcFile, "w") as f:
+            f.write("[command line]\nintercepts = printenv\nenvironment = FOO,EXISTING,GONE\n")
+        self.environment = dict(os.environ)
+        self.environment["PYTHONPATH"] = os.pathsep.join(filter(None, [ sys.path[0], os.getenv("PYTHONPATH") ]))
+        self.environment["EXISTING"] = "base"
+        self.environment["GONE"] = "here"
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpDir)
+
+    def runPrintenv(self, mode, recordFile, replayFile=None, sendWholeEnvironment=False):
+        manager = capturemock.CaptureMockManager()
+        environment = dict(self.environment)
+        manager.startServer(mode, recordFile, replayFile, rcFiles=[ self.rcFile ],
+                            interceptDir=os.path.join(self.tmpDir, "intercepts"),
+                            sutDirectory=self.tmpDir, environment=environment)
+        if sendWholeEnvironment:
+            del environment["CAPTUREMOCK_ENVIRONMENT"]
+        try:
+            changed = dict(environment, FOO="new", EXISTING="changed")
+            del changed["GONE"]
+            outputs = [ self.getOutput([ "printenv", "FOO", "EXISTING", "GONE" ], changed),
+                        self.getOutput([ "printenv", "EXISTING", "GONE" ], environment) ]
+        finally:
+            manager.terminate()
+        return outputs
+
+    def getOutput(self, cmdArgs, environment):
+        proc = subprocess.Popen(cmdArgs, env=environment, cwd=self.tmpDir, stdout=subprocess.PIPE)
+        return proc.communicate()[0], proc.returncode
+
+    def readFile(self, fileName):
+        with open(fileName) as f:
+            return f.read()
+
+    def checkRecordAndReplay(self, sendWholeEnvironment):
+        recordFile = os.path.join(self.tmpDir, "record.mock")
+        outputs = self.runPrintenv(capturemock.RECORD, recordFile, sendWholeEnvironment=sendWholeEnvironment)
+        self.assertEqual(outputs, [ (b"new\nchanged\n", 1), (b"base\nhere\n", 0) ])
+        self.assertEqual(self.readFile(recordFile), expected)
+        replayRecordFile = os.path.join(self.tmpDir, "replay_record.mock")
+        self.assertEqual(self.runPrintenv(capturemock.REPLAY, replayRecordFile, recordFile, sendWholeEnvironment), outputs)
+        # Only the same if the replaying server worked out the same environment
+        self.assertEqual(self.readFile(replayRecordFile), expected)
+
+    def testDelta(self):
+        self.checkRecordAndReplay(sendWholeEnvironment=False)
+
+    def testWholeEnvironment(self):
+        # What happens if the baseline can't be written
+        self.checkRecordAndReplay(sendWholeEnvironment=True)
+
+
+if __name__ == "__main__":
+    unittest.main()
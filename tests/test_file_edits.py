@@ -0,0 +1,160 @@
+""" Files a recorded command creates, links and deletes are stored with the recording, and put back on replay """
+
+import os, sys, stat, shutil, filecmp, tempfile, subprocess, unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import capturemock
+from capturemock.fileedittraffic import FileEditTraffic
+
+scriptText = """#!/bin/sh
+# Makes many files, a large one, a link, and deletes one file
+mkdir -p "$1/sub/deeper"
+i=0
+while [ $i -lt 50 ]; do echo "file $i" > "$1/sub/f$i.txt"; i=$((i+1)); done
+echo deep > "$1/sub/deeper/d.txt"
+head -c 3000000 /dev/zero | tr '\\\\0' 'x' > "$1/large.txt"
+echo same > "$1/copy1.txt"
+echo same > "$1/copy2.txt"
+ln -sf sub/f1.txt "$1/link"
+rm -f "$1/old.txt"
+"""
+
+class CopyFileTest(unittest.TestCase):
+    def setUp(self):
+        self.tmpDir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpDir)
+
+    def checkCopy(self, data):
+        srcPath = os.path.join(self.tmpDir, "src")
+        dstPath = os.path.join(self.tmpDir, "dst")
+        with open(srcPath, "wb") as f:
+            f.write(data)
+        FileEditTraffic.copyFile(srcPath, dstPath)
+        with open(dstPath, "rb") as f:
+            self.assertEqual(f.read(), data)
+
+    def testLargerThanOneChunk(self):
+        self.checkCopy(os.urandom(3 * 1024 * 1024 + 17))
+
+    def testEmpty(self):
+        self.checkCopy(b"")
+
+    @unittest.skipUnless(os.path.isfile("/proc/self/status"), "needs /proc")
+    def testClaimsToBeEmpty(self):
+        dstPath = os.path.join(self.tmpDir, "status")
+        FileEditTraffic.copyFile("/proc/self/status", dstPath)
+        self.assertGreater(os.path.getsize(dstPath), 0)
+
+
+@unittest.skipUnless(os.name == "posix", "intercepts a shell script as a POSIX command")
+class FileEditsTest(unittest.TestCase):
+    settings = ""
+    def setUp(self):
+        self.tmpDir = tempfile.mkdtemp()
+        binDir = os.path.join(self.tmpDir, "bin")
+        os.mkdir(binDir)
+        script = os.path.join(binDir, "makefiles")
+        with open(script, "w") as f:
+            f.write(scriptText)
+        os.chmod(script, stat.S_IRWXU)
+        self.rcFile = os.path.join(self.tmpDir, "capturemockrc")
+        self.writeRcFile(self.settings)
+        self.environment = dict(os.environ)
+        self.environment["PYTHONPATH"] = os.pathsep.join(filter(None, [ sys.path[0], os.getenv("PYTHONPATH") ]))
+        self.environment["PATH"] = binDir + os.pathsep + self.environment.get("PATH", "")
+        self.workDir = os.path.join(self.tmpDir, "work")
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpDir)
+
+    def writeRcFile(self, settings):
+        with open(self.rcFile, "w") as f:
+            f.write("[general]\n" + settings.replace("TMPDIR", self.tmpDir) + "\n[command line]\nintercepts = makefiles\n")
+
+    def runScript(self, mode, recordFile, recordEditDir, replayFile=None, replayEditDir=None):
+        if os.path.isdir(self.workDir):
+            shutil.rmtree(self.workDir)
+        os.mkdir(self.workDir)
+        with open(os.path.join(self.workDir, "old.txt"), "w") as f:
+            f.write("old\n")
+        manager = capturemock.CaptureMockManager()
+        manager.startServer(mode, recordFile, replayFile, recordEditDir, replayEditDir, rcFiles=[ self.rcFile ],
+                            interceptDir=os.path.join(self.tmpDir, "intercepts"),
+                            sutDirectory=self.tmpDir, environment=self.environment)
+        try:
+            subprocess.check_call([ "makefiles", self.workDir ], env=self.environment, cwd=self.tmpDir)
+        finally:
+            manager.terminate()
+
+    def assertSameTree(self, dir1, dir2):
+        comparison = filecmp.dircmp(dir1, dir2)
+        self.assertEqual((comparison.left_only, comparison.right_only, comparison.diff_files), ([], [], []))
+        for subDir in comparison.common_dirs:
+            self.assertSameTree(os.path.join(dir1, subDir), os.path.join(dir2, subDir))
+
+    def record(self):
+        recordEditDir = os.path.join(self.tmpDir, "edits")
+        recordFile = os.path.join(self.tmpDir, "record.mock")
+        self.runScript(capturemock.RECORD, recordFile, recordEditDir)
+        recordedDir = os.path.join(self.tmpDir, "recorded")
+        os.rename(self.workDir, recordedDir)
+        return recordFile, recordEditDir, recordedDir
+
+    def replay(self, recordFile, recordEditDir):
+        # Replaying doesn't run the script, the files must all come from what was recorded
+        self.runScript(capturemock.REPLAY, os.path.join(self.tmpDir, "replay_record.mock"),
+                       os.path.join(self.tmpDir, "replay_edits"), recordFile, recordEditDir)
+
+    def recordAndReplay(self):
+        recordFile, recordEditDir, recordedDir = self.record()
+        self.replay(recordFile, recordEditDir)
+        self.assertSameTree(recordedDir, self.workDir)
+        self.assertEqual(os.readlink(os.path.join(self.workDir, "link")), "sub/f1.txt")
+        self.assertFalse(os.path.exists(os.path.join(self.workDir, "old.txt")))
+        return os.path.join(recordEditDir, "work")
+
+    def testRecordAndReplay(self):
+        editDir = self.recordAndReplay()
+        self.assertEqual(len(os.listdir(os.path.join(editDir, "sub"))), 51)
+        self.assertEqual(os.path.getsize(os.path.join(editDir, "large.txt")), 3000000)
+
+
+class BlobStoreTest(FileEditsTest):
+    settings = "file_edit_store = TMPDIR/store"
+
+    def getStoredFiles(self, root, suffix=""):
+        found = []
+        for dirName, _, fileNames in os.walk(root):
+            found += [ os.path.join(dirName, f) for f in fileNames if f.endswith(suffix) ]
+        return found
+
+    def testRecordAndReplay(self):
+        editDir = self.recordAndReplay()
+        # Only links and blob references are kept with the recording, the contents are in the store
+        self.assertEqual(os.listdir(os.path.join(editDir, "sub", "deeper")), [ "d.txt.CAPTUREMOCK_BLOB" ])
+        blobFiles = self.getStoredFiles(editDir, FileEditTraffic.blobSuffix)
+        self.assertEqual(len(blobFiles), 54)
+        with open(os.path.join(editDir, "copy1.txt.CAPTUREMOCK_BLOB")) as f:
+            blobName = f.read().strip()
+        with open(os.path.join(editDir, "copy2.txt.CAPTUREMOCK_BLOB")) as f:
+            self.assertEqual(f.read().strip(), blobName)
+        self.assertEqual(blobName, FileEditTraffic.hashFile(os.path.join(self.workDir, "copy1.txt")))
+        # Identical contents are stored once
+        storeDir = os.path.join(self.tmpDir, "store")
+        self.assertTrue(os.path.isfile(os.path.join(storeDir, blobName[:2], blobName[2:])))
+        self.assertEqual(len(self.getStoredFiles(storeDir)), 53)
+
+    def testReplayWithoutStore(self):
+        recordFile, recordEditDir, recordedDir = self.record()
+        self.writeRcFile("")
+        self.replay(recordFile, recordEditDir)
+        # The blobs can't be found, so are reported and left out, while links are still restored
+        self.assertFalse(os.path.exists(os.path.join(self.workDir, "large.txt")))
+        self.assertFalse(os.path.exists(os.path.join(self.workDir, "sub", "f0.txt")))
+        self.assertEqual(os.readlink(os.path.join(self.workDir, "link")), "sub/f1.txt")
+
+
+if __name__ == "__main__":
+    unittest.main()
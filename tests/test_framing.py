@@ -0,0 +1,96 @@
+""" The framed protocol carries requests and responses of any size, and intercepted commands replay what they recorded through it """
+
+import os, io, sys, stat, shutil, tempfile, subprocess, unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import capturemock
+from capturemock import framing
+
+scriptText = """#!%s
+import sys
+sys.stdout.write("x" * 200000 + "\\n\\u00e9\\n")
+sys.stderr.write("err line\\n")
+sys.exit(3)
+"""
+
+class FramingTest(unittest.TestCase):
+    def testLargeRequest(self):
+        request = b"".join(str(i).encode() for i in range(50000))
+        self.assertGreater(len(request), framing.maxFrameSize * 2)
+        stream = io.BytesIO()
+        framing.sendRequest(stream.write, request)
+        stream.seek(0)
+        self.assertEqual(framing.readRequest(stream.read), request)
+        self.assertEqual(framing.readFrame(stream.read), (None, None))
+
+    def testConnectionClosedMidRequest(self):
+        stream = io.BytesIO()
+        framing.writeField(stream.write, framing.REQ, b"unfinished")
+        stream.seek(0)
+        self.assertIsNone(framing.readRequest(stream.read))
+
+    def testResponseEndsOnce(self):
+        stream = io.BytesIO()
+        responseFile = framing.FramedResponseFile(stream)
+        responseFile.writeField(framing.OUT, b"output")
+        responseFile.write(b"message")
+        responseFile.close()
+        responseFile.close()
+        stream.seek(0)
+        frames = []
+        frameType, data = framing.readFrame(stream.read)
+        while frameType is not None:
+            frames.append((frameType, data))
+            frameType, data = framing.readFrame(stream.read)
+        self.assertEqual(frames, [ (framing.OUT, b"output"), (framing.MSG, b"message"), (framing.END, b"") ])
+
+
+@unittest.skipUnless(os.name == "posix", "intercepts a script as a POSIX command")
+class FramedCommandTest(unittest.TestCase):
+    def setUp(self):
+        self.tmpDir = tempfile.mkdtemp()
+        binDir = os.path.join(self.tmpDir, "bin")
+        os.mkdir(binDir)
+        self.script = os.path.join(binDir, "bigout")
+        with open(self.script, "w") as f:
+            f.write(scriptText % sys.executable)
+        os.chmod(self.script, stat.S_IRWXU)
+        self.rcFile = os.path.join(self.tmpDir, "capturemockrc")
+        with open(self.rcFile, "w") as f:
+            f.write("[command line]\nintercepts = bigout\n")
+        self.environment = dict(os.environ)
+        self.environment["PYTHONPATH"] = os.pathsep.join(filter(None, [ sys.path[0], os.getenv("PYTHONPATH") ]))
+        self.environment["PYTHONIOENCODING"] = "utf-8"
+        self.environment["PATH"] = binDir + os.pathsep + self.environment.get("PATH", "")
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpDir)
+
+    def runScript(self, mode, recordFile, replayFile=None):
+        manager = capturemock.CaptureMockManager()
+        manager.startServer(mode, recordFile, replayFile, rcFiles=[ self.rcFile ],
+                            interceptDir=os.path.join(self.tmpDir, "intercepts"),
+                            sutDirectory=self.tmpDir, environment=self.environment)
+        try:
+            proc = subprocess.Popen([ "bigout" ], env=self.environment, cwd=self.tmpDir,
+                                    stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+            output, errors = proc.communicate()
+            return output, errors, proc.returncode
+        finally:
+            manager.terminate()
+
+    def testRecordAndReplay(self):
+        recordFile = os.path.join(self.tmpDir, "record.mock")
+        recorded = self.runScript(capturemock.RECORD, recordFile)
+        self.assertEqual(recorded, (b"x" * 200000 + u"\né\n".encode("utf-8"), b"err line\n", 3))
+        # Can only come from the record file now
+        os.remove(self.script)
+        replayRecordFile = os.path.join(self.tmpDir, "replay_record.mock")
+        self.assertEqual(self.runScript(capturemock.REPLAY, replayRecordFile, recordFile), recorded)
+        with open(recordFile, "rb") as f:
+            with open(replayRecordFile, "rb") as f2:
+                self.assertEqual(f.read(), f2.read())
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,76 @@
+""" Attributes defined in a subclass of an intercepted class are looked up locally, even if added later """
+
+import os, sys, shutil, tempfile, unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import capturemock
+
+moduleText = """
+import abc
+class Shape(object):
+    def area(self):
+        return 1
+AbstractBase = abc.ABCMeta("AbstractBase", (object,), { "__module__" : __name__ })
+class Abstract(AbstractBase):
+    def area(self):
+        return 5
+"""
+
+class LocalAttributesTest(unittest.TestCase):
+    def setUp(self):
+        self.tmpDir = tempfile.mkdtemp()
+        with open(os.path.join(self.tmpDir, "shapes.py"), "w") as f:
+            f.write(moduleText)
+        rcFile = os.path.join(self.tmpDir, "capturemockrc")
+        with open(rcFile, "w") as f:
+            f.write("[python]\nintercepts = shapes\n")
+        self.recordFile = os.path.join(self.tmpDir, "record.mock")
+        sys.path.insert(0, self.tmpDir)
+        self.interceptor = capturemock.interceptPython(capturemock.RECORD, self.recordFile, None, [ rcFile ], [])
+
+    def tearDown(self):
+        self.interceptor.resetIntercepts()
+        sys.path.remove(self.tmpDir)
+        sys.modules.pop("shapes", None)
+        shutil.rmtree(self.tmpDir)
+
+    def checkSubclass(self, baseClass, area):
+        class Square(baseClass):
+            def side(self):
+                return 2
+        square = Square()
+        self.assertEqual(square.side(), 2)
+        self.assertEqual(square.area(), area)
+        Square.extra = lambda self: 3
+        self.assertEqual(square.extra(), 3)
+        # Same number of attributes as before, but not the same ones
+        del Square.extra
+        Square.other = lambda self: 4
+        self.assertEqual(square.other(), 4)
+        self.assertFalse(hasattr(square, "extra"))
+
+    def readRecordFile(self):
+        self.interceptor.resetIntercepts()
+        with open(self.recordFile) as f:
+            return f.read()
+
+    def testSubclass(self):
+        import shapes
+        self.checkSubclass(shapes.Shape, 1)
+        recorded = self.readRecordFile()
+        self.assertIn("<-PYT:shape1.area()\n->RET:1\n", recorded)
+        self.assertNotIn("side", recorded)
+        self.assertNotIn("other", recorded)
+        # Only asked for once it had gone again
+        self.assertEqual(recorded.count("extra"), 2)
+
+    def testSubclassWithMetaClass(self):
+        import shapes
+        self.checkSubclass(shapes.Abstract, 5)
+        recorded = self.readRecordFile()
+        self.assertIn("->RET:5\n", recorded)
+        self.assertNotIn("side", recorded)
+
+
+if __name__ == "__main__":
+    unittest.main()
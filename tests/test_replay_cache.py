@@ -0,0 +1,72 @@
+""" The replay cache gives the same replay as parsing the record file, and is only used when it can be trusted """
+
+import os, sys, stat, shutil, tempfile, subprocess, unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import capturemock
+from capturemock import config, replayinfo
+
+@unittest.skipUnless(os.name == "posix", "intercepts echo as a POSIX command")
+class ReplayCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.tmpDir = tempfile.mkdtemp()
+        self.cacheDir = os.path.join(self.tmpDir, "cache")
+        self.rcFile = os.path.join(self.tmpDir, "capturemockrc")
+        with open(self.rcFile, "w") as f:
+            f.write("[general]\nreplay_cache_dir = " + self.cacheDir + "\n[command line]\nintercepts = echo\n")
+        self.replayFile = os.path.join(self.tmpDir, "replay.mock")
+        self.writeReplayFile("replayed")
+        self.environment = dict(os.environ)
+        self.environment["PYTHONPATH"] = os.pathsep.join(filter(None, [ sys.path[0], os.getenv("PYTHONPATH") ]))
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpDir)
+
+    def writeReplayFile(self, output):
+        with open(self.replayFile, "w") as f:
+            f.write("<-CMD:echo hello\n->OUT:" + output + "\n")
+
+    def replayEcho(self):
+        manager = capturemock.CaptureMockManager()
+        manager.startServer(capturemock.REPLAY, os.path.join(self.tmpDir, "record.mock"), self.replayFile,
+                            rcFiles=[ self.rcFile ], interceptDir=os.path.join(self.tmpDir, "intercepts"),
+                            sutDirectory=self.tmpDir, environment=self.environment)
+        try:
+            return subprocess.check_output([ "echo", "hello" ], env=self.environment, cwd=self.tmpDir)
+        finally:
+            manager.terminate()
+
+    def getCacheFile(self):
+        return replayinfo.ReplayInfo.getCacheInfo(self.cacheDir, self.replayFile, [])[0]
+
+    def makeReplayInfo(self):
+        return replayinfo.ReplayInfo(config.REPLAY, self.replayFile, config.RcFileHandler([ self.rcFile ]))
+
+    def getResponses(self, replayInfo):
+        return [ repr(handler) for handler in replayInfo.responseMap.values() ]
+
+    def testReplayFromCache(self):
+        self.assertEqual(self.replayEcho(), b"replayed\n")
+        cacheFile = self.getCacheFile()
+        self.assertTrue(os.path.isfile(cacheFile))
+        self.assertEqual(stat.S_IMODE(os.stat(cacheFile).st_mode), 0o600)
+        self.assertEqual(self.replayEcho(), b"replayed\n")
+
+    def testChangedContentsNotCached(self):
+        self.assertEqual(self.getResponses(self.makeReplayInfo()), [ "[['->OUT:replayed\\n']]" ])
+        # Same size and modification time, only the contents show it has changed
+        statInfo = os.stat(self.replayFile)
+        self.writeReplayFile("REPLAYED")
+        os.utime(self.replayFile, (statInfo.st_atime, statInfo.st_mtime))
+        self.assertEqual(self.getResponses(self.makeReplayInfo()), [ "[['->OUT:REPLAYED\\n']]" ])
+
+    def testCacheOthersCanWriteIgnored(self):
+        replayInfo = self.makeReplayInfo()
+        cacheFile, cacheKey = replayInfo.getCacheInfo(self.cacheDir, self.replayFile, [ ("echo", None) ])
+        self.assertTrue(replayInfo.readCache(cacheFile, cacheKey))
+        os.chmod(cacheFile, 0o666)
+        self.assertFalse(replayInfo.readCache(cacheFile, cacheKey))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,57 @@
+""" Asking a running server for its statistics shouldn't hold up recording the traffic that comes after """
+
+import os, sys, shutil, tempfile, subprocess, unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import capturemock
+
+@unittest.skipUnless(os.name == "posix", "intercepts echo as a POSIX command")
+class StatisticsQueryTest(unittest.TestCase):
+    def setUp(self):
+        self.tmpDir = tempfile.mkdtemp()
+        self.rcFile = os.path.join(self.tmpDir, "capturemockrc")
+        with open(self.rcFile, "w") as f:
+            f.write("[general]\ncollect_statistics = True\n[command line]\nintercepts = echo\n")
+        self.recordFile = os.path.join(self.tmpDir, "record.mock")
+        self.environment = dict(os.environ)
+        # The server runs as a separate process, and needs to find this capturemock
+        self.environment["PYTHONPATH"] = os.pathsep.join(filter(None, [ sys.path[0], os.getenv("PYTHONPATH") ]))
+        self.daemonProcess = None
+
+    def tearDown(self):
+        if self.daemonProcess:
+            capturemock.stopDaemon(self.daemonProcess, self.environment)
+        shutil.rmtree(self.tmpDir)
+
+    def runEcho(self, text):
+        subprocess.check_call([ "echo", text ], env=self.environment, cwd=self.tmpDir, stdout=subprocess.PIPE)
+
+    def readRecordFile(self):
+        with open(self.recordFile) as f:
+            return f.read()
+
+    def checkRecordedAfterQuery(self):
+        manager = capturemock.CaptureMockManager()
+        manager.startServer(capturemock.RECORD, self.recordFile, rcFiles=[ self.rcFile ],
+                            interceptDir=os.path.join(self.tmpDir, "intercepts"),
+                            sutDirectory=self.tmpDir, environment=self.environment)
+        try:
+            self.runEcho("first")
+            self.assertIn("CommandLineTraffic", manager.getStatistics())
+            self.runEcho("again")
+            # Still running, so it can only be there if it wasn't held back behind the query
+            self.assertIn("<-CMD:echo again", self.readRecordFile())
+        finally:
+            manager.terminate()
+        self.assertEqual(self.readRecordFile(), "<-CMD:echo first\n->OUT:first\n<-CMD:echo again\n->OUT:again\n")
+
+    def testServer(self):
+        self.checkRecordedAfterQuery()
+
+    def testDaemonSession(self):
+        self.daemonProcess = capturemock.startDaemon([ self.rcFile ], self.environment)
+        self.checkRecordedAfterQuery()
+
+
+if __name__ == "__main__":
+    unittest.main()
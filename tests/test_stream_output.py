@@ -0,0 +1,87 @@
+""" With stream_output, a recorded command's output reaches the caller while it is still running, and replays as normal """
+
+import os, sys, stat, shutil, tempfile, subprocess, unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import capturemock
+
+# Only finishes early if whoever runs it can see its first line while it is still running
+scriptText = """#!%s
+import sys, os, time
+sys.stdout.write("started\\n")
+sys.stdout.flush()
+sys.stderr.write("some errors\\n")
+sys.stderr.flush()
+for _ in range(100):
+    if os.path.exists(sys.argv[1]):
+        sys.stdout.write("seen marker\\n")
+        sys.exit(2)
+    time.sleep(0.05)
+sys.stdout.write("timed out\\n")
+"""
+
+@unittest.skipUnless(os.name == "posix", "intercepts a script as a POSIX command")
+class StreamOutputTest(unittest.TestCase):
+    def setUp(self):
+        self.tmpDir = tempfile.mkdtemp()
+        binDir = os.path.join(self.tmpDir, "bin")
+        os.mkdir(binDir)
+        self.script = os.path.join(binDir, "waiter")
+        with open(self.script, "w") as f:
+            f.write(scriptText % sys.executable)
+        os.chmod(self.script, stat.S_IRWXU)
+        self.rcFile = os.path.join(self.tmpDir, "capturemockrc")
+        self.environment = dict(os.environ)
+        self.environment["PYTHONPATH"] = os.pathsep.join(filter(None, [ sys.path[0], os.getenv("PYTHONPATH") ]))
+        self.environment["PATH"] = binDir + os.pathsep + self.environment.get("PATH", "")
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpDir)
+
+    def writeRcFile(self, protocol):
+        with open(self.rcFile, "w") as f:
+            f.write("[general]\nserver_protocol = " + protocol + "\n[command line]\nintercepts = waiter\nstream_output = True\n")
+
+    def runScript(self, mode, recordFile, replayFile=None):
+        manager = capturemock.CaptureMockManager()
+        manager.startServer(mode, recordFile, replayFile, rcFiles=[ self.rcFile ],
+                            interceptDir=os.path.join(self.tmpDir, "intercepts"),
+                            sutDirectory=self.tmpDir, environment=self.environment)
+        try:
+            proc = subprocess.Popen([ "waiter", "marker" ], env=self.environment, cwd=self.tmpDir,
+                                    stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+            firstLine = proc.stdout.readline()
+            with open(os.path.join(self.tmpDir, "marker"), "w"):
+                pass
+            # Not communicate(), which would miss anything readline has buffered
+            output = proc.stdout.read()
+            errors = proc.stderr.read()
+            proc.stdout.close()
+            proc.stderr.close()
+            return firstLine + output, errors, proc.wait()
+        finally:
+            manager.terminate()
+            os.remove(os.path.join(self.tmpDir, "marker"))
+
+    def checkRecordAndReplay(self):
+        recordFile = os.path.join(self.tmpDir, "record.mock")
+        recorded = self.runScript(capturemock.RECORD, recordFile)
+        self.assertEqual(recorded, (b"started\nseen marker\n", b"some errors\n", 2))
+        with open(recordFile) as f:
+            self.assertEqual(f.read(), "<-CMD:waiter marker\n->OUT:started\nseen marker\n->ERR:some errors\n->EXC:2\n")
+        # Can only come from the record file now
+        os.remove(self.script)
+        replayRecordFile = os.path.join(self.tmpDir, "replay_record.mock")
+        self.assertEqual(self.runScript(capturemock.REPLAY, replayRecordFile, recordFile), recorded)
+
+    def testClassic(self):
+        self.writeRcFile("classic")
+        self.checkRecordAndReplay()
+
+    def testAsyncio(self):
+        self.writeRcFile("asyncio")
+        self.checkRecordAndReplay()
+
+
+if __name__ == "__main__":
+    unittest.main()
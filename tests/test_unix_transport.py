@@ -0,0 +1,76 @@
+""" Servers listening on a Unix domain socket record and replay just as they do over TCP """
+
+import os, sys, shutil, tempfile, subprocess, unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import capturemock
+
+@unittest.skipUnless(hasattr(os, "fork"), "needs Unix domain sockets, and intercepts echo as a POSIX command")
+class UnixTransportTest(unittest.TestCase):
+    def setUp(self):
+        self.tmpDir = tempfile.mkdtemp()
+        self.rcFile = os.path.join(self.tmpDir, "capturemockrc")
+        self.environment = dict(os.environ)
+        self.environment["PYTHONPATH"] = os.pathsep.join(filter(None, [ sys.path[0], os.getenv("PYTHONPATH") ]))
+        self.daemonProcess = None
+
+    def tearDown(self):
+        if self.daemonProcess:
+            capturemock.stopDaemon(self.daemonProcess, self.environment)
+        shutil.rmtree(self.tmpDir)
+
+    def writeRcFile(self, protocol):
+        with open(self.rcFile, "w") as f:
+            f.write("[general]\nserver_transport = unix\nserver_protocol = " + protocol + "\n[command line]\nintercepts = echo\n")
+
+    def runEchoes(self, mode, recordFile, replayFile=None):
+        manager = capturemock.CaptureMockManager()
+        manager.startServer(mode, recordFile, replayFile, rcFiles=[ self.rcFile ],
+                            interceptDir=os.path.join(self.tmpDir, "intercepts"),
+                            sutDirectory=self.tmpDir, environment=self.environment)
+        try:
+            self.socketPath = self.environment["CAPTUREMOCK_SERVER"].split("#")[0]
+            self.assertTrue(os.path.exists(self.socketPath), self.socketPath + " should be the server's socket")
+            outputs = [ subprocess.check_output([ "echo", text ], env=self.environment, cwd=self.tmpDir)
+                        for text in [ "one", "two" ] ]
+        finally:
+            manager.terminate()
+        if not self.daemonProcess:
+            self.assertFalse(os.path.exists(self.socketPath), "socket should be removed when the server stops")
+        return outputs
+
+    def readFile(self, fileName):
+        with open(fileName) as f:
+            return f.read()
+
+    def checkRecordAndReplay(self):
+        recordFile = os.path.join(self.tmpDir, "record.mock")
+        self.assertEqual(self.runEchoes(capturemock.RECORD, recordFile), [ b"one\n", b"two\n" ])
+        recorded = "<-CMD:echo one\n->OUT:one\n<-CMD:echo two\n->OUT:two\n"
+        self.assertEqual(self.readFile(recordFile), recorded)
+        with open(recordFile, "w") as f:
+            f.write(recorded.replace("->OUT:", "->OUT:replayed "))
+        replayRecordFile = os.path.join(self.tmpDir, "replay_record.mock")
+        self.assertEqual(self.runEchoes(capturemock.REPLAY, replayRecordFile, recordFile),
+                         [ b"replayed one\n", b"replayed two\n" ])
+
+    def testClassic(self):
+        self.writeRcFile("classic")
+        self.checkRecordAndReplay()
+
+    def testAsyncio(self):
+        self.writeRcFile("asyncio")
+        self.checkRecordAndReplay()
+
+    def testDaemonSession(self):
+        self.writeRcFile("classic")
+        self.daemonProcess = capturemock.startDaemon([ self.rcFile ], self.environment)
+        self.checkRecordAndReplay()
+        # Sessions share the daemon's socket, which goes with the daemon
+        capturemock.stopDaemon(self.daemonProcess, self.environment)
+        self.daemonProcess = None
+        self.assertFalse(os.path.exists(self.socketPath), "socket should be removed when the daemon stops")
+
+
+if __name__ == "__main__":
+    unittest.main()